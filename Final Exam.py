@@ -1,14 +1,100 @@
+# %% [markdown]
+# # The Online Cafeteria
+# ## Final Exam in Programming, Algorithms and Data Structures
+# ### Daniel Henke, 176182
+
+# %% [markdown]
+# #### Money
+# 
+# All amounts are kept as whole øre in integers, so revenue and balances add up exactly. Prices on the menus are still given in dkk and converted when an order is priced. A discount is applied with a precomputed multiplier for its tier and rounded half up to the nearest øre, once per order.
+
+# %%
+from array import array
+
+ORE_PER_DKK = 100
+#share of the price that is paid in percent, for every discount from 0 to 100
+PRICE_MULTIPLIERS = [100 - discount for discount in range(101)]
+
+def to_ore(dkk):
+    """Converts an amount in dkk to whole øre."""
+    return round(dkk * ORE_PER_DKK)
+
+def to_dkk(ore):
+    """Converts an amount in øre to dkk."""
+    return ore / ORE_PER_DKK
+
+def format_dkk(ore):
+    """Returns an amount in øre as dkk for messages, as a whole number if there are no øre."""
+    return ore // ORE_PER_DKK if ore % ORE_PER_DKK == 0 else to_dkk(ore)
+
+def valid_discount(discount):
+    """Checks that a discount is one of the tiers in PRICE_MULTIPLIERS, a whole number from 0 to 100."""
+    return isinstance(discount, int) and 0 <= discount < len(PRICE_MULTIPLIERS)
+
+def discounted_ore(price_ore, quantity, discount):
+    """Returns the price of a quantity of an item after the discount, rounded half up to whole øre.
+
+    Args:
+        price_ore (int): the price of one item in øre
+        quantity (int): the number of items
+        discount (int): the discount in percent
+
+    Returns:
+        int: The discounted price in øre
+    """
+    return (price_ore * quantity * PRICE_MULTIPLIERS[discount] + 50) // 100
+
+def discounted_prices_ore(prices_ore, discount):
+    """Applies a discount to many prices at once.
+
+    Args:
+        prices_ore (iterable): the prices of single items in øre
+        discount (int): the discount in percent
+
+    Returns:
+        array: An array of the discounted prices in øre
+    """
+    multiplier = PRICE_MULTIPLIERS[discount]
+    return array('q', [(price * multiplier + 50) // 100 for price in prices_ore])
+
+# %% [markdown]
+# #### Customer Class
+# 
+# Customers can view the menu of a cafeteria, both compact and detailed, add balance, place and pick-up an order and search the menus. Beyond those, there getters for the balance and the open orders.
+
+# %%
 class General_Customer:
-    def __init__(self, name, customer_id, university, customer_type, discount=0):
-        assert discount>=0 and discount<=100, "Discount should be between 0 and 100"
+    #no __dict__ per customer; the type and the discount are the same for all customers of a class
+    __slots__ = ("name", "customer_id", "university", "balance_ore", "order_list")
+    customer_type = "Customer"
+    discount = 0
+    
+    def __init__(self, name, customer_id, university, customer_type=None, discount=None):
+        assert discount == None or valid_discount(discount), "Discount should be a whole number between 0 and 100"
         assert isinstance(university, University), "university should be of type University"
+        #a type or discount that differs from the class is kept in a subclass shared by all customers like it
+        if (customer_type != None and customer_type != self.customer_type) or (discount != None and discount != self.discount):
+            self.__class__ = customer_class(type(self), customer_type or self.customer_type, self.discount if discount == None else discount)
         self.name = name
         self.customer_id = customer_id
         self.university = university
-        self.customer_type = customer_type
-        self.discount = discount
-        self.balance = 0
-        self.orders = []
+        self.balance_ore = 0
+        self.order_list = None
+        
+    @property
+    def orders(self):
+        #most customers never order, so the list is only created when it is first needed
+        if self.order_list == None:
+            self.order_list = []
+        return self.order_list
+    
+    @property
+    def balance(self):
+        return to_dkk(self.balance_ore)
+    
+    @balance.setter
+    def balance(self, amount):
+        self.balance_ore = to_ore(amount)
     
     def __str__(self):
         if self.customer_id == None:
@@ -31,9 +117,10 @@ class General_Customer:
         cafeteria = self.university.get_cafeteria(cafeteria_name)
         assert cafeteria != None, f"Sorry, {cafeteria_name} is not available in the university"
         menu_with_discount = {}
-        for item, details in cafeteria.menu.items():
-            discounted_price = details['price'] * (1 - (self.discount / 100))
-            menu_with_discount[item] = (discounted_price, details['quantity'])
+        menu = cafeteria.snapshot.menu
+        prices = discounted_prices_ore([to_ore(details['price']) for details in menu.values()], self.discount)
+        for (item, details), price in zip(menu.items(), prices):
+            menu_with_discount[item] = (to_dkk(price), details['quantity'])
         return menu_with_discount
     
     def view_detailed_menu(self, cafeteria_name):
@@ -48,10 +135,11 @@ class General_Customer:
         cafeteria = self.university.get_cafeteria(cafeteria_name)
         assert cafeteria != None, f"Sorry, {cafeteria_name} is not available in the university"
         detailed_menu = {}
-        for item, details in cafeteria.menu.items():
-            #price is discounted for staff and students
-            discounted_price = details['price'] * (1 - (self.discount / 100))
-            detailed_menu[item] = (details['description'], discounted_price, details['quantity'])
+        menu = cafeteria.snapshot.menu
+        #price is discounted for staff and students
+        prices = discounted_prices_ore([to_ore(details['price']) for details in menu.values()], self.discount)
+        for (item, details), price in zip(menu.items(), prices):
+            detailed_menu[item] = (details['description'], to_dkk(price), details['quantity'])
         return detailed_menu
     
     #this method is only available for staff and students
@@ -65,17 +153,20 @@ class General_Customer:
             str: A message indicating the success of the balance addition
         """
         assert amount>0, "Amount should be greater than 0"
-        self.balance+=amount
-        return f"{amount}dkk added to the balance of {self.name}. The new balance is {self.balance}dkk"
+        with self.university.customer_lock(self.customer_id):
+            self.balance_ore+=to_ore(amount)
+            self.university.ledger.record("top_up", to_ore(amount), self.customer_id, self.customer_type)
+        return f"{amount}dkk added to the balance of {self.name}. The new balance is {format_dkk(self.balance_ore)}dkk"
         
     #this method is only available for staff and students 
-    def place_order(self, cafeteria_name, item, quantity):
+    def place_order(self, cafeteria_name, item, quantity, pickup_time=None):
         """Places an order in a cafeteria.
 
         Args:
             cafeteria_name (String): the cafeteria where the order is to be placed
             item (string): the item to be ordered
             quantity (int): number of items to be ordered
+            pickup_time (float, optional): pre-orders the item for this pickup time, only in cafeterias with a kitchen scheduler
             
         Returns:
             tuple: A tuple containing a potential message and the order object
@@ -83,28 +174,91 @@ class General_Customer:
         cafeteria=self.university.get_cafeteria(cafeteria_name)
         assert cafeteria!=None, f"Sorry, {cafeteria_name} is not available in the university"
         assert quantity>0, "Quantity should be greater than 0"
-        if item in cafeteria.menu:
-            #calculating the price after discount for full order           
-            price = cafeteria.menu[item]['price']*quantity*(1-(self.discount/100))
-            if self.balance < price:
-                raise ValueError(f"Sorry, you do not have enough balance to place this order")
-            
-            #placing the order with the cafeteria
-            order=cafeteria.process_order(self.customer_id, self.customer_type, item, quantity, self.discount)
+        #expired holds give their stock back before the order is placed; this refunds other customers, so it has to happen before taking the customer lock
+        cafeteria.release_expired_holds()
+        #the balance check, the order and the debit happen under the customer lock, so concurrent tills cannot overdraw the account
+        with self.university.customer_lock(self.customer_id):
+            #the menu and the price are checked under the same cafeteria lock as the reservation, so they cannot change in between
+            with cafeteria.lock:
+                if item not in cafeteria.menu:
+                    raise ValueError(f"Sorry, {item} is not available in the menu")
+                #calculating the price after discount for full order           
+                price = discounted_ore(to_ore(cafeteria.menu[item]['price']), quantity, self.discount)
+                if self.balance_ore < price:
+                    raise ValueError(f"Sorry, you do not have enough balance to place this order")
+                
+                #placing the order with the cafeteria
+                order=cafeteria.process_order(self.customer_id, self.customer_type, item, quantity, self.discount, pickup_time)
             
             #updating the balance based on the actual order (may be lower quantity)
-            self.balance-=order[1].price
+            self.balance_ore-=order[1].price_ore
             self.orders.append(order[1])
-            return order
-                
-        else:
-            raise ValueError(f"Sorry, {item} is not available in the menu")
+            self.university.ledger.record("debit", order[1].price_ore, self.customer_id, self.customer_type, cafeteria_name)
+        return order
         
     
+    #this method is only available for staff and students 
+    def place_order_anywhere(self, item, quantity, pickup_time=None):
+        """Places an order in the cafeteria where it is expected to be ready first. If that cafeteria turns the order away, the next one is tried.
+
+        Args:
+            item (string): the item to be ordered
+            quantity (int): number of items to be ordered
+            pickup_time (float, optional): pre-orders the item for this pickup time
+
+        Returns:
+            tuple: A tuple containing a potential message and the order object
+        """
+        ranking = self.university.rank_cafeterias(item, quantity)
+        if not ranking:
+            raise ValueError(f"Sorry, {item} is not available in any cafeteria right now")
+        for position, (cafeteria_name, _, _) in enumerate(ranking):
+            try:
+                return self.place_order(cafeteria_name, item, quantity, pickup_time)
+            except OrderRejected:
+                if position == len(ranking) - 1:
+                    raise
+    
+    #this method is only available for staff and students 
+    def place_basket_order(self, cafeteria_name, basket, pickup_time=None):
+        """Places one order for several items in a cafeteria. Either the whole basket is ordered or nothing.
+
+        Args:
+            cafeteria_name (String): the cafeteria where the order is to be placed
+            basket (dict): a dictionary with item names as keys and quantities as values
+            pickup_time (float, optional): pre-orders the basket for this pickup time, only in cafeterias with a kitchen scheduler
+            
+        Returns:
+            tuple: A tuple containing a potential message and the basket order object
+        """
+        cafeteria=self.university.get_cafeteria(cafeteria_name)
+        assert cafeteria!=None, f"Sorry, {cafeteria_name} is not available in the university"
+        cafeteria.release_expired_holds()
+        with self.university.customer_lock(self.customer_id):
+            #the basket is priced under the same cafeteria lock as the reservation, so the prices cannot change in between
+            with cafeteria.lock:
+                if self.balance_ore < cafeteria.basket_price_ore(basket, self.discount):
+                    raise ValueError(f"Sorry, you do not have enough balance to place this order")
+                order=cafeteria.process_basket(self.customer_id, self.customer_type, basket, self.discount, pickup_time)
+            self.balance_ore-=order[1].price_ore
+            self.orders.append(order[1])
+            self.university.ledger.record("debit", order[1].price_ore, self.customer_id, self.customer_type, cafeteria_name)
+        return order
+    
     def view_orders(self):
         """Lets the customer view all the orders placed by them and not picked up yet."""
         return self.orders
     
+    def iter_orders(self, status=None, where=None):
+        """Yields the orders of the customer that are not picked up yet, optionally only those with a status or for which where(order) is true. Only the references are copied under the lock, so the orders can change while they are consumed."""
+        if self.order_list == None:
+            return
+        with self.university.customer_lock(self.customer_id):
+            orders = tuple(self.order_list)
+        for order in orders:
+            if (status == None or order.status == status) and (where == None or where(order)):
+                yield order
+    
     def get_balance(self):
         """Returns the balance of the customer."""
         return self.balance
@@ -118,10 +272,11 @@ class General_Customer:
         Returns: 
             the success or failure message of the order pick up
         """
-        for order in self.orders:
-            if order.order_id == order_id:
-                self.orders.remove(order)
-                return order.pick_up()
+        with self.university.customer_lock(self.customer_id):
+            for order in self.orders:
+                if order.order_id == order_id:
+                    self.orders.remove(order)
+                    return order.pick_up()
         raise ValueError(f"Sorry, order with id {order_id} not found")
     
     def search_menus(self, item):
@@ -135,21 +290,35 @@ class General_Customer:
         """
         result=self.university.search_menu(item)
         if result[0]!=False:
+            prices = discounted_prices_ore([to_ore(row[2]) for row in result], self.discount)
             for i in range(len(result)):
-                result[i][2]=result[i][2]*(1-(self.discount/100))
+                result[i][2]=to_dkk(prices[i])
             return result
         else:
             return result
         
 
+#(class, customer type, discount) -> subclass for customers whose type or discount differs from their class
+CUSTOMER_CLASSES = {}
+
+def customer_class(base, customer_type, discount):
+    """Returns the subclass of a customer class with another customer type and discount, so these stay class attributes."""
+    assert valid_discount(discount), "Discount should be a whole number between 0 and 100"
+    key = (base, customer_type, discount)
+    if key not in CUSTOMER_CLASSES:
+        CUSTOMER_CLASSES[key] = type(base.__name__, (base,), {"__slots__": (), "customer_type": customer_type, "discount": discount})
+    return CUSTOMER_CLASSES[key]
+        
+
 # %% [markdown]
 # #### Student
 # The first subclass of customer
 
 # %%
 class Student(General_Customer):
-    def __init__(self, name, student_id, university):
-        super().__init__(name, student_id, university, "Student", 20)
+    __slots__ = ()
+    customer_type = "Student"
+    discount = 20
 
 # %% [markdown]
 # #### Staff
@@ -158,8 +327,9 @@ class Student(General_Customer):
 
 # %%
 class Staff(General_Customer):
-    def __init__(self, name, staff_id, university):
-        super().__init__(name, staff_id, university, "Staff", 10)
+    __slots__ = ()
+    customer_type = "Staff"
+    discount = 10
 
 # %% [markdown]
 # #### Guest
@@ -167,10 +337,19 @@ class Staff(General_Customer):
 
 # %%
 class Guest(General_Customer):
+    __slots__ = ()
+    customer_type = "Guest"
+    
     def __init__(self, name, university):
-        super().__init__(name, None, university, "Guest", 0)
+        super().__init__(name, None, university)
+    
+    def place_order(self, cafeteria, item, quantity, pickup_time=None):
+        raise PermissionError("Guests cannot place orders online. Please book in person.")
     
-    def place_order(self, cafeteria, item, quantity):
+    def place_order_anywhere(self, item, quantity, pickup_time=None):
+        raise PermissionError("Guests cannot place orders online. Please book in person.")
+    
+    def place_basket_order(self, cafeteria, basket, pickup_time=None):
         raise PermissionError("Guests cannot place orders online. Please book in person.")
     
     def add_balance(self, amount):
@@ -182,29 +361,363 @@ class Guest(General_Customer):
     def view_orders(self):
         raise PermissionError("Guests do not have any orders.")
     
+    def iter_orders(self, status=None, where=None):
+        raise PermissionError("Guests do not have any orders.")
+    
     def pick_up_order(self, order_id):
         raise PermissionError("Guests cannot pick up orders.")
     
         
+# %% [markdown]
+# #### Compact Accounts
+# 
+# For very many customers, a university can keep its students and staff in an AccountTable instead of one object each. The ids, balances and types are stored in typed arrays, generated names such as "Student 12" are not stored at all, and order lists are only created for customers who order. Looking up a customer by id uses a sorted index. New customers are first kept in a small dictionary, which is merged into the index once it has grown by an eighth, so adding and looking up customers never rebuilds the whole index. The customers handed out are small proxy objects, which read and write their row of the table and otherwise behave like a Student or Staff.
+
+# %%
+import bisect
+
+class AccountTable:
+    TYPES = ["Student", "Staff"]
+    
+    def __init__(self, university):
+        self.university = university
+        self.ids = array('q')
+        self.balances = array('q')
+        self.types = array('b')
+        #rows of every type in the order they were added
+        self.rows = [array('q') for _ in self.TYPES]
+        #only names that differ from the generated "<type> <number>" are stored
+        self.names = {}
+        #row -> list of orders, only for customers who ordered
+        self.orders = {}
+        #ids and rows sorted by id and type
+        self.index_ids = array('q')
+        self.index_rows = array('q')
+        #id -> rows of the customers added since the last merge into the index
+        self.pending = {}
+        self.n_pending = 0
+        
+    def __len__(self):
+        return len(self.ids)
+        
+    def add(self, customer_type, name, customer_id):
+        """Adds a customer.
+
+        Args:
+            customer_type (String): "Student" or "Staff"
+            name (String): the name of the customer
+            customer_id (int): the id of the customer
+
+        Returns:
+            Account: the proxy of the new customer
+        """
+        code = self.TYPES.index(customer_type)
+        assert self.find_row(customer_id, code) == None, f"{customer_type} with id {customer_id} already exists"
+        row = len(self.ids)
+        if name != f"{customer_type} {len(self.rows[code]) + 1}":
+            self.names[row] = name
+        self.ids.append(customer_id)
+        self.balances.append(0)
+        self.types.append(code)
+        self.rows[code].append(row)
+        self.pending.setdefault(customer_id, []).append(row)
+        self.n_pending += 1
+        if self.n_pending > max(1024, len(self.index_rows) // 8):
+            self.merge_pending()
+        return self.proxy(row)
+    
+    def name(self, row):
+        if row in self.names:
+            return self.names[row]
+        code = self.types[row]
+        return f"{self.TYPES[code]} {bisect.bisect_left(self.rows[code], row) + 1}"
+    
+    def proxy(self, row):
+        return ACCOUNT_CLASSES[self.types[row]](self, row)
+    
+    def merge_pending(self):
+        """Merges the customers added since the last merge into the sorted index."""
+        indexed = list(zip(self.index_ids, map(self.types.__getitem__, self.index_rows), self.index_rows))
+        pending = [(self.ids[row], self.types[row], row) for rows in self.pending.values() for row in rows]
+        #the index is already sorted, so sorting only has to sort the new rows and merge the two runs
+        merged = sorted(indexed + pending)
+        self.index_ids = array('q', [entry[0] for entry in merged])
+        self.index_rows = array('q', [entry[2] for entry in merged])
+        self.pending = {}
+        self.n_pending = 0
+        
+    def indexed_row(self, customer_id, code=None):
+        """Returns the row of a customer in the index as it is, students first, or None."""
+        position = bisect.bisect_left(self.index_ids, customer_id)
+        while position < len(self.index_ids) and self.index_ids[position] == customer_id:
+            row = self.index_rows[position]
+            if code == None or self.types[row] == code:
+                return row
+            position += 1
+        return None
+    
+    def find_row(self, customer_id, code=None):
+        """Returns the row of a customer in the index or among the customers added since the last merge, students first, or None."""
+        rows = [row for row in self.pending.get(customer_id, ()) if code == None or self.types[row] == code]
+        indexed = self.indexed_row(customer_id, code)
+        if indexed != None:
+            rows.append(indexed)
+        return min(rows, key=lambda row: self.types[row]) if rows else None
+    
+    def get(self, customer_id):
+        """Returns the customer with an id, students first, or None."""
+        row = self.find_row(customer_id)
+        return None if row == None else self.proxy(row)
+    
+    def view(self, customer_type):
+        return AccountList(self, self.TYPES.index(customer_type))
+    
+
+class AccountList:
+    def __init__(self, table, code):
+        """A read-only list of the customers of one type in an AccountTable, used for University.students and University.staff."""
+        self.table = table
+        self.code = code
+        
+    def __len__(self):
+        return len(self.table.rows[self.code])
+    
+    def __iter__(self):
+        for row in self.table.rows[self.code]:
+            yield self.table.proxy(row)
+            
+    def __getitem__(self, position):
+        if isinstance(position, slice):
+            return [self.table.proxy(row) for row in self.table.rows[self.code][position]]
+        return self.table.proxy(self.table.rows[self.code][position])
+    
+    def __add__(self, other):
+        return list(self) + list(other)
+    
+    def __radd__(self, other):
+        return list(other) + list(self)
+    
+
+class Account:
+    #only the table and the row are stored, everything else is read from the table
+    __slots__ = ()
+    
+    def __init__(self, table, row):
+        self.table = table
+        self.row = row
+        
+    def __eq__(self, other):
+        return isinstance(other, Account) and other.table is self.table and other.row == self.row
+    
+    def __hash__(self):
+        return hash((id(self.table), self.row))
+        
+    @property
+    def customer_id(self):
+        return self.table.ids[self.row]
     
+    @property
+    def name(self):
+        return self.table.name(self.row)
+    
+    @property
+    def university(self):
+        return self.table.university
+    
+    @property
+    def balance_ore(self):
+        return self.table.balances[self.row]
+    
+    @balance_ore.setter
+    def balance_ore(self, amount):
+        self.table.balances[self.row] = amount
+        
+    @property
+    def orders(self):
+        if self.row not in self.table.orders:
+            self.table.orders[self.row] = []
+        return self.table.orders[self.row]
+    
+    @property
+    def order_list(self):
+        #None for customers who never ordered, like General_Customer.order_list
+        return self.table.orders.get(self.row)
+    
+
+class StudentAccount(Account, Student):
+    __slots__ = ("table", "row")
+
+class StaffAccount(Account, Staff):
+    __slots__ = ("table", "row")
+
+#proxy class for every type code of AccountTable
+ACCOUNT_CLASSES = [StudentAccount, StaffAccount]
+
 
 # %% [markdown]
 # #### Cafeteria
 # 
 # The cafeteria can add and edit the menu with multiple methods, both full uploads and individual additions and changes. They can process, complete and cancel orders and review the most popular items in order. Closing the cafeteria is also possible to reset the cafeteria at the end of a day. For popular items, we use merge sort
+# 
+# Every cafeteria has its own lock, so several tills can take orders at the same time without overselling the stock. The lock is always taken after the customer lock and never the other way around.
+# 
+# Optionally, a cafeteria only holds the stock of an order for a limited time. The deadlines are kept in a heap, so when new orders come in only the expired holds have to be looked at, and their stock goes back on the menu.
+# 
+# Browsing the menu never takes the cafeteria lock. After every change, the writer publishes a new read-only version of the menu. The versions keep the items in small chunks, so a new version only copies the chunks of the changed items and the tuple of chunks, and shares everything else with the previous version. Readers take the current version with a single attribute lookup and get a consistent menu even while orders are being taken.
 
 # %%
 
 import copy
+import heapq
+import math
+import threading
+import time
+from collections import deque
+from collections.abc import Mapping
+from types import MappingProxyType
+
+class ChunkedMenu(Mapping):
+    CHUNK = 32
+    
+    def __init__(self, chunks=(), index=None):
+        """A read-only menu whose items are kept in chunks of at most CHUNK items, in the order they were added.
+
+        Args:
+            chunks (tuple): read-only dictionaries of item names and details
+            index (dict, optional): item name -> position of its chunk
+        """
+        self.chunks = chunks
+        self.index = {} if index == None else index
+        
+    @classmethod
+    def build(cls, menu):
+        """Returns a new chunked menu with the items of a dictionary."""
+        items = list(menu.items())
+        chunks = tuple(MappingProxyType(dict(items[i:i + cls.CHUNK])) for i in range(0, len(items), cls.CHUNK))
+        return cls(chunks, {name: i // cls.CHUNK for i, (name, _) in enumerate(items)})
+        
+    def __getitem__(self, name):
+        return self.chunks[self.index[name]][name]
+    
+    def __contains__(self, name):
+        return name in self.index
+    
+    def __iter__(self):
+        for chunk in self.chunks:
+            yield from chunk
+            
+    def __len__(self):
+        return len(self.index)
+    
+    def updated(self, changes):
+        """Returns a new version of the menu. Only the chunks of the changed items and the tuple of chunks are copied; the index is only copied if items are added or removed.
+
+        Args:
+            changes (dict): item name -> new details, or None if the item was removed
+
+        Returns:
+            ChunkedMenu: the new version
+        """
+        chunks = list(self.chunks)
+        index = self.index
+        copied = {}
+        for name, details in changes.items():
+            if name not in index:
+                if details == None:
+                    continue
+                #new items go to the end, like in a dictionary
+                if index is self.index:
+                    index = dict(index)
+                last = len(chunks) - 1
+                if last < 0 or len(copied.get(last, chunks[last])) >= self.CHUNK:
+                    chunks.append(MappingProxyType({}))
+                    last += 1
+                index[name] = last
+            position = index[name]
+            if position not in copied:
+                copied[position] = dict(chunks[position])
+            if details == None:
+                if index is self.index:
+                    index = dict(index)
+                del index[name]
+                del copied[position][name]
+            else:
+                copied[position][name] = details
+        for position, chunk in copied.items():
+            chunks[position] = MappingProxyType(chunk)
+        menu = ChunkedMenu(tuple(chunks), index)
+        #chunks emptied by removed items are dropped once there are twice as many chunks as needed
+        if len(chunks) > 2 * (len(index) // self.CHUNK + 1):
+            return ChunkedMenu.build(menu)
+        return menu
+
+
+class MenuSnapshot:
+    def __init__(self, version, menu):
+        """A read-only version of the menu of a cafeteria.
+
+        Args:
+            version (int): the number of the version, counting up from 0
+            menu (ChunkedMenu): the items and their read-only details
+        """
+        self.version = version
+        self.menu = menu
 
 class Cafeteria:
     def __init__(self, name, university):
         self.name = name
         self.university = university
         self.menu = {}
-        self.orders = []
+        #open orders by id, so an order is found and taken off without going through all open orders
+        self.orders = {}
         self.item_popularity = {}
-        self.revenue=0
+        self.revenue_ore=0
+        #re-entrant, as closing the cafeteria cancels orders while holding the lock
+        self.lock = threading.RLock()
+        #heap of (deadline, order id, order) for orders that are only held for a limited time
+        self.holds = []
+        self.hold_seconds = None
+        #set by RestockEngine, KitchenScheduler and AdmissionControl
+        self.restock_engine = None
+        self.scheduler = None
+        self.admission = None
+        #times of the completions within the last completion_window seconds
+        self.completions = deque()
+        self.completion_window = 60
+        #the current read-only version of the menu, replaced as a whole on every change
+        self.snapshot = MenuSnapshot(0, ChunkedMenu())
+        
+    @property
+    def revenue(self):
+        return to_dkk(self.revenue_ore)
+    
+    def publish_menu(self, items):
+        """Publishes a new version of the menu. Only the changed items and their chunks are copied, all other chunks are shared with the previous version.
+
+        Args:
+            items (iterable): the names of the items that changed
+        """
+        with self.lock:
+            changed = set(items)
+            if len(changed) >= len(self.menu):
+                #after uploading or closing, the whole menu is new anyway
+                menu = ChunkedMenu.build({name: MappingProxyType(dict(details)) for name, details in self.menu.items()})
+            else:
+                menu = self.snapshot.menu.updated({name: MappingProxyType(dict(self.menu[name])) if name in self.menu else None for name in changed})
+            self.snapshot = MenuSnapshot(self.snapshot.version + 1, menu)
+    
+    def stock_changed(self, *items):
+        """Publishes a new version of the menu and passes the live stock of items on to the availability index of the university. It has to be called after every change of the menu.
+
+        Args:
+            items (string): the names of the items whose stock changed
+        """
+        self.publish_menu(items)
+        for item in items:
+            quantity = self.menu[item]['quantity'] if item in self.menu else 0
+            self.university.update_availability(self.name, item, quantity)
+            if self.restock_engine != None:
+                self.restock_engine.stock_changed(item)
         
     def add_item(self, item, description, price, quantity):
         """Adds an item to the menu of the cafeteria.
@@ -220,9 +733,11 @@ class Cafeteria:
         """
         assert price>0, "Price should be greater than 0"
         assert quantity>0, "Quantity should be greater than 0"
-        self.menu[item] = {'description': description, 'price': price, 'quantity': quantity, 'cafeteria': self.name}
-        # adding an item can be solved in-place, so no need to update the sorted menu
-        self.university.update_sorted_menu(item, quantity, self.name, description, price)
+        with self.lock:
+            self.menu[item] = {'description': description, 'price': price, 'quantity': quantity, 'cafeteria': self.name}
+            # adding an item can be solved in-place, so no need to update the sorted menu
+            self.university.update_sorted_menu(item, quantity, self.name, description, price)
+            self.stock_changed(item)
         return f"{item} added to the menu"
         
     
@@ -237,11 +752,15 @@ class Cafeteria:
         """
         assert type(new_menu)==dict, "Menu should be a dictionary"
         #deepcopy is used to avoid any changes in the original menu, especially when adding the attribute 'cafeteria'
-        self.menu = copy.deepcopy(new_menu)
-        for key in self.menu.keys():
-            self.menu[key]['cafeteria'] = self.name
+        menu = copy.deepcopy(new_menu)
+        for key in menu.keys():
+            menu[key]['cafeteria'] = self.name
+        with self.lock:
+            old_items = set(self.menu)
+            self.menu = menu
+            self.stock_changed(*(old_items | set(self.menu)))
         # uploading a menu can change the order of the items, so the sorted menu should be updated    
-        self.university.is_sorted = False
+        self.university.invalidate_sorted_menu()
         return "Menu uploaded successfully"
         
     def update_item(self, item_name, description, price, quantity, new_item_name=None):
@@ -258,24 +777,29 @@ class Cafeteria:
         """
         assert price > 0, "Price should be greater than 0"
         assert quantity > 0, "Quantity should be greater than 0"
-        if item_name in self.menu:
-            if new_item_name:
-                self.menu[new_item_name] = self.menu.pop(item_name)
-                message=f"{item_name} updated to {new_item_name} with description: {description}, price: {price}dkk and quantity: {quantity}"
-                item_name = new_item_name
-                # updating the name can is a large change, so the sorted menu has to be fully re-sorted
-                self.university.is_sorted = False
-                
+        with self.lock:
+            if item_name in self.menu:
+                old_item_name = item_name
+                if new_item_name:
+                    self.menu[new_item_name] = self.menu.pop(item_name)
+                    message=f"{item_name} updated to {new_item_name} with description: {description}, price: {price}dkk and quantity: {quantity}"
+                    item_name = new_item_name
+                    
+                else:
+                    #changing the description, price, and quantity can be solved in-place, so no need to update the sorted menu fully
+                    self.university.update_sorted_menu(item_name, quantity, self.name, description, price)
+                    message=f"{item_name} updated with description: {description}, price: {price}dkk and quantity: {quantity}"
+                self.menu[item_name]['description'] = description
+                self.menu[item_name]['price'] = price
+                self.menu[item_name]['quantity'] = quantity
+                self.stock_changed(item_name)
+                if new_item_name:
+                    self.stock_changed(old_item_name)
+                    # updating the name can is a large change, so the sorted menu has to be fully re-sorted
+                    self.university.invalidate_sorted_menu()
+                return message
             else:
-                #changing the description, price, and quantity can be solved in-place, so no need to update the sorted menu fully
-                self.university.update_sorted_menu(item_name, quantity, self.name, description, price)
-                message=f"{item_name} updated with description: {description}, price: {price}dkk and quantity: {quantity}"
-            self.menu[item_name]['description'] = description
-            self.menu[item_name]['price'] = price
-            self.menu[item_name]['quantity'] = quantity
-            return message
-        else:
-            raise ValueError(f"Sorry, {item_name} is not available in the menu")
+                raise ValueError(f"Sorry, {item_name} is not available in the menu")
         
     def restock_item(self, item, quantity):
         """Restocks an item in the menu.
@@ -288,12 +812,14 @@ class Cafeteria:
             str: A message indicating the success of the restocking
         """
         assert quantity>0, "Quantity should be greater than 0"
-        if item in self.menu:
-            self.menu[item]['quantity']+=quantity
-            self.university.update_sorted_menu(item, self.menu[item]['quantity'], self.name, self.menu[item]['description'], self.menu[item]['price'])
-            return f"{quantity} {item}(s) added to the stock. The new quantity is {self.menu[item]['quantity']}"
-        else:
-            raise ValueError(f"Sorry, {item} is not available in the menu")
+        with self.lock:
+            if item in self.menu:
+                self.menu[item]['quantity']+=quantity
+                self.university.update_sorted_menu(item, self.menu[item]['quantity'], self.name, self.menu[item]['description'], self.menu[item]['price'])
+                self.stock_changed(item)
+                return f"{quantity} {item}(s) added to the stock. The new quantity is {self.menu[item]['quantity']}"
+            else:
+                raise ValueError(f"Sorry, {item} is not available in the menu")
         
     def remove_item(self, item):
         """Removes an item from the menu.
@@ -304,14 +830,16 @@ class Cafeteria:
         Returns:
             str: A message indicating the success of the item removal
         """
-        if item in self.menu:
-            self.menu.pop(item)
-            self.university.remove_item_from_sorted_menu(item, self.name)
-            return f"{item} removed from the menu"
-        else:
-            raise ValueError(f"Sorry, {item} is not available in the menu")
+        with self.lock:
+            if item in self.menu:
+                self.menu.pop(item)
+                self.university.remove_item_from_sorted_menu(item, self.name)
+                self.stock_changed(item)
+                return f"{item} removed from the menu"
+            else:
+                raise ValueError(f"Sorry, {item} is not available in the menu")
     
-    def process_order(self, customer_id, customer_type, item, quantity, discount=0):
+    def process_order(self, customer_id, customer_type, item, quantity, discount=0, pickup_time=None):
         """Processes an order placed by a customer.
 
         Args:
@@ -320,14 +848,32 @@ class Cafeteria:
             item (string): the item to be ordered
             quantity (int): number of items to be ordered
             discount (int): the discount to be applied to the order
+            pickup_time (float, optional): the pickup time of a pre-order
 
         Returns:
             tuple: A tuple containing a potential message and the order object
         """
         assert quantity>0, "Quantity should be greater than 0"
-        assert discount>=0, "Discount should be greater than or equal to 0"
-        assert discount<=100, "Discount should be less than or equal to 100"
+        assert valid_discount(discount), "Discount should be a whole number between 0 and 100"
         assert self.university.get_customer(customer_id)!=None, f"Sorry, customer with id {customer_id} not found"
+        #the stock check and the reservation have to be one atomic step, otherwise two tills can sell the same item
+        with self.lock:
+            return self.reserve_order(customer_id, customer_type, item, quantity, discount, pickup_time)
+        
+    def reserve_order(self, customer_id, customer_type, item, quantity, discount=0, pickup_time=None):
+        """Reserves the stock for an order and creates it. The caller has to hold the cafeteria lock and has to have checked the customer.
+
+        Args:
+            customer_id (int): the id of the customer placing the order
+            customer_type (string): the type of the customer placing the order
+            item (string): the item to be ordered
+            quantity (int): number of items to be ordered
+            discount (int): the discount to be applied to the order
+            pickup_time (float, optional): the pickup time of a pre-order
+
+        Returns:
+            tuple: A tuple containing a potential message and the order object
+        """
         if item in self.menu:
             message= None
             if self.menu[item]['quantity'] < quantity and self.menu[item]['quantity'] > 0:
@@ -335,19 +881,129 @@ class Cafeteria:
                 message= f"Sorry, only {self.menu[item]['quantity']} {item}(s) available"
             elif self.menu[item]['quantity'] == 0:
                 raise ValueError(f"Sorry, {item} is out of stock")
+            if pickup_time != None:
+                if self.scheduler == None:
+                    raise ValueError(f"Sorry, {self.name} does not take pre-orders")
+                self.scheduler.check(pickup_time)
+            #admission comes last, so orders that fail a check above do not use up a token
+            if self.admission != None:
+                self.admission.admit(customer_type)
             order = Order(self, customer_id, customer_type, item, quantity, self.menu[item]['price'], discount)
             if item not in self.item_popularity:
                 self.item_popularity[item] = 0
             self.item_popularity[item] += quantity
             self.menu[item]['quantity']-=quantity
-            self.orders.append(order)
+            self.stock_changed(item)
+            self.orders[order.order_id] = order
+            self.hold(order)
+            if pickup_time != None:
+                self.scheduler.book(order, pickup_time)
+            self.university.history.record(order)
             return (message, order)
         else:
             raise ValueError(f"Sorry, {item} is not available in the menu")
         
+    def basket_price_ore(self, basket, discount=0):
+        """Prices a basket in one pass.
+
+        Args:
+            basket (dict): a dictionary with item names as keys and quantities as values
+            discount (int): the discount to be applied to the basket
+
+        Returns:
+            int: The price of the basket after the discount in øre
+        """
+        total = 0
+        for item, quantity in basket.items():
+            if item not in self.menu:
+                raise ValueError(f"Sorry, {item} is not available in the menu")
+            total += to_ore(self.menu[item]['price'])*quantity
+        return discounted_ore(total, 1, discount)
+        
+    def process_basket(self, customer_id, customer_type, basket, discount=0, pickup_time=None):
+        """Processes a basket of several items as one order. Either all items are reserved or none.
+
+        Args:
+            customer_id (int): the id of the customer placing the order
+            customer_type (string): the type of the customer placing the order
+            basket (dict): a dictionary with item names as keys and quantities as values
+            discount (int): the discount to be applied to the order
+            pickup_time (float, optional): the pickup time of a pre-order
+
+        Returns:
+            tuple: A tuple containing a potential message and the basket order object
+        """
+        assert len(basket)>0, "Basket should not be empty"
+        assert valid_discount(discount), "Discount should be a whole number between 0 and 100"
+        assert self.university.get_customer(customer_id)!=None, f"Sorry, customer with id {customer_id} not found"
+        with self.lock:
+            #first check every line, so nothing has to be rolled back
+            lines = []
+            for item, quantity in basket.items():
+                assert quantity>0, "Quantity should be greater than 0"
+                if item not in self.menu:
+                    raise ValueError(f"Sorry, {item} is not available in the menu")
+                if self.menu[item]['quantity'] < quantity:
+                    raise ValueError(f"Sorry, only {self.menu[item]['quantity']} {item}(s) available")
+                lines.append((item, quantity, self.menu[item]['price']))
+            if pickup_time != None:
+                if self.scheduler == None:
+                    raise ValueError(f"Sorry, {self.name} does not take pre-orders")
+                self.scheduler.check(pickup_time)
+            if self.admission != None:
+                self.admission.admit(customer_type)
+            #then reserve all of them
+            for item, quantity, _ in lines:
+                self.menu[item]['quantity']-=quantity
+                self.item_popularity[item] = self.item_popularity.get(item, 0) + quantity
+            self.stock_changed(*basket)
+            order = BasketOrder(self, customer_id, customer_type, lines, discount)
+            self.orders[order.order_id] = order
+            self.hold(order)
+            if pickup_time != None:
+                self.scheduler.book(order, pickup_time)
+            self.university.history.record(order)
+            return (None, order)
+        
     def view_orders(self):
         """Lets the cafeteria view all the orders placed by customers and not picked up yet."""
-        return self.orders
+        return list(self.orders.values())
+    
+    def iter_orders(self, status=None, customer_id=None, where=None):
+        """Yields the open orders one at a time, optionally only those with a status, of a customer or for which where(order) is true. Only the references are copied under the lock."""
+        with self.lock:
+            orders = tuple(self.orders.values())
+        for order in orders:
+            if (status == None or order.status == status) and (customer_id == None or order.customer_id == customer_id) and (where == None or where(order)):
+                yield order
+    
+    def record_completion(self, now=None):
+        now = time.time() if now == None else now
+        self.completions.append(now)
+        while self.completions[0] < now - self.completion_window:
+            self.completions.popleft()
+    
+    def completion_rate(self, now=None):
+        """Returns the completed orders per second over the last completion_window seconds."""
+        now = time.time() if now == None else now
+        #routing calls this without holding the cafeteria lock, so the trimming takes it
+        with self.lock:
+            while len(self.completions) > 0 and self.completions[0] < now - self.completion_window:
+                self.completions.popleft()
+            return len(self.completions) / self.completion_window
+    
+    def queue_metrics(self, now=None):
+        """Returns how busy the cafeteria is, so callers can send customers elsewhere.
+
+        Returns:
+            dict: A dictionary with the open orders, the completions per second, the estimated wait in seconds for a new order and, with admission control, the admitted and rejected orders
+        """
+        metrics = {"open_orders": len(self.orders), "completion_rate": self.completion_rate(now)}
+        if self.admission != None:
+            metrics.update(self.admission.metrics(now))
+        elif metrics["completion_rate"] > 0:
+            metrics["estimated_wait"] = metrics["open_orders"] / metrics["completion_rate"]
+        return metrics
             
     
     def complete_order(self, order_id):
@@ -356,13 +1012,22 @@ class Cafeteria:
         Args:
             order (int): the order object to be completed
         """
-        for order in self.orders:
-            if order.order_id == order_id:
-                self.orders.remove(order)
-                self.university.update_sorted_menu(order.item, order.quantity, self.name)
-                self.revenue+=order.price
-                return order.complete()
-        raise ValueError(f"Order {order_id} not found")
+        with self.lock:
+            order = self.orders.pop(order_id, None)
+            if order == None:
+                raise ValueError(f"Order {order_id} not found")
+            self.university.release_visitor(order.customer_id)
+            #a completed pre-order no longer takes up a place in its slot
+            if order.pickup_time != None:
+                self.scheduler.release(order)
+            self.record_completion()
+            #completing does not change the stock, but the sorted menu is brought up to the live stock of the items
+            for item, _, _ in order.line_items():
+                if item in self.menu:
+                    self.university.update_sorted_menu(item, self.menu[item]['quantity'], self.name)
+            self.revenue_ore+=order.price_ore
+            self.university.ledger.record("revenue", order.price_ore, order.customer_id, order.customer_type, self.name)
+            return order.complete()
         
     
     def cancel_order(self, order_id):
@@ -371,31 +1036,119 @@ class Cafeteria:
         Args:
             order (int): the order object to be cancelled
         """
-        for order in self.orders:
-            if order.order_id == order_id:
-                self.orders.remove(order)
-                if order.item in self.menu:
-                    self.menu[order.item]['quantity']+=order.quantity
-                else:
-                    self.menu[order.item] = {'description': None, 'price': order.price/(order.quantity*(1-(order.discount/100))), 'quantity': order.quantity, 'cafeteria': self.name}
-                return order.cancel()
-        raise ValueError(f"Order {order_id} not found")
+        with self.lock:
+            order = self.orders.get(order_id)
+            if order == None:
+                raise ValueError(f"Order {order_id} not found")
+            self.withdraw_order(order)
+        #the refund takes the customer lock, so it has to happen after the cafeteria lock is released
+        return order.cancel()
     
-    def close_cafeteria(self):
+    def withdraw_order(self, order):
+        """Takes an open order off the list and puts its stock back on the menu. The caller has to hold the cafeteria lock and cancel the order afterwards.
+
+        Args:
+            order (Order): the open order
+        """
+        del self.orders[order.order_id]
+        self.university.release_visitor(order.customer_id)
+        if order.pickup_time != None:
+            self.scheduler.release(order)
+        for item, quantity, unit_price in order.line_items():
+            if item in self.menu:
+                self.menu[item]['quantity']+=quantity
+            else:
+                self.menu[item] = {'description': None, 'price': unit_price, 'quantity': quantity, 'cafeteria': self.name}
+            self.stock_changed(item)
+            
+    def set_hold_time(self, seconds):
+        """Sets for how long the stock of a new order is held before the order is cancelled if it is still not completed.
+
+        Args:
+            seconds (float): the hold time in seconds, or None to hold the stock until the cafeteria closes
+        """
+        assert seconds == None or seconds > 0, "Hold time should be greater than 0"
+        self.hold_seconds = seconds
+        
+    def hold(self, order):
+        """Puts a new order on the expiry heap if the cafeteria has a hold time. The caller has to hold the cafeteria lock."""
+        if self.hold_seconds != None:
+            order.hold_until = order.created_at + self.hold_seconds
+            heapq.heappush(self.holds, (order.hold_until, order.order_id, order))
+    
+    def release_expired_holds(self, now=None):
+        """Cancels the open orders whose hold has expired and puts their stock back. Only the expired holds are looked at.
+
+        Args:
+            now (float, optional): the current time, defaults to time.time()
+
+        Returns:
+            list: A list of the cancelled orders
+        """
+        now = time.time() if now == None else now
+        expired = []
+        with self.lock:
+            while len(self.holds) > 0 and self.holds[0][0] <= now:
+                order = heapq.heappop(self.holds)[2]
+                #orders that were completed or cancelled in the meantime are no longer open and are simply skipped; the status of a cancelled order is only set after the lock is released
+                if self.orders.get(order.order_id) is order:
+                    self.withdraw_order(order)
+                    expired.append(order)
+        #refunds after the cafeteria lock is released, as in cancel_order
+        for order in expired:
+            order.cancel()
+        return expired
+    
+    def close_cafeteria(self, refunds=None):
         """Closes the cafeteria for the day and returns the revenue generated. The open orders are cancelled and the menu and popularity is cleared.
         
+        All open orders are drained in one pass and the refunds are added up per customer, so every customer is refunded once.
+
+        Args:
+            refunds (dict, optional): if given, the refunds are added to this dictionary of customer ids and amounts in øre instead of being paid out, so the university can pay out the refunds of all cafeterias together
+        
         Returns:
             int: The revenue generated by the cafeteria
         """
-        return_value=self.revenue
-        for order in self.orders:
-            self.cancel_order(order.order_id)
-        self.item_popularity = {}
-        self.menu = {}
-        self.university.is_sorted = False
-        self.revenue = 0
+        pay_out = refunds == None
+        if pay_out:
+            refunds = {}
+        with self.lock:
+            return_value=self.revenue
+            #the menu is cleared anyway, so the stock of the cancelled orders does not have to be put back
+            for order in self.orders.values():
+                order.cancel(refund=False)
+                self.university.release_visitor(order.customer_id)
+                refunds[order.customer_id] = refunds.get(order.customer_id, 0) + order.price_ore
+            self.orders = {}
+            self.holds = []
+            if self.scheduler != None:
+                self.scheduler.clear()
+            self.item_popularity = {}
+            self.completions.clear()
+            closed_items = list(self.menu)
+            self.menu = {}
+            self.stock_changed(*closed_items)
+            self.revenue_ore = 0
+        self.university.invalidate_sorted_menu()
+        #the refunds take the customer locks, so they are paid out after the cafeteria lock is released
+        if pay_out:
+            self.university.refund(refunds, self.name)
         return return_value
     
+    def complete_next_batch(self):
+        """Completes the pre-orders of the earliest pickup slot, which the kitchen prepares together.
+
+        Returns:
+            tuple: A tuple containing the start of the slot, a dictionary with the items and total quantities to be prepared, and the completion messages
+        """
+        assert self.scheduler != None, f"{self.name} does not take pre-orders"
+        #taking the batch off the queue and completing it is one step, so no order of the batch can be cancelled in between
+        with self.lock:
+            slot_start, items, orders = self.scheduler.next_batch()
+            messages = [self.complete_order(order.order_id) for order in orders]
+        return slot_start, items, messages
+    
     def popular_items(self, n):
         """Returns the n most popular items in the cafeteria.
 
@@ -443,52 +1196,845 @@ class Cafeteria:
         return sorted_items[:n]
 
 # %% [markdown]
-# #### Order
+# #### Restocking
 # 
-# Order simply manages the orders themselves.
+# A restock engine decides on its own when a cafeteria should restock an item. It reacts to the stock changes of the cafeteria: a change only marks the item and is counted, which costs next to nothing per order, and the marked items are checked and restocked together after a number of changes or when the engine is flushed. What and how much to restock comes from pluggable policies, and the result is capped at the shelf capacity.
 
 # %%
+from abc import ABC, abstractmethod
 
-class Order:
-    class_counter=1
-    def __init__(self, cafeteria, customer_id, customer_type, item, quantity, price, discount=0):
-        self.order_id = Order.class_counter
+class RestockPolicy(ABC):
+    @abstractmethod
+    def restock_quantity(self, cafeteria, item, quantity):
+        """Returns how many items should be added to the stock.
+
+        Args:
+            cafeteria (Cafeteria): the cafeteria of the item
+            item (string): the name of the item
+            quantity (int): the current stock
+
+        Returns:
+            int: the quantity to be added, 0 if no restocking is needed
+        """
+
+
+class ReorderPointPolicy(RestockPolicy):
+    def __init__(self, reorder_point, order_up_to):
+        assert order_up_to > reorder_point >= 0, "Order-up-to level should be greater than the reorder point"
+        self.reorder_point = reorder_point
+        self.order_up_to = order_up_to
+        
+    def restock_quantity(self, cafeteria, item, quantity):
+        return self.order_up_to - quantity if quantity <= self.reorder_point else 0
+
+
+class DemandRatePolicy(RestockPolicy):
+    """Expects the demand for the rest of the day to be a share of what was sold so far according to item_popularity and keeps that much in stock."""
+    def __init__(self, cover=0.5, minimum=5):
+        assert cover > 0, "Cover should be greater than 0"
+        self.cover = cover
+        self.minimum = minimum
+        
+    def restock_quantity(self, cafeteria, item, quantity):
+        expected_demand = max(self.minimum, math.ceil(cafeteria.item_popularity.get(item, 0) * self.cover))
+        return expected_demand - quantity if quantity < expected_demand else 0
+
+
+class RestockEngine:
+    def __init__(self, cafeteria, policies, capacity=None, batch_size=10):
+        """Attaches a restock engine to a cafeteria.
+
+        Args:
+            cafeteria (Cafeteria): the cafeteria to be restocked
+            policies (list): the restock policies, the largest suggested quantity is used
+            capacity (int or dict, optional): the maximum shelf capacity, either for all items or per item name
+            batch_size (int): number of stock changes after which the engine restocks on its own
+        """
+        assert len(policies) > 0, "At least one policy is needed"
+        assert batch_size > 0, "Batch size should be greater than 0"
         self.cafeteria = cafeteria
-        self.customer_id = customer_id
-        self.customer_type = customer_type
-        self.item = item
-        self.quantity = quantity
-        self.price = price*quantity*(1-(discount/100))
-        self.discount = discount
-        #for simplicity, we assume all orders are accepted as the check is done before creating the order
-        self.status = "Accepted"
-        Order.class_counter+=1
+        self.policies = policies
+        self.capacity = capacity
+        self.batch_size = batch_size
+        self.changed = set()
+        #stock changes since the last flush, so a few items that sell often are checked as well
+        self.change_count = 0
+        self.flushing = False
+        cafeteria.restock_engine = self
         
-    def __str__(self):
-        return f"({self.status}) Order {self.order_id} by {self.customer_type} {self.customer_id} for {self.quantity} {self.item}(s) for {self.price}dkk"	
-    
-    def __repr__(self):
-        return self.__str__()
+    def stock_changed(self, item):
+        """Marks an item whose stock changed and restocks the marked items after batch_size changes."""
+        if self.flushing:
+            return
+        self.changed.add(item)
+        self.change_count += 1
+        if self.change_count >= self.batch_size:
+            self.flush()
+            
+    def shelf_capacity(self, item):
+        if isinstance(self.capacity, dict):
+            return self.capacity.get(item)
+        return self.capacity
+            
+    def flush(self):
+        """Checks all marked items and restocks those the policies ask for.
+
+        Returns:
+            list: A list of tuples containing the item and the quantity added
+        """
+        restocked = []
+        with self.cafeteria.lock:
+            changed, self.changed = self.changed, set()
+            self.change_count = 0
+            self.flushing = True
+            try:
+                for item in changed:
+                    if item not in self.cafeteria.menu:
+                        continue
+                    quantity = self.cafeteria.menu[item]['quantity']
+                    amount = max(policy.restock_quantity(self.cafeteria, item, quantity) for policy in self.policies)
+                    capacity = self.shelf_capacity(item)
+                    if capacity != None:
+                        amount = min(amount, capacity - quantity)
+                    if amount > 0:
+                        self.cafeteria.restock_item(item, amount)
+                        restocked.append((item, amount))
+            finally:
+                self.flushing = False
+        return restocked
+
+
+# %% [markdown]
+# #### Kitchen Scheduler
+# 
+# At peak times, customers can pre-order for a pickup slot. Every slot can only take a limited number of orders. The scheduler keeps the pre-orders in a priority queue by pickup time, so the kitchen always prepares the earliest slot next, and identical items of a slot are added up so they can be prepared in one step.
+
+# %%
+class KitchenScheduler:
+    def __init__(self, cafeteria, slot_minutes=15, capacity=20):
+        """Attaches a kitchen scheduler to a cafeteria.
+
+        Args:
+            cafeteria (Cafeteria): the cafeteria taking pre-orders
+            slot_minutes (int): the length of a pickup slot in minutes
+            capacity (int): the maximum number of open orders per slot
+        """
+        assert slot_minutes > 0, "Slot length should be greater than 0"
+        assert capacity > 0, "Capacity should be greater than 0"
+        self.slot_seconds = slot_minutes * 60
+        self.capacity = capacity
+        #slot number -> number of open orders booked for it
+        self.load = {}
+        #heap of (pickup time, order id, order)
+        self.queue = []
+        cafeteria.scheduler = self
+        
+    def slot(self, pickup_time):
+        return int(pickup_time // self.slot_seconds)
+    
+    def slot_load(self, pickup_time):
+        """Returns the number of orders booked for the slot of a pickup time."""
+        return self.load.get(self.slot(pickup_time), 0)
+    
+    def check(self, pickup_time):
+        """Raises a ValueError if the slot of a pickup time is full."""
+        if self.slot_load(pickup_time) >= self.capacity:
+            slot_start = time.strftime("%H:%M", time.localtime(self.slot(pickup_time) * self.slot_seconds))
+            raise ValueError(f"Sorry, the pickup slot at {slot_start} is fully booked")
+        
+    def book(self, order, pickup_time):
+        """Books an order for a pickup time. The caller has to hold the cafeteria lock and has to have checked the slot."""
+        order.pickup_time = pickup_time
+        slot = self.slot(pickup_time)
+        self.load[slot] = self.load.get(slot, 0) + 1
+        heapq.heappush(self.queue, (pickup_time, order.order_id, order))
+        
+    def release(self, order):
+        """Frees the place of a cancelled or completed order in its slot. The order itself is dropped from the queue when it is reached."""
+        slot = self.slot(order.pickup_time)
+        self.load[slot] -= 1
+        if self.load[slot] == 0:
+            del self.load[slot]
+            
+    def clear(self):
+        self.load = {}
+        self.queue = []
+            
+    def next_pickup_time(self):
+        """Returns the pickup time of the next open pre-order, or None if there is none."""
+        while len(self.queue) > 0 and self.queue[0][2].status != "Accepted":
+            heapq.heappop(self.queue)
+        return self.queue[0][0] if len(self.queue) > 0 else None
+    
+    def next_batch(self):
+        """Takes the open pre-orders of the earliest slot off the queue and adds up identical items.
+
+        Returns:
+            tuple: A tuple containing the start time of the slot, a dictionary with the items and total quantities, and the orders
+        """
+        first = self.next_pickup_time()
+        if first == None:
+            return None, {}, []
+        slot = self.slot(first)
+        items = {}
+        orders = []
+        while len(self.queue) > 0 and self.slot(self.queue[0][0]) == slot:
+            order = heapq.heappop(self.queue)[2]
+            if order.status != "Accepted":
+                continue
+            orders.append(order)
+            for item, quantity, _ in order.line_items():
+                items[item] = items.get(item, 0) + quantity
+        return slot * self.slot_seconds, items, orders
+
+
+# %% [markdown]
+# #### Admission Control
+# 
+# During a rush, a cafeteria with admission control turns orders away instead of letting its queue grow without bound. An order is rejected if the cafeteria already has the maximum number of open orders, if the estimated wait is too long, or if customers of the same type have used up their token bucket. The estimated wait is the number of open orders divided by the recent completion rate. Admission is checked after the menu, stock and pickup slot checks, so only orders that would otherwise be accepted use up tokens, and a rejection still happens before any stock is touched. It comes with a hint after how many seconds it is worth trying again. The queue metrics of every cafeteria can be used to send customers to a cafeteria that is less busy.
+
+# %%
+class OrderRejected(ValueError):
+    def __init__(self, message, retry_after):
+        """Raised when a cafeteria is too busy to take an order.
+
+        Args:
+            message (String): the message for the customer
+            retry_after (float): the seconds after which the order is likely to be accepted
+        """
+        super().__init__(message)
+        self.retry_after = retry_after
+        
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        """A bucket that refills with rate tokens per second up to burst tokens. Every order takes one token.
+
+        Args:
+            rate (float): tokens added per second
+            burst (int): the most tokens the bucket can hold
+        """
+        assert rate > 0 and burst >= 1, "Rate should be greater than 0 and burst at least 1"
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = None
+        
+    def take(self, now):
+        """Takes a token if there is one.
+
+        Returns:
+            float: 0 if a token was taken, otherwise the seconds until the next token
+        """
+        if self.updated != None:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+    
+
+class AdmissionControl:
+    def __init__(self, cafeteria, max_open_orders=None, max_wait=None, rates=None, seconds_per_order=60):
+        """Attaches admission control to a cafeteria.
+
+        Args:
+            cafeteria (Cafeteria): the cafeteria
+            max_open_orders (int, optional): the most orders that can be open at the same time
+            max_wait (float, optional): the longest estimated wait in seconds that is still accepted
+            rates (dict, optional): customer type -> (orders per second, burst) for a token bucket per customer type
+            seconds_per_order (float): the time an order is assumed to take while nothing was completed recently
+        """
+        assert max_open_orders == None or max_open_orders > 0, "Maximum open orders should be greater than 0"
+        assert max_wait == None or max_wait > 0, "Maximum wait should be greater than 0"
+        self.cafeteria = cafeteria
+        self.max_open_orders = max_open_orders
+        self.max_wait = max_wait
+        self.seconds_per_order = seconds_per_order
+        self.buckets = {customer_type: TokenBucket(rate, burst) for customer_type, (rate, burst) in (rates or {}).items()}
+        self.admitted = 0
+        #reason -> number of rejected orders
+        self.rejected = {}
+        cafeteria.admission = self
+        
+    def order_seconds(self, now=None):
+        """Returns the estimated seconds per order from the recent completion rate."""
+        rate = self.cafeteria.completion_rate(now)
+        return 1 / rate if rate > 0 else self.seconds_per_order
+        
+    def estimated_wait(self, now=None):
+        return len(self.cafeteria.orders) * self.order_seconds(now)
+    
+    def reject(self, reason, retry_after):
+        self.rejected[reason] = self.rejected.get(reason, 0) + 1
+        raise OrderRejected(f"Sorry, {self.cafeteria.name} is too busy right now. Please try again in {math.ceil(retry_after)} seconds", retry_after)
+        
+    def admit(self, customer_type, now=None):
+        """Admits an order or raises OrderRejected. The caller has to hold the cafeteria lock.
+
+        Args:
+            customer_type (String): the type of the customer placing the order
+            now (float, optional): the current time, defaults to time.time()
+        """
+        now = time.time() if now == None else now
+        open_orders = len(self.cafeteria.orders)
+        order_seconds = self.order_seconds(now)
+        if self.max_open_orders != None and open_orders >= self.max_open_orders:
+            self.reject("open_orders", (open_orders - self.max_open_orders + 1) * order_seconds)
+        if self.max_wait != None and open_orders * order_seconds > self.max_wait:
+            self.reject("wait", open_orders * order_seconds - self.max_wait)
+        bucket = self.buckets.get(customer_type)
+        if bucket != None:
+            retry_after = bucket.take(now)
+            if retry_after > 0:
+                self.reject("rate", retry_after)
+        self.admitted += 1
+        
+    def metrics(self, now=None):
+        return {"estimated_wait": self.estimated_wait(now), "admitted": self.admitted, "rejected": dict(self.rejected)}
+
+
+# %% [markdown]
+# #### Order
+# 
+# Order simply manages the orders themselves. The order ids are handed out under a lock, so no two tills can get the same id.
+
+# %%
+
+class Order:
+    class_counter=1
+    #with several shards, every shard hands out every n-th id, see configure_ids
+    id_step=1
+    counter_lock=threading.Lock()
+    def __init__(self, cafeteria, customer_id, customer_type, item, quantity, price, discount=0):
+        with Order.counter_lock:
+            self.order_id = Order.class_counter
+            Order.class_counter+=Order.id_step
+        self.cafeteria = cafeteria
+        self.customer_id = customer_id
+        self.customer_type = customer_type
+        self.item = item
+        self.quantity = quantity
+        self.unit_price = price
+        self.price_ore = discounted_ore(to_ore(price), quantity, discount)
+        self.discount = discount
+        #for simplicity, we assume all orders are accepted as the check is done before creating the order
+        self.status = "Accepted"
+        self.created_at = time.time()
+        self.updated_at = self.created_at
+        #only set if the cafeteria holds the stock for a limited time or the order is a pre-order
+        self.hold_until = None
+        self.pickup_time = None
+        
+    def __str__(self):
+        return f"({self.status}) Order {self.order_id} by {self.customer_type} {self.customer_id} for {self.description()} for {self.price}dkk"	
+    
+    def __repr__(self):
+        return self.__str__()
+    
+    @property
+    def price(self):
+        return to_dkk(self.price_ore)
     
     def total_price(self):
         return self.price
     
+    def line_items(self):
+        """Returns the items of the order as a list of tuples (item, quantity, unit price)."""
+        return [(self.item, self.quantity, self.unit_price)]
+    
+    def description(self):
+        """Returns the items of the order as text, e.g. "2 Coffee(s), 1 Croissant(s)"."""
+        return ", ".join(f"{quantity} {item}(s)" for item, quantity, _ in self.line_items())
+    
+    @staticmethod
+    def configure_ids(shard, n_shards):
+        """Partitions the order ids between shards, so shard i only hands out ids i+1, i+1+n_shards, and so on.
+
+        Args:
+            shard (int): the number of this shard, starting at 0
+            n_shards (int): the total number of shards
+        """
+        assert 0 <= shard < n_shards, "Shard should be between 0 and the number of shards"
+        with Order.counter_lock:
+            Order.class_counter = shard + 1
+            Order.id_step = n_shards
+    
+    def set_status(self, status):
+        """Changes the status of the order and records the change in the order history."""
+        self.status = status
+        self.updated_at = time.time()
+        self.cafeteria.university.history.record(self)
+    
     def complete(self):
-        self.status = "Completed"
+        self.set_status("Completed")
         return f"Order {self.order_id} completed"
     
-    def cancel(self):
-        self.status = "Cancelled"
-        #Refund
-        for customer in self.cafeteria.university.all_customers():
-            if customer.customer_id == self.customer_id:
-                customer.balance+=self.price
+    def cancel(self, refund=True):
+        self.set_status("Cancelled")
+        #Refund, unless the caller refunds several orders at once
+        if refund:
+            university = self.cafeteria.university
+            customer = university.get_customer(self.customer_id)
+            if customer != None:
+                with university.customer_lock(customer.customer_id):
+                    customer.balance_ore+=self.price_ore
+                university.customer_ledger(customer.customer_id).record("refund", self.price_ore, customer.customer_id, customer.customer_type, self.cafeteria.name)
         return f"Order {self.order_id} cancelled"
         
         
     def pick_up(self):
-        self.status = "Picked Up"
+        self.set_status("Picked Up")
         return f"Order {self.order_id} picked up"
+    
+
+class BasketOrder(Order):
+    def __init__(self, cafeteria, customer_id, customer_type, lines, discount=0):
+        #a basket has no single item, its items are only available through line_items
+        super().__init__(cafeteria, customer_id, customer_type, None, sum(line[1] for line in lines), 0, discount)
+        self.lines = lines
+        self.unit_price = None
+        self.price_ore = discounted_ore(sum(to_ore(unit_price)*quantity for _, quantity, unit_price in lines), 1, discount)
+    
+    def line_items(self):
+        return list(self.lines)
+        
+    
+
+# %% [markdown]
+# #### Ledger
+# 
+# The ledger records every top-up, debit, refund and revenue entry and never changes an entry afterwards. The entries are stored column by column in compact arrays. Running totals per kind, cafeteria, customer type and hour are updated with every entry, so reports do not have to go through all entries again, and every customer has a list of their entry positions for statements.
+
+# %%
+class Ledger:
+    KINDS = ["top_up", "debit", "refund", "revenue"]
+    
+    def __init__(self):
+        self.kinds = array('b')
+        self.amounts = array('q')
+        self.customers = array('q')
+        self.cafeterias = array('h')
+        self.customer_types = array('b')
+        self.timestamps = array('d')
+        #names are stored once and the entries only keep their position
+        self.cafeteria_names = []
+        self.cafeteria_codes = {}
+        self.customer_type_names = []
+        self.customer_type_codes = {}
+        self.totals = {}
+        self.customer_entries = {}
+        self.lock = threading.Lock()
+        
+    def __len__(self):
+        return len(self.amounts)
+    
+    def code(self, name, names, codes):
+        if name == None:
+            return -1
+        if name not in codes:
+            codes[name] = len(names)
+            names.append(name)
+        return codes[name]
+        
+    def record(self, kind, amount_ore, customer_id=None, customer_type=None, cafeteria_name=None, timestamp=None):
+        """Appends an entry and updates the running totals.
+
+        Args:
+            kind (String): one of "top_up", "debit", "refund" and "revenue"
+            amount_ore (int): the amount in øre
+            customer_id (int, optional): the customer the entry belongs to
+            customer_type (String, optional): the type of the customer
+            cafeteria_name (String, optional): the cafeteria the entry belongs to
+            timestamp (float, optional): the time of the entry, defaults to now
+        """
+        assert kind in self.KINDS, f"Kind should be one of {self.KINDS}"
+        timestamp = time.time() if timestamp == None else timestamp
+        hour = int(timestamp // 3600)
+        with self.lock:
+            position = len(self.amounts)
+            self.kinds.append(self.KINDS.index(kind))
+            self.amounts.append(amount_ore)
+            self.customers.append(-1 if customer_id == None else customer_id)
+            self.cafeterias.append(self.code(cafeteria_name, self.cafeteria_names, self.cafeteria_codes))
+            self.customer_types.append(self.code(customer_type, self.customer_type_names, self.customer_type_codes))
+            self.timestamps.append(timestamp)
+            for key in [(kind,), (kind, "cafeteria", cafeteria_name), (kind, "customer_type", customer_type), (kind, "hour", hour)]:
+                self.totals[key] = self.totals.get(key, 0) + amount_ore
+            if customer_id != None:
+                self.customer_entries.setdefault(customer_id, []).append(position)
+                
+    def total(self, kind, cafeteria_name=None, customer_type=None, hour=None):
+        """Returns the running total of a kind of entry, optionally for one cafeteria, customer type or hour. Only one of them can be given.
+
+        Args:
+            kind (String): one of "top_up", "debit", "refund" and "revenue"
+            cafeteria_name (String, optional): the cafeteria
+            customer_type (String, optional): the customer type
+            hour (int, optional): the hour since the epoch, i.e. timestamp // 3600
+
+        Returns:
+            int: The total in øre
+        """
+        if cafeteria_name != None:
+            key = (kind, "cafeteria", cafeteria_name)
+        elif customer_type != None:
+            key = (kind, "customer_type", customer_type)
+        elif hour != None:
+            key = (kind, "hour", hour)
+        else:
+            key = (kind,)
+        return self.totals.get(key, 0)
+    
+    def revenue_by_hour(self):
+        """Returns the revenue in øre per hour since the epoch."""
+        return {key[2]: total for key, total in self.totals.items() if key[0] == "revenue" and key[1:2] == ("hour",)}
+    
+    def statement(self, customer_id):
+        """Returns all entries of a customer in the order they were recorded.
+
+        Args:
+            customer_id (int): the id of the customer
+
+        Returns:
+            list: A list of dictionaries with the kind, amount in dkk, cafeteria and time of every entry
+        """
+        statement = []
+        for position in self.customer_entries.get(customer_id, []):
+            cafeteria = self.cafeterias[position]
+            statement.append({"kind": self.KINDS[self.kinds[position]], "amount": to_dkk(self.amounts[position]),
+                              "cafeteria": self.cafeteria_names[cafeteria] if cafeteria >= 0 else None, "timestamp": self.timestamps[position]})
+        return statement
+        
+    
+
+# %% [markdown]
+# #### Order History
+# 
+# Orders leave the cafeteria when they are completed and the customer when they are picked up, so the history keeps every status change of every order with its time. Like the ledger, the events are stored in columns of compact arrays, one row per item of the order. There are indexes by customer, cafeteria and item. As the events are appended in time order, a time range is found with a binary search, and a query only looks at the rows of its smallest index. The columns can be saved to and loaded from a directory with one binary file per column.
+
+# %%
+import bisect
+import json
+import os
+
+class OrderHistory:
+    EVENTS = ["Accepted", "Completed", "Cancelled", "Picked Up"]
+    #column name and array type code
+    COLUMNS = [("order_ids", 'q'), ("events", 'b'), ("customers", 'q'), ("cafeterias", 'h'), ("items", 'l'),
+               ("quantities", 'l'), ("prices", 'q'), ("timestamps", 'd')]
+    
+    def __init__(self):
+        for column, type_code in self.COLUMNS:
+            setattr(self, column, array(type_code))
+        self.cafeteria_names = []
+        self.item_names = []
+        self.rebuild_indexes()
+        self.lock = threading.Lock()
+        
+    def __len__(self):
+        return len(self.order_ids)
+        
+    def rebuild_indexes(self):
+        self.cafeteria_codes = {name: code for code, name in enumerate(self.cafeteria_names)}
+        self.item_codes = {name: code for code, name in enumerate(self.item_names)}
+        self.by_customer = {}
+        self.by_cafeteria = {}
+        self.by_item = {}
+        for position in range(len(self.order_ids)):
+            self.index(position)
+            
+    def index(self, position):
+        self.by_customer.setdefault(self.customers[position], array('l')).append(position)
+        self.by_cafeteria.setdefault(self.cafeterias[position], array('l')).append(position)
+        self.by_item.setdefault(self.items[position], array('l')).append(position)
+        
+    def code(self, name, names, codes):
+        if name not in codes:
+            codes[name] = len(names)
+            names.append(name)
+        return codes[name]
+    
+    def record(self, order):
+        """Records the current status of an order, one row per item of the order.
+
+        Args:
+            order (Order): the order whose status changed
+        """
+        lines = order.line_items()
+        with self.lock:
+            #the time never goes backwards, so time ranges can be found with a binary search
+            timestamp = max(order.updated_at, self.timestamps[-1]) if len(self.timestamps) > 0 else order.updated_at
+            for item, quantity, unit_price in lines:
+                position = len(self.order_ids)
+                self.order_ids.append(order.order_id)
+                self.events.append(self.EVENTS.index(order.status))
+                self.customers.append(order.customer_id)
+                self.cafeterias.append(self.code(order.cafeteria.name, self.cafeteria_names, self.cafeteria_codes))
+                self.items.append(self.code(item, self.item_names, self.item_codes))
+                self.quantities.append(quantity)
+                self.prices.append(order.price_ore if len(lines) == 1 else discounted_ore(to_ore(unit_price), quantity, order.discount))
+                self.timestamps.append(timestamp)
+                self.index(position)
+                
+    def positions(self, customer_id=None, cafeteria_name=None, item=None, start=None, end=None):
+        """Returns the positions of the rows matching all given filters in time order.
+
+        Args:
+            customer_id (int, optional): only rows of this customer
+            cafeteria_name (String, optional): only rows of this cafeteria
+            item (String, optional): only rows of this item
+            start (float, optional): only rows at or after this time
+            end (float, optional): only rows before this time
+
+        Returns:
+            list: A list of row positions
+        """
+        first = 0 if start == None else bisect.bisect_left(self.timestamps, start)
+        last = len(self.timestamps) if end == None else bisect.bisect_left(self.timestamps, end)
+        candidates = []
+        if customer_id != None:
+            candidates.append(self.by_customer.get(customer_id, array('l')))
+        if cafeteria_name != None:
+            candidates.append(self.by_cafeteria.get(self.cafeteria_codes.get(cafeteria_name), array('l')))
+        if item != None:
+            candidates.append(self.by_item.get(self.item_codes.get(item), array('l')))
+        if not candidates:
+            return list(range(first, last))
+        #scan the smallest index and check the other filters row by row
+        candidates.sort(key=len)
+        smallest = candidates[0]
+        positions = smallest[bisect.bisect_left(smallest, first):bisect.bisect_left(smallest, last)]
+        cafeteria = self.cafeteria_codes.get(cafeteria_name)
+        item_code = self.item_codes.get(item)
+        return [position for position in positions
+                if (customer_id == None or self.customers[position] == customer_id)
+                and (cafeteria_name == None or self.cafeterias[position] == cafeteria)
+                and (item == None or self.items[position] == item_code)]
+    
+    def query(self, event=None, **filters):
+        """Returns the matching events as dictionaries.
+
+        Args:
+            event (String, optional): only events of this kind, e.g. "Completed"
+            filters: the filters of positions
+
+        Returns:
+            list: A list of dictionaries with the order id, event, customer id, cafeteria, item, quantity, price in dkk and time
+        """
+        event_code = None if event == None else self.EVENTS.index(event)
+        results = []
+        for position in self.positions(**filters):
+            if event_code != None and self.events[position] != event_code:
+                continue
+            results.append({"order_id": self.order_ids[position], "event": self.EVENTS[self.events[position]],
+                            "customer_id": self.customers[position], "cafeteria": self.cafeteria_names[self.cafeterias[position]],
+                            "item": self.item_names[self.items[position]], "quantity": self.quantities[position],
+                            "price": to_dkk(self.prices[position]), "timestamp": self.timestamps[position]})
+        return results
+    
+    def quantity_per_hour(self, event="Accepted", **filters):
+        """Adds up the quantities of the matching events per hour, e.g. the Pasta sold per hour in Kilen.
+
+        Returns:
+            dict: A dictionary with the hour since the epoch as keys and the quantity as values
+        """
+        event_code = self.EVENTS.index(event)
+        per_hour = {}
+        for position in self.positions(**filters):
+            if self.events[position] == event_code:
+                hour = int(self.timestamps[position] // 3600)
+                per_hour[hour] = per_hour.get(hour, 0) + self.quantities[position]
+        return per_hour
+    
+    def save(self, directory):
+        """Saves the history to a directory with one binary file per column and the names as JSON."""
+        os.makedirs(directory, exist_ok=True)
+        with self.lock:
+            for column, _ in self.COLUMNS:
+                with open(os.path.join(directory, f"{column}.bin"), "wb") as file:
+                    getattr(self, column).tofile(file)
+            with open(os.path.join(directory, "names.json"), "w") as file:
+                json.dump({"cafeterias": self.cafeteria_names, "items": self.item_names}, file)
+                
+    @classmethod
+    def load(cls, directory):
+        """Loads a history saved with save and rebuilds its indexes.
+
+        Returns:
+            OrderHistory: the loaded history
+        """
+        history = cls()
+        with open(os.path.join(directory, "names.json")) as file:
+            names = json.load(file)
+        history.cafeteria_names = names["cafeterias"]
+        history.item_names = names["items"]
+        for column, type_code in cls.COLUMNS:
+            path = os.path.join(directory, f"{column}.bin")
+            values = array(type_code)
+            with open(path, "rb") as file:
+                values.fromfile(file, os.path.getsize(path) // values.itemsize)
+            setattr(history, column, values)
+        history.rebuild_indexes()
+        return history
+        
+    
+
+# %% [markdown]
+# #### Demand Forecasting
+# 
+# The forecaster keeps one demand time series per item and cafeteria, one value per day, taken from the item popularity of simulated or recorded days or from the order history. The days are stored as columns over all series, so every model goes through the days once and updates all items together: a moving average, exponential smoothing and day-of-week seasonality on top of the smoothed level. The forecast is turned into stocking quantities that can be put into a menu for upload_menu.
+
+# %%
+class DemandForecaster:
+    def __init__(self):
+        self.series = []
+        self.series_index = {}
+        #one column per day with the demand of every series, and the weekday of the day (0 is Monday)
+        self.days = []
+        self.weekdays = []
+        
+    def add_day(self, demand, weekday=None):
+        """Adds the demand of one day.
+
+        Args:
+            demand (dict): a dictionary with (cafeteria name, item) as keys and the quantity demanded as values
+            weekday (int, optional): the weekday of the day, 0 is Monday; defaults to the day after the last one
+        """
+        for key in demand:
+            if key not in self.series_index:
+                self.series_index[key] = len(self.series)
+                self.series.append(key)
+                for column in self.days:
+                    column.append(0.0)
+        column = [0.0] * len(self.series)
+        for key, quantity in demand.items():
+            column[self.series_index[key]] = float(quantity)
+        if weekday == None:
+            weekday = (self.weekdays[-1] + 1) % 7 if self.weekdays else 0
+        self.days.append(column)
+        self.weekdays.append(weekday)
+        
+    def record_day(self, university, weekday=None):
+        """Adds the item popularity of all cafeterias of a university as one day. It has to be called before the cafeterias are closed."""
+        demand = {}
+        for cafeteria in university.cafeterias:
+            for item, quantity in cafeteria.item_popularity.items():
+                demand[(cafeteria.name, item)] = quantity
+        self.add_day(demand, weekday)
+        
+    @classmethod
+    def from_history(cls, history, day_seconds=86400):
+        """Builds a forecaster from the accepted orders of an order history, one day per day_seconds.
+
+        Returns:
+            DemandForecaster: the forecaster with one day for every day in the history, including days without orders
+        """
+        forecaster = cls()
+        positions = history.positions()
+        if not positions:
+            return forecaster
+        accepted = history.EVENTS.index("Accepted")
+        first_day = int(history.timestamps[positions[0]] // day_seconds)
+        demand_by_day = {}
+        for position in positions:
+            if history.events[position] == accepted:
+                day = int(history.timestamps[position] // day_seconds)
+                key = (history.cafeteria_names[history.cafeterias[position]], history.item_names[history.items[position]])
+                demand = demand_by_day.setdefault(day, {})
+                demand[key] = demand.get(key, 0) + history.quantities[position]
+        last_day = int(history.timestamps[positions[-1]] // day_seconds)
+        for day in range(first_day, last_day + 1):
+            #the epoch started on a Thursday
+            forecaster.add_day(demand_by_day.get(day, {}), (day + 3) % 7)
+        return forecaster
+    
+    def moving_average(self, window=7):
+        """Returns the average demand of the last window days for every series."""
+        assert window > 0, "Window should be greater than 0"
+        recent = self.days[-window:]
+        totals = [0.0] * len(self.series)
+        for column in recent:
+            totals = [total + value for total, value in zip(totals, column)]
+        return [total / len(recent) for total in totals] if recent else totals
+    
+    def exponential_smoothing(self, alpha=0.3):
+        """Returns the exponentially smoothed demand level for every series."""
+        assert 0 < alpha <= 1, "Alpha should be between 0 and 1"
+        if not self.days:
+            return []
+        level = list(self.days[0])
+        for column in self.days[1:]:
+            level = [alpha * value + (1 - alpha) * previous for value, previous in zip(column, level)]
+        return level
+    
+    def seasonal_factors(self, min_weeks=2):
+        """Returns for every weekday the factor by which the demand of every series differs from its average.
+
+        Args:
+            min_weeks (int): weekdays seen fewer times than this get no factor, as a single day says little about the weekday
+
+        Returns:
+            dict: A dictionary with weekdays as keys and lists of factors as values
+        """
+        overall = self.moving_average(len(self.days)) if self.days else []
+        sums = {}
+        counts = {}
+        for weekday, column in zip(self.weekdays, self.days):
+            current = sums.get(weekday, [0.0] * len(self.series))
+            sums[weekday] = [total + value for total, value in zip(current, column)]
+            counts[weekday] = counts.get(weekday, 0) + 1
+        factors = {}
+        for weekday, totals in sums.items():
+            if counts[weekday] < min_weeks:
+                continue
+            factors[weekday] = [(total / counts[weekday]) / mean if mean > 0 else 1.0 for total, mean in zip(totals, overall)]
+        return factors
+    
+    def forecast(self, method="seasonal", weekday=None, window=7, alpha=0.3):
+        """Forecasts the demand of the next day.
+
+        Args:
+            method (String): "moving_average", "exponential_smoothing" or "seasonal", which is exponential smoothing times the weekday factor
+            weekday (int, optional): the weekday to be forecast, defaults to the day after the last one
+            window (int): the window of the moving average
+            alpha (float): the smoothing factor of the exponential smoothing
+
+        Returns:
+            dict: A dictionary with (cafeteria name, item) as keys and the expected demand as values
+        """
+        assert method in ("moving_average", "exponential_smoothing", "seasonal"), f"Unknown method {method}"
+        if method == "moving_average":
+            values = self.moving_average(window)
+        else:
+            values = self.exponential_smoothing(alpha)
+            if method == "seasonal" and self.days:
+                weekday = (self.weekdays[-1] + 1) % 7 if weekday == None else weekday
+                factors = self.seasonal_factors().get(weekday)
+                if factors != None:
+                    values = [value * factor for value, factor in zip(values, factors)]
+        return dict(zip(self.series, values))
+    
+    def stocking_quantities(self, safety=1.2, minimum=1, **forecast_arguments):
+        """Turns the forecast into whole stocking quantities with a safety margin.
+
+        Returns:
+            dict: A dictionary with cafeteria names as keys and dictionaries of items and quantities as values
+        """
+        quantities = {}
+        for (cafeteria_name, item), demand in self.forecast(**forecast_arguments).items():
+            quantities.setdefault(cafeteria_name, {})[item] = max(minimum, math.ceil(demand * safety))
+        return quantities
+    
+    def stocked_menu(self, menu, cafeteria_name, safety=1.2, minimum=1, **forecast_arguments):
+        """Returns a copy of a menu with the forecast quantities for a cafeteria, ready for upload_menu. Items without a forecast keep their quantity."""
+        quantities = self.stocking_quantities(safety, minimum, **forecast_arguments).get(cafeteria_name, {})
+        new_menu = copy.deepcopy(menu)
+        for item, details in new_menu.items():
+            if item in quantities:
+                details['quantity'] = quantities[item]
+        return new_menu
         
     
 
@@ -496,30 +2042,190 @@ class Order:
 # #### University
 # 
 # University is the central administration of all cafeterias. It adds students, staff, cafeterias and manages them. It keeps a sorted menu of all menu items across all cafeterias for easy access and searching. It also simulates customers and days and has a central closing function for all cafeterias. For the sorted menu, we use in-place updating and insertion sort.
+# 
+# For concurrent use, the balances are protected by a fixed set of striped locks instead of one lock per customer, and the shared sorted menu has its own lock. Like the menus of the cafeterias, the sorted menu is read-only and kept in chunks, so a change only copies one chunk and the tuple of chunks, and readers never have to lock it.
 
 # %%
+import itertools
 import random
+from collections.abc import Sequence
+from concurrent.futures import ThreadPoolExecutor
 random.seed(0)
 
+class SortedMenu(Sequence):
+    CHUNK = 64
+    
+    def __init__(self, chunks=()):
+        """A read-only version of the sorted menu, with the entries (item, description, price, quantity, cafeteria) sorted by item and cafeteria in chunks of about CHUNK entries.
+
+        Args:
+            chunks (tuple): tuples of entries, none of them empty
+        """
+        self.chunks = chunks
+        #first (item, cafeteria) and position of the first entry of every chunk, for binary searches
+        self.firsts = tuple((chunk[0][0], chunk[0][4]) for chunk in chunks)
+        self.offsets = tuple(itertools.accumulate((len(chunk) for chunk in chunks), initial=0))
+        
+    @classmethod
+    def build(cls, entries):
+        """Returns a new sorted menu with a list of entries that is already sorted."""
+        return cls(tuple(tuple(entries[i:i + cls.CHUNK]) for i in range(0, len(entries), cls.CHUNK)))
+        
+    def __len__(self):
+        return self.offsets[-1]
+    
+    def __getitem__(self, position):
+        if isinstance(position, slice):
+            return [self[i] for i in range(*position.indices(len(self)))]
+        if position < 0:
+            position += len(self)
+        if not 0 <= position < len(self):
+            raise IndexError("Sorted menu index out of range")
+        chunk = bisect.bisect_right(self.offsets, position) - 1
+        return self.chunks[chunk][position - self.offsets[chunk]]
+    
+    def __iter__(self):
+        for chunk in self.chunks:
+            yield from chunk
+            
+    def position(self, key):
+        """Returns the position of the first entry whose (item, cafeteria) is not smaller than key. The key can also be only (item,).
+        """
+        if not self.chunks:
+            return 0
+        chunk = max(bisect.bisect_left(self.firsts, key) - 1, 0)
+        return self.offsets[chunk] + bisect.bisect_left(self.chunks[chunk], key, key=lambda entry: (entry[0], entry[4]))
+    
+    def find(self, key):
+        """Returns the entry of an (item, cafeteria), or None."""
+        position = self.position(key)
+        if position < len(self) and (self[position][0], self[position][4]) == key:
+            return self[position]
+        return None
+    
+    def iterate(self, start, stop):
+        """Yields the entries from position start up to, but not including, position stop, one chunk after the other."""
+        chunk = bisect.bisect_right(self.offsets, start) - 1
+        while start < stop and chunk < len(self.chunks):
+            offset = self.offsets[chunk]
+            yield from self.chunks[chunk][start - offset:stop - offset]
+            start = self.offsets[chunk + 1]
+            chunk += 1
+    
+    def replaced(self, key, entry):
+        """Returns a new version in which the entry of an (item, cafeteria) is replaced by entry, or inserted if there was none, or removed if entry is None. Only the chunk of the entry and the tuple of chunks are copied.
+
+        Args:
+            key (tuple): the item and the cafeteria
+            entry (tuple): the new entry, or None
+
+        Returns:
+            SortedMenu: the new version
+        """
+        if not self.chunks:
+            return self if entry == None else SortedMenu(((entry,),))
+        chunk = max(bisect.bisect_right(self.firsts, key) - 1, 0)
+        entries = list(self.chunks[chunk])
+        i = bisect.bisect_left(entries, key, key=lambda entry: (entry[0], entry[4]))
+        if i < len(entries) and (entries[i][0], entries[i][4]) == key:
+            if entry == None:
+                del entries[i]
+            else:
+                entries[i] = entry
+        elif entry == None:
+            return self
+        else:
+            entries.insert(i, entry)
+        chunks = list(self.chunks)
+        if not entries:
+            del chunks[chunk]
+        elif len(entries) > 2 * self.CHUNK:
+            chunks[chunk:chunk + 1] = [tuple(entries[:self.CHUNK]), tuple(entries[self.CHUNK:])]
+        else:
+            chunks[chunk] = tuple(entries)
+        return SortedMenu(tuple(chunks))
+
+
 class University:
-    def __init__(self, name):
+    def __init__(self, name, compact_accounts=False):
         self.name = name
         self.cafeterias = []
         self.students = []
         self.staff = []
-        self.sorted_menu = []
+        #customers by id, so adding and looking up a customer does not go through the lists
+        self.students_by_id = {}
+        self.staff_by_id = {}
+        #with compact accounts, students and staff are rows of a table instead of objects, see AccountTable
+        self.accounts = None
+        if compact_accounts:
+            self.accounts = AccountTable(self)
+            self.students = self.accounts.view("Student")
+            self.staff = self.accounts.view("Staff")
+        #read-only version of the sorted menu, a new version is published on every change
+        self.sorted_menu = SortedMenu()
         self.is_sorted = False
+        self.menu_lock = threading.RLock()
+        self.customer_locks = [threading.Lock() for _ in range(64)]
+        self.day_summaries = []
+        self.ledger = Ledger()
+        self.history = OrderHistory()
+        #item name -> {cafeteria name: live quantity}, only for cafeterias that have the item in stock
+        self.availability = {}
+        self.availability_lock = threading.Lock()
+        #if set to a DemandForecaster, every closed day is added to it
+        self.forecaster = None
+        #assumed time per order for routing while a cafeteria has not completed anything recently
+        self.seconds_per_order = 60
+        #set by Federation; visitors are customers of other campuses with open orders here, by id, with the number of their open orders
+        self.federation = None
+        self.visitors = {}
+        self.visitor_orders = {}
+        self.visitor_lock = threading.Lock()
+        
+    def customer_lock(self, customer_id):
+        """Returns the lock guarding the balance and orders of a customer. Customers share a fixed number of locks (lock striping).
+
+        Args:
+            customer_id (int): the id of the customer
+
+        Returns:
+            threading.Lock: the lock responsible for the customer
+        """
+        return self.customer_locks[hash(customer_id) % len(self.customer_locks)]
+    
+    def customer_locks_for(self, customer_ids):
+        """Returns the locks of several customers without duplicates and in a fixed order, so they can be taken together without deadlocks.
+
+        Args:
+            customer_ids (iterable): the ids of the customers
+
+        Returns:
+            list: A list of the locks responsible for the customers
+        """
+        stripes = sorted({hash(customer_id) % len(self.customer_locks) for customer_id in customer_ids})
+        return [self.customer_locks[stripe] for stripe in stripes]
         
     def add_student(self, name, student_id):
-        assert student_id not in [student.customer_id for student in self.students], f"Student with id {student_id} already exists"
+        #in a federation, the customer is registered with their home campus first
+        if self.federation != None:
+            self.federation.register(self, student_id)
+        if self.accounts != None:
+            return self.accounts.add("Student", name, student_id)
+        assert student_id not in self.students_by_id, f"Student with id {student_id} already exists"
         student = Student(name, student_id, self)
         self.students.append(student)
+        self.students_by_id[student_id] = student
         return student
     
     def add_staff(self, name, staff_id):
-        assert staff_id not in [staff.customer_id for staff in self.staff], f"Staff with id {staff_id} already exists"
+        if self.federation != None:
+            self.federation.register(self, staff_id)
+        if self.accounts != None:
+            return self.accounts.add("Staff", name, staff_id)
+        assert staff_id not in self.staff_by_id, f"Staff with id {staff_id} already exists"
         staff = Staff(name, staff_id, self)
         self.staff.append(staff)
+        self.staff_by_id[staff_id] = staff
         return staff
     
     def all_customers(self):
@@ -528,15 +2234,66 @@ class University:
         Returns:
             list: A list containing all the customers in the university
         """
+        if self.visitors:
+            return self.students + self.staff + list(self.visitors.values())
         return self.students + self.staff
     
+    def customers_by_id(self):
+        """Returns a dictionary of all customers by their id for many lookups at once.
+
+        Returns:
+            dict: A dictionary with customer ids as keys and customers as values
+        """
+        customers = dict(self.visitors)
+        # students are added last, so they win over staff with the same id just like in get_customer
+        if self.accounts != None:
+            for customer in self.staff + self.students:
+                customers[customer.customer_id] = customer
+        else:
+            customers.update(self.staff_by_id)
+            customers.update(self.students_by_id)
+        return customers
+    
     def get_customer(self, customer_id):
         """"
         Returns the customer with the given id."""
-        for customer in self.all_customers():
-            if customer.customer_id == customer_id:
-                return customer
-        return None
+        if self.accounts != None:
+            customer = self.accounts.get(customer_id)
+        else:
+            customer = self.students_by_id.get(customer_id)
+            if customer == None:
+                customer = self.staff_by_id.get(customer_id)
+        if customer == None:
+            customer = self.visitors.get(customer_id)
+        #customers of other campuses are found at their home campus
+        if customer == None and self.federation != None:
+            customer = self.federation.get_customer(customer_id)
+        return customer
+    
+    def customer_ledger(self, customer_id):
+        """Returns the ledger for the money of a customer, which in a federation is the ledger of their home campus."""
+        if self.federation != None:
+            home = self.federation.home_campus(customer_id)
+            if home != None:
+                return home.ledger
+        return self.ledger
+    
+    def add_visitor(self, customer):
+        """Registers a customer of another campus who placed an order here."""
+        with self.visitor_lock:
+            self.visitors[customer.customer_id] = customer
+            self.visitor_orders[customer.customer_id] = self.visitor_orders.get(customer.customer_id, 0) + 1
+            
+    def release_visitor(self, customer_id):
+        """Counts down the open orders of a visitor when one is completed or cancelled and forgets the visitor after the last one."""
+        if customer_id not in self.visitor_orders:
+            return
+        with self.visitor_lock:
+            if customer_id in self.visitor_orders:
+                self.visitor_orders[customer_id] -= 1
+                if self.visitor_orders[customer_id] == 0:
+                    del self.visitor_orders[customer_id]
+                    del self.visitors[customer_id]
     
     def add_cafeteria(self, name):
         assert name not in [cafeteria.name for cafeteria in self.cafeterias], f"Cafeteria with name {name} already exists"
@@ -545,10 +2302,12 @@ class University:
         return cafeteria
     
     def get_cafeteria(self, name):
-        """" Returns the cafeteria with the given name.""" 
+        """" Returns the cafeteria with the given name. In a federation, the cafeterias of the other campuses are found as well.""" 
         for cafeteria in self.cafeterias:
             if cafeteria.name == name:
                 return cafeteria
+        if self.federation != None:
+            return self.federation.find_cafeteria(name)
         return None
     
     def generate_customers(self, n_students, n_staff):
@@ -567,195 +2326,1775 @@ class University:
             description (string): the description of the item
             price (int): the price of the item
         """
-        assert quantity>0, "Quantity should be greater than 0"
+        assert quantity>=0, "Quantity should not be negative"
         assert cafeteria_name in [cafeteria.name for cafeteria in self.cafeterias], f"Sorry, {cafeteria_name} is not available in the university"
-        #only update if the menu is sorted
-        if self.is_sorted:
-            for i in range(len(self.sorted_menu)):
-                if self.sorted_menu[i][0] == item:
-                    # Remove the item from the list
-                    prev_item = self.sorted_menu.pop(i)
-
-                    # Re-insert the item at the correct position
-                    j = len(self.sorted_menu) - 1
-                    while j >= 0 and self.sorted_menu[j][0] > item[0]:
-                        j -= 1
-                    if description == None:
-                        self.sorted_menu.insert(j + 1, (item, prev_item[1], prev_item[2], quantity, cafeteria_name))
-                    else:
-                        self.sorted_menu.insert(j + 1, (item,  description, price, quantity, cafeteria_name))
+        with self.menu_lock:
+            #only update if the menu is sorted
+            if self.is_sorted:
+                key = (item, cafeteria_name)
+                if description == None:
+                    prev_item = self.sorted_menu.find(key)
+                    #without a description and price, only an item that is on the sorted menu can be updated
+                    if prev_item == None:
+                        return
+                    description, price = prev_item[1], prev_item[2]
+                # Replace the item, or insert a new item, at the correct position by name and cafeteria
+                self.sorted_menu = self.sorted_menu.replaced(key, (item, description, price, quantity, cafeteria_name))
+    
+    def remove_item_from_sorted_menu(self, item, cafeteria_name):
+        """Removes an item from the sorted menu of the university.
+
+        Args:
+            item (string): the name of the item
+            cafeteria_name (string): the name of the cafeteria
+        """
+        with self.menu_lock:
+            if self.is_sorted:
+                self.sorted_menu = self.sorted_menu.replaced((item, cafeteria_name), None)
+    
+    def invalidate_sorted_menu(self):
+        """Marks the sorted menu as out of date, so it is sorted again on the next read. The menu lock makes sure a sort that is still running cannot mark the old menu as up to date afterwards."""
+        with self.menu_lock:
+            self.is_sorted = False
+    
+    def sorted_menu_snapshot(self):
+        """Returns the current version of the sorted menu. The menu lock is only taken if the menu has to be sorted again.
+
+        Returns:
+            SortedMenu: the sorted menu as tuples of item, description, price, quantity and cafeteria
+        """
+        if not self.is_sorted:
+            with self.menu_lock:
+                if not self.is_sorted:
+                    self.sort_menu()
+        return self.sorted_menu
+      
+    def release_expired_holds(self, now=None):
+        """Cancels the expired holds of all cafeterias.
+
+        Args:
+            now (float, optional): the current time, defaults to time.time()
+
+        Returns:
+            list: A list of the cancelled orders
+        """
+        expired = []
+        for cafeteria in self.cafeterias:
+            expired.extend(cafeteria.release_expired_holds(now))
+        return expired
+    
+    def update_availability(self, cafeteria_name, item, quantity):
+        """Updates the live stock of an item in a cafeteria in the availability index.
+
+        Args:
+            cafeteria_name (string): the name of the cafeteria
+            item (string): the name of the item
+            quantity (int): the live quantity, 0 if the item is out of stock or not on the menu
+        """
+        with self.availability_lock:
+            if quantity > 0:
+                self.availability.setdefault(item, {})[cafeteria_name] = quantity
+            elif item in self.availability:
+                self.availability[item].pop(cafeteria_name, None)
+                if not self.availability[item]:
+                    del self.availability[item]
+    
+    def in_stock_anywhere(self, item):
+        """Returns whether an item is in stock in any cafeteria right now."""
+        return item in self.availability
+    
+    def where_available(self, item):
+        """Returns the cafeterias that have an item in stock right now, the one with the most stock first.
+
+        Args:
+            item (string): the name of the item
+
+        Returns:
+            list: A list of tuples containing the cafeteria name and the live quantity
+        """
+        with self.availability_lock:
+            stock = list(self.availability.get(item, {}).items())
+        return sorted(stock, key=lambda entry: (-entry[1], entry[0]))
+    
+    def queue_metrics(self):
+        """Returns the queue metrics of all cafeterias, see Cafeteria.queue_metrics."""
+        return {cafeteria.name: cafeteria.queue_metrics() for cafeteria in self.cafeterias}
+    
+    def rank_cafeterias(self, item, quantity=1):
+        """Ranks the cafeterias that have an item in stock by how soon a new order would be ready. Only signals that are kept up to date anyway are used: the live stock from the availability index, the number of open orders and the recent completion rate.
+
+        Cafeterias that have the whole quantity come first, then the shortest estimated wait, then the most stock. Cafeterias whose admission control would turn the order away because of too many open orders are left out.
+
+        Args:
+            item (string): the name of the item
+            quantity (int): the quantity to be ordered
+
+        Returns:
+            list: A list of tuples containing the cafeteria name, the live quantity and the estimated wait in seconds
+        """
+        with self.availability_lock:
+            stock = list(self.availability.get(item, {}).items())
+        ranking = []
+        for cafeteria_name, available in stock:
+            cafeteria = self.get_cafeteria(cafeteria_name)
+            open_orders = len(cafeteria.orders)
+            if cafeteria.admission != None:
+                if cafeteria.admission.max_open_orders != None and open_orders >= cafeteria.admission.max_open_orders:
+                    continue
+                order_seconds = cafeteria.admission.order_seconds()
+            else:
+                rate = cafeteria.completion_rate()
+                order_seconds = 1 / rate if rate > 0 else self.seconds_per_order
+            ranking.append((cafeteria_name, available, (open_orders + 1) * order_seconds))
+        return sorted(ranking, key=lambda entry: (entry[1] < quantity, entry[2], -entry[1], entry[0]))
+    
+    def route_order(self, item, quantity=1):
+        """Returns the name of the cafeteria an order should go to, see rank_cafeterias.
+
+        Raises:
+            ValueError: if no cafeteria has the item in stock
+        """
+        ranking = self.rank_cafeterias(item, quantity)
+        if not ranking:
+            raise ValueError(f"Sorry, {item} is not available in any cafeteria right now")
+        return ranking[0][0]
+    
+    def search_available(self, item_name):
+        """Searches for an item like search_menu, but only returns cafeterias that have it in stock right now, with the live quantity and the one with the most stock first.
+
+        Args:
+            item_name (String): the name of the item to be searched
+
+        Returns:
+            list: a list of lists containing the cafeteria, description, price and live quantity
+        """
+        results = []
+        for cafeteria_name, quantity in self.where_available(item_name):
+            details = self.get_cafeteria(cafeteria_name).snapshot.menu.get(item_name)
+            if details != None:
+                results.append([cafeteria_name, details['description'], details['price'], quantity])
+        if not results:
+            return False, f"Item '{item_name}' is not in stock in any cafeteria."
+        return results
+      
+    def view_sorted_menu(self):
+        """Returns the sorted menu of the university as a list of dictionaries.
+        
+        Returns:
+            list: list of dictionaries containing the item, description, price, quantity, and cafeteria of each item in the menu
+        """
+        return list(self.iter_sorted_menu())
+    
+    def iter_sorted_menu(self, start=None, stop=None, where=None):
+        """Yields the sorted menu one item at a time. The bounds are looked up in the sorted menu with a binary search, so only the items in the range are visited.
+
+        Args:
+            start (string, optional): the first item name to be included
+            stop (string, optional): the first item name not to be included anymore
+            where (callable, optional): only items for which where(menu_item) is true are yielded
+
+        Yields:
+            dict: the item, description, price, quantity and cafeteria of a menu item
+        """
+        menu = self.sorted_menu_snapshot()
+        low = 0 if start == None else menu.position((start,))
+        high = len(menu) if stop == None else menu.position((stop,))
+        for item in menu.iterate(low, high):
+            menu_item = {
+            "item": item[0],
+            "description": item[1],
+            "price": item[2],
+            "quantity": item[3],
+            "cafeteria": item[4]
+            }
+            if where == None or where(menu_item):
+                yield menu_item
+                
+    def iter_search(self, item_name, where=None):
+        """Yields the matches of an item like search_menu, ordered by cafeteria, without building the list of all matches.
+
+        Args:
+            item_name (String): the name of the item to be searched
+            where (callable, optional): only matches for which where(match) is true are yielded
+
+        Yields:
+            list: the cafeteria, description, price and quantity
+        """
+        menu = self.sorted_menu_snapshot()
+        for entry in menu.iterate(menu.position((item_name,)), len(menu)):
+            if entry[0] != item_name:
+                break
+            match = [entry[4], entry[1], entry[2], entry[3]]
+            if where == None or where(match):
+                yield match
+            
+    def iter_customers(self, customer_type=None, where=None):
+        """Yields the customers one at a time instead of joining the lists like all_customers.
+
+        Args:
+            customer_type (String, optional): only "Student" or "Staff"
+            where (callable, optional): only customers for which where(customer) is true are yielded
+            
+        Raises:
+            ValueError: if the customer type is not "Student" or "Staff"
+        """
+        visitors = tuple(self.visitors.values())
+        if customer_type == None:
+            groups = [self.students, self.staff, visitors]
+        elif customer_type == "Student":
+            groups = [self.students, [visitor for visitor in visitors if visitor.customer_type == "Student"]]
+        elif customer_type == "Staff":
+            groups = [self.staff, [visitor for visitor in visitors if visitor.customer_type == "Staff"]]
+        else:
+            raise ValueError(f"Sorry, {customer_type} is not a customer type")
+        for group in groups:
+            for customer in group:
+                if where == None or where(customer):
+                    yield customer
+    
+    def sort_menu(self):
+        """
+        Generates a sorted complete menu using insertion sort and updates the cache.
+        
+        Returns:
+            The sorted complete menu.
+        """
+        with self.menu_lock:
+            complete_menu = []        
+            i=0
+            # Sort using insertion sort
+            for cafeteria in self.cafeterias:
+                menu = cafeteria.snapshot.menu
+                for name in menu.keys():
+                    item=(name, menu[name]['description'], menu[name]['price'],menu[name]['quantity'],menu[name]['cafeteria'])
+                    complete_menu.append(item)
+                    j=i-1
+                    while j >= 0 and (complete_menu[j][0] > name or (complete_menu[j][0] == name and complete_menu[j][4]>item[4])):  # Sort by item name
+                        complete_menu[j + 1] = complete_menu[j]
+                        j -= 1
+                    complete_menu[j + 1] = item
+                    i+=1
+
+            # Update the cache
+            self.sorted_menu = SortedMenu.build(complete_menu)
+            self.is_sorted = True
+            return self.sorted_menu
+    
+    def search_menu(self, item_name):
+        """Searches for an item in the menu of the university.
+
+        Args:
+            item_name (String): the name of the item to be searched
+
+        Returns:
+            list: a list of tuples containing the item details
+        """
+        # Binary search in the sorted menu, which is sorted first if it is not up-to-date
+        results = list(self.iter_search(item_name))
+        if results:
+            return results
+        return False, f"Item '{item_name}' not found in any cafeteria."
+    
+    def place_orders_batch(self, requests):
+        """Places many orders at once. The customers and cafeterias are looked up once, the requests are grouped by cafeteria and every cafeteria is locked only once for its whole group.
+
+        Args:
+            requests (list): a list of tuples (customer_id, cafeteria_name, item, quantity)
+
+        Returns:
+            list: A list with one tuple per request in the same order. It contains the potential message and the order object, or the error message and None if the order failed.
+        """
+        customers = self.customers_by_id()
+        cafeterias = {cafeteria.name: cafeteria for cafeteria in self.cafeterias}
+        
+        results = [None] * len(requests)
+        groups = {}
+        for index, (customer_id, cafeteria_name, item, quantity) in enumerate(requests):
+            #customers of other campuses are found through the federation
+            if customer_id not in customers and self.federation != None:
+                customer = self.get_customer(customer_id)
+                if customer != None:
+                    customers[customer_id] = customer
+            if customer_id not in customers:
+                results[index] = (f"Sorry, customer with id {customer_id} not found", None)
+            elif cafeteria_name not in cafeterias:
+                results[index] = (f"Sorry, {cafeteria_name} is not available in the university", None)
+            elif quantity <= 0:
+                results[index] = ("Quantity should be greater than 0", None)
+            else:
+                groups.setdefault(cafeteria_name, []).append(index)
+        
+        for cafeteria_name, indices in groups.items():
+            cafeteria = cafeterias[cafeteria_name]
+            cafeteria.release_expired_holds()
+            locks = self.customer_locks_for(requests[index][0] for index in indices)
+            # customer locks before the cafeteria lock, as in place_order
+            for lock in locks:
+                lock.acquire()
+            try:
+                with cafeteria.lock:
+                    for index in indices:
+                        customer_id, _, item, quantity = requests[index]
+                        customer = customers[customer_id]
+                        visiting = customer.university is not self
+                        #the visitor is registered first, as in Federation.place_order
+                        if visiting:
+                            self.add_visitor(customer)
+                        try:
+                            if item not in cafeteria.menu:
+                                raise ValueError(f"Sorry, {item} is not available in the menu")
+                            if customer.balance_ore < discounted_ore(to_ore(cafeteria.menu[item]['price']), quantity, customer.discount):
+                                raise ValueError(f"Sorry, you do not have enough balance to place this order")
+                            message, order = cafeteria.reserve_order(customer_id, customer.customer_type, item, quantity, customer.discount)
+                        except ValueError as e:
+                            if visiting:
+                                self.release_visitor(customer_id)
+                            results[index] = (str(e), None)
+                            continue
+                        customer.balance_ore -= order.price_ore
+                        self.customer_ledger(customer_id).record("debit", order.price_ore, customer_id, customer.customer_type, cafeteria_name)
+                        customer.orders.append(order)
+                        results[index] = (message, order)
+            finally:
+                for lock in reversed(locks):
+                    lock.release()
+        return results
+    
+    
+    def simulate_day(self, n=10):
+        """Simulates a day in the university. Every fifth order, the most popular items are restocked, unless the cafeteria has a restock engine, which then decides.
+        
+        Args:
+            n (int): maximum number of orders to be placed in each cafeteria, at least 5
+            
+            
+        Returns:
+            tuple: A tuple containing the number of cancelled orders, completed orders, successful orders, failed orders, and a log of all the events
+            """
+        assert n>=5, "n should be at least 5"
+        cancelled_orders = 0
+        completed_orders = 0
+        successful_orders = 0
+        failed_orders = 0
+        log = []
+        
+        for cafeteria in self.cafeterias:
+            for i in range(random.randint(5, n)):
+                if i % 5 == 4:
+                    if cafeteria.restock_engine != None:
+                        for item, quantity in cafeteria.restock_engine.flush():
+                            log.append(f"Restocked {item} in {cafeteria.name}")
+                    else:
+                        popular_items = cafeteria.popular_items(5)
+                        for item in popular_items:
+                            cafeteria.restock_item(item[0], random.randint(10, 50))
+                            log.append(f"Restocked {item[0]} in {cafeteria.name}")
+                
+                customer = random.choice(self.all_customers())
+                customer.add_balance(random.randint(10, 500))
+                log.append(f"Added balance to {customer.name}")
+                item = random.choice(list(cafeteria.menu.keys()))
+                quantity = random.randint(1, 5)
+                
+                try:
+                    order = customer.place_order(cafeteria.name, item, quantity)
+                    log.append(f"{customer.name} placed order for {quantity} {item}(s) from {cafeteria.name}")
+                    if random.random() < 0.1:
+                        cafeteria.cancel_order(order[1].order_id)
+                        cancelled_orders += 1
+                        log.append(f"Order for {quantity} {item}(s) from {cafeteria.name} was cancelled")
+                    elif random.random() > 0.1:
+                        cafeteria.complete_order(order[1].order_id)
+                        completed_orders += 1
+                        log.append(f"Order for {quantity} {item}(s) from {cafeteria.name} was completed")
+                        if random.random() > 0.2:
+                            customer.pick_up_order(order[1].order_id)
+                            successful_orders += 1
+                            log.append(f"Order for {quantity} {item}(s) from {cafeteria.name} was picked up")
+                except ValueError as e:
+                    failed_orders += 1
+                    log.append(f"Order for {quantity} {item}(s) from {cafeteria.name} failed: {str(e)}")
+                   
+        return cancelled_orders, completed_orders, successful_orders, failed_orders, log
+    
+    def refund(self, refunds, cafeteria_name=None, customers=None):
+        """Pays out refunds to customers with a single lookup per customer.
+
+        Args:
+            refunds (dict): a dictionary with customer ids as keys and the amounts to be refunded in øre as values
+            cafeteria_name (String, optional): the cafeteria the refunds are recorded for in the ledger
+            customers (dict, optional): the result of customers_by_id, if the caller already has it
+        """
+        if customers == None:
+            customers = self.customers_by_id()
+        for customer_id, amount in refunds.items():
+            customer = customers.get(customer_id)
+            if customer == None:
+                customer = self.get_customer(customer_id)
+            if customer != None:
+                with self.customer_lock(customer_id):
+                    customer.balance_ore+=amount
+                self.customer_ledger(customer_id).record("refund", amount, customer_id, customer.customer_type, cafeteria_name)
+    
+    def close_university(self, parallel=False):
+        """Closes the university for the day. The refunds of every cafeteria are paid out in one pass per cafeteria and the day is added to the day summaries.
+        
+        Args:
+            parallel (bool): whether the cafeterias should be closed in parallel threads
+        
+        Returns:
+            tuple: A tuple containing the total revenue and the revenue by cafeteria as a dictionary
+        """
+        if self.forecaster != None:
+            self.forecaster.record_day(self)
+        refunds_by_cafeteria = {cafeteria.name: {} for cafeteria in self.cafeterias}
+        if parallel and len(self.cafeterias) > 1:
+            with ThreadPoolExecutor(max_workers=len(self.cafeterias)) as executor:
+                revenues = list(executor.map(lambda cafeteria: cafeteria.close_cafeteria(refunds_by_cafeteria[cafeteria.name]), self.cafeterias))
+        else:
+            revenues = [cafeteria.close_cafeteria(refunds_by_cafeteria[cafeteria.name]) for cafeteria in self.cafeterias]
+        
+        revenue_by_cafeteria = {}
+        refunded = 0
+        refunded_customers = set()
+        customers = self.customers_by_id()
+        for cafeteria, revenue in zip(self.cafeterias, revenues):
+            revenue_by_cafeteria[cafeteria.name] = revenue
+            refunds = refunds_by_cafeteria[cafeteria.name]
+            self.refund(refunds, cafeteria.name, customers)
+            refunded += sum(refunds.values())
+            refunded_customers.update(refunds)
+        total_revenue = sum(revenues)
+        self.day_summaries.append({"total_revenue": total_revenue, "revenue_by_cafeteria": revenue_by_cafeteria,
+                                   "refunded": to_dkk(refunded), "refunded_customers": len(refunded_customers)})
+        return total_revenue, revenue_by_cafeteria
+        
+
+
+
+# %% [markdown]
+# #### Sharding
+# 
+# To use more than one core, the cafeterias can be split between worker processes (shards). Every shard runs its own University with its cafeterias and hands out its own part of the order ids, so ids never collide. The ShardedUniversity in the main process is the router: it keeps the customers and their balances, sends every order to the shard of its cafeteria and asks all shards at once for searches and for closing (scatter/gather). Batches of orders are sent to all shards at the same time, so the shards work in parallel.
+
+# %%
+import multiprocessing
+
+class Shard:
+    def __init__(self, shard, n_shards, cafeteria_names):
+        Order.configure_ids(shard, n_shards)
+        self.university = University(f"Shard {shard}")
+        for name in cafeteria_names:
+            self.university.add_cafeteria(name)
+        self.orders = {}
+        
+    def run(self, connection):
+        """Answers the requests of the router until it sends "stop"."""
+        while True:
+            command, args = connection.recv()
+            if command == "stop":
+                break
+            try:
+                connection.send((True, getattr(self, command)(*args)))
+            except (ValueError, AssertionError, PermissionError) as e:
+                connection.send((False, str(e)))
+            #any other error is sent back as well, so the worker keeps serving its cafeterias
+            except Exception as e:
+                connection.send((False, f"{type(e).__name__}: {e}"))
+        connection.close()
+                
+    def cafeteria(self, name):
+        cafeteria = self.university.get_cafeteria(name)
+        if cafeteria == None:
+            raise ValueError(f"Sorry, {name} is not available in the university")
+        return cafeteria
+    
+    def upload_menu(self, cafeteria_name, menu):
+        return self.cafeteria(cafeteria_name).upload_menu(menu)
+    
+    def restock_item(self, cafeteria_name, item, quantity):
+        return self.cafeteria(cafeteria_name).restock_item(item, quantity)
+    
+    def place(self, customer_id, customer_type, discount, balance_ore, cafeteria_name, item, quantity):
+        """Places an order for a customer the router has checked, as long as the price is within the balance.
+
+        Returns:
+            tuple: A tuple containing the potential message, the order id, the quantity and the price in øre
+        """
+        cafeteria = self.cafeteria(cafeteria_name)
+        assert quantity>0, "Quantity should be greater than 0"
+        with cafeteria.lock:
+            if item not in cafeteria.menu:
+                raise ValueError(f"Sorry, {item} is not available in the menu")
+            if balance_ore < discounted_ore(to_ore(cafeteria.menu[item]['price']), quantity, discount):
+                raise ValueError(f"Sorry, you do not have enough balance to place this order")
+            message, order = cafeteria.reserve_order(customer_id, customer_type, item, quantity, discount)
+        self.orders[order.order_id] = order
+        return message, order.order_id, order.quantity, order.price_ore
+    
+    def place_batch(self, requests, balances):
+        """Places a batch of orders. The balances are the ones of the customers at the start of the batch and go down with every order.
+
+        Args:
+            requests (list): a list of tuples (index, customer_id, customer_type, discount, cafeteria_name, item, quantity)
+            balances (dict): a dictionary with customer ids as keys and balances in øre as values
+
+        Returns:
+            list: A list of tuples (index, ok, result), where result is the return value of place or the error message
+        """
+        results = []
+        for index, customer_id, customer_type, discount, cafeteria_name, item, quantity in requests:
+            try:
+                result = self.place(customer_id, customer_type, discount, balances[customer_id], cafeteria_name, item, quantity)
+            except (ValueError, AssertionError) as e:
+                results.append((index, False, str(e)))
+                continue
+            balances[customer_id] -= result[3]
+            results.append((index, True, result))
+        return results
+    
+    def complete_order(self, cafeteria_name, order_id):
+        """Completes an order and returns the message and the price in øre, which the router records as revenue."""
+        message = self.cafeteria(cafeteria_name).complete_order(order_id)
+        return message, self.orders[order_id].price_ore
+    
+    def cancel_order(self, cafeteria_name, order_id):
+        """Cancels an order and returns its price in øre, which the router refunds."""
+        self.cafeteria(cafeteria_name).cancel_order(order_id)
+        return self.orders.pop(order_id).price_ore
+    
+    def pick_up_order(self, order_id):
+        order = self.orders.get(order_id)
+        if order == None or order.status != "Completed":
+            raise ValueError(f"Sorry, order with id {order_id} not found")
+        del self.orders[order_id]
+        return order.pick_up()
+    
+    def search_menu(self, item_name):
+        result = self.university.search_menu(item_name)
+        return [] if result[0] == False else result
+    
+    def close(self):
+        """Closes all cafeterias of the shard.
+
+        Returns:
+            tuple: A tuple containing the revenue by cafeteria and the refunds in øre by customer id
+        """
+        revenue_by_cafeteria = {}
+        refunds = {}
+        for cafeteria in self.university.cafeterias:
+            revenue_by_cafeteria[cafeteria.name] = cafeteria.close_cafeteria(refunds)
+        self.orders = {}
+        return revenue_by_cafeteria, refunds
+    
+
+def run_shard(connection, shard, n_shards, cafeteria_names):
+    Shard(shard, n_shards, cafeteria_names).run(connection)
+
+
+class ShardedUniversity:
+    def __init__(self, name, cafeteria_names, n_shards=None):
+        """Starts the shard processes and splits the cafeterias between them.
+
+        Args:
+            name (String): the name of the university
+            cafeteria_names (list): the names of the cafeterias
+            n_shards (int, optional): the number of worker processes, defaults to one per core but not more than cafeterias
+        """
+        n_shards = min(len(cafeteria_names), os.cpu_count() or 1) if n_shards == None else n_shards
+        assert 0 < n_shards <= len(cafeteria_names), "There should be between 1 shard and one shard per cafeteria"
+        #customers, balances and the ledger stay in the router
+        self.directory = University(name)
+        self.cafeteria_names = list(cafeteria_names)
+        self.shard_of = {name: i % n_shards for i, name in enumerate(cafeteria_names)}
+        #order id -> (customer id, cafeteria name)
+        self.order_owners = {}
+        self.connections = []
+        self.processes = []
+        self.connection_locks = []
+        for shard in range(n_shards):
+            router_end, shard_end = multiprocessing.Pipe()
+            names = [name for name in cafeteria_names if self.shard_of[name] == shard]
+            process = multiprocessing.Process(target=run_shard, args=(shard_end, shard, n_shards, names), daemon=True)
+            process.start()
+            self.connections.append(router_end)
+            self.processes.append(process)
+            self.connection_locks.append(threading.Lock())
+            
+    def call(self, shard, command, *args):
+        with self.connection_locks[shard]:
+            self.connections[shard].send((command, args))
+            ok, result = self.connections[shard].recv()
+        if not ok:
+            raise ValueError(result)
+        return result
+    
+    def scatter(self, command, args_by_shard):
+        """Sends a command to several shards at once and gathers the answers.
+
+        Args:
+            command (String): the method of Shard to be called
+            args_by_shard (dict): a dictionary with shard numbers as keys and argument tuples as values
+
+        Returns:
+            dict: A dictionary with shard numbers as keys and the results as values
+        """
+        shards = sorted(args_by_shard)
+        for shard in shards:
+            self.connection_locks[shard].acquire()
+        try:
+            for shard in shards:
+                self.connections[shard].send((command, args_by_shard[shard]))
+            answers = {shard: self.connections[shard].recv() for shard in shards}
+        finally:
+            for shard in shards:
+                self.connection_locks[shard].release()
+        for ok, result in answers.values():
+            if not ok:
+                raise ValueError(result)
+        return {shard: answer[1] for shard, answer in answers.items()}
+    
+    def shard(self, cafeteria_name):
+        if cafeteria_name not in self.shard_of:
+            raise ValueError(f"Sorry, {cafeteria_name} is not available in the university")
+        return self.shard_of[cafeteria_name]
+    
+    def add_student(self, name, student_id):
+        return self.directory.add_student(name, student_id)
+    
+    def add_staff(self, name, staff_id):
+        return self.directory.add_staff(name, staff_id)
+    
+    def generate_customers(self, n_students, n_staff):
+        self.directory.generate_customers(n_students, n_staff)
+        
+    def get_customer(self, customer_id):
+        return self.directory.get_customer(customer_id)
+    
+    def upload_menu(self, cafeteria_name, menu):
+        return self.call(self.shard(cafeteria_name), "upload_menu", cafeteria_name, menu)
+    
+    def restock_item(self, cafeteria_name, item, quantity):
+        return self.call(self.shard(cafeteria_name), "restock_item", cafeteria_name, item, quantity)
+    
+    def place_order(self, customer_id, cafeteria_name, item, quantity):
+        """Places an order with the shard of the cafeteria and debits the customer.
+
+        Returns:
+            tuple: A tuple containing the potential message, the order id, the quantity and the price in dkk
+        """
+        customer = self.directory.get_customer(customer_id)
+        if customer == None:
+            raise ValueError(f"Sorry, customer with id {customer_id} not found")
+        with self.directory.customer_lock(customer_id):
+            message, order_id, quantity, price_ore = self.call(self.shard(cafeteria_name), "place", customer_id, customer.customer_type,
+                                                               customer.discount, customer.balance_ore, cafeteria_name, item, quantity)
+            customer.balance_ore -= price_ore
+        self.order_owners[order_id] = (customer_id, cafeteria_name)
+        self.directory.ledger.record("debit", price_ore, customer_id, customer.customer_type, cafeteria_name)
+        return message, order_id, quantity, to_dkk(price_ore)
+    
+    def place_orders_batch(self, requests):
+        """Places many orders with all shards working at the same time. Customers whose orders go to more than one shard are handled afterwards, one order at a time, so they cannot spend their balance twice.
+
+        Args:
+            requests (list): a list of tuples (customer_id, cafeteria_name, item, quantity)
+
+        Returns:
+            list: A list with one tuple per request, containing the potential message and the order id, or the error message and None
+        """
+        customers = self.directory.customers_by_id()
+        results = [None] * len(requests)
+        shards_of_customer = {}
+        for customer_id, cafeteria_name, _, _ in requests:
+            if cafeteria_name in self.shard_of:
+                shards_of_customer.setdefault(customer_id, set()).add(self.shard_of[cafeteria_name])
+        by_shard = {}
+        later = []
+        for index, (customer_id, cafeteria_name, item, quantity) in enumerate(requests):
+            customer = customers.get(customer_id)
+            if customer == None:
+                results[index] = (f"Sorry, customer with id {customer_id} not found", None)
+            elif cafeteria_name not in self.shard_of:
+                results[index] = (f"Sorry, {cafeteria_name} is not available in the university", None)
+            elif len(shards_of_customer[customer_id]) > 1:
+                later.append(index)
+            else:
+                by_shard.setdefault(self.shard_of[cafeteria_name], []).append((index, customer_id, customer.customer_type, customer.discount, cafeteria_name, item, quantity))
+        
+        locks = self.directory.customer_locks_for(request[1] for batch in by_shard.values() for request in batch)
+        for lock in locks:
+            lock.acquire()
+        try:
+            args_by_shard = {}
+            for shard, batch in by_shard.items():
+                args_by_shard[shard] = (batch, {request[1]: customers[request[1]].balance_ore for request in batch})
+            answers = self.scatter("place_batch", args_by_shard) if args_by_shard else {}
+            for shard, shard_results in answers.items():
+                for index, ok, result in shard_results:
+                    if not ok:
+                        results[index] = (result, None)
+                        continue
+                    customer_id, cafeteria_name = requests[index][0], requests[index][1]
+                    message, order_id, _, price_ore = result
+                    customers[customer_id].balance_ore -= price_ore
+                    self.order_owners[order_id] = (customer_id, cafeteria_name)
+                    self.directory.ledger.record("debit", price_ore, customer_id, customers[customer_id].customer_type, cafeteria_name)
+                    results[index] = (message, order_id)
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+        
+        for index in later:
+            try:
+                message, order_id, _, _ = self.place_order(*requests[index])
+                results[index] = (message, order_id)
+            except (ValueError, AssertionError) as e:
+                results[index] = (str(e), None)
+        return results
+    
+    def complete_order(self, cafeteria_name, order_id):
+        message, price_ore = self.call(self.shard(cafeteria_name), "complete_order", cafeteria_name, order_id)
+        customer = self.directory.get_customer(self.order_owners[order_id][0])
+        self.directory.ledger.record("revenue", price_ore, customer.customer_id, customer.customer_type, cafeteria_name)
+        return message
+    
+    def cancel_order(self, cafeteria_name, order_id):
+        price_ore = self.call(self.shard(cafeteria_name), "cancel_order", cafeteria_name, order_id)
+        customer_id = self.order_owners.pop(order_id)[0]
+        self.directory.refund({customer_id: price_ore}, cafeteria_name)
+        return f"Order {order_id} cancelled"
+    
+    def pick_up_order(self, customer_id, order_id):
+        owner = self.order_owners.get(order_id)
+        if owner == None or owner[0] != customer_id:
+            raise ValueError(f"Sorry, order with id {order_id} not found")
+        message = self.call(self.shard(owner[1]), "pick_up_order", order_id)
+        del self.order_owners[order_id]
+        return message
+    
+    def search_menu(self, item_name):
+        """Searches all shards at once and merges the results.
+
+        Returns:
+            list: a list of lists containing the cafeteria, description, price and quantity
+        """
+        answers = self.scatter("search_menu", {shard: (item_name,) for shard in range(len(self.connections))})
+        results = sorted((row for result in answers.values() for row in result), key=lambda row: row[0])
+        if not results:
+            return False, f"Item '{item_name}' not found in any cafeteria."
+        return results
+    
+    def close_university(self):
+        """Closes all shards at once and pays out the refunds.
+
+        Returns:
+            tuple: A tuple containing the total revenue and the revenue by cafeteria as a dictionary
+        """
+        answers = self.scatter("close", {shard: () for shard in range(len(self.connections))})
+        revenue_by_cafeteria = {}
+        refunds = {}
+        for shard_revenue, shard_refunds in answers.values():
+            revenue_by_cafeteria.update(shard_revenue)
+            for customer_id, amount in shard_refunds.items():
+                refunds[customer_id] = refunds.get(customer_id, 0) + amount
+        self.directory.refund(refunds)
+        self.order_owners = {}
+        revenue_by_cafeteria = {name: revenue_by_cafeteria[name] for name in self.cafeteria_names}
+        return sum(revenue_by_cafeteria.values()), revenue_by_cafeteria
+    
+    def shutdown(self):
+        """Stops all shard processes."""
+        for connection, lock in zip(self.connections, self.connection_locks):
+            with lock:
+                connection.send(("stop", ()))
+        for process in self.processes:
+            process.join()
+        self.connections = []
+        self.processes = []
+
+
+# %% [markdown]
+# #### Shared Memory
+# 
+# For several till processes working on the same stock and balances, the quantities and balances can be moved into shared memory. A SharedTable is an array of integers in a multiprocessing.shared_memory block with a dictionary from names to slots. Reading a value reads the shared memory directly without copying; changing a value is a compare-and-swap under one of a few striped process locks, so two processes can never both take the last item. A SharedInventory puts the stock of all cafeterias and the balances of all customers of a university into two such tables, and counts the items sold and the money taken by every cafeteria in two more. Writing back books the sales since the last write back in the cafeterias, with their revenue, the popularity of the items and the ledger, and passes the new stock on to the sorted menu and the restock engines.
+
+# %%
+from multiprocessing import shared_memory
+
+class SharedTable:
+    def __init__(self, keys, stripes=16):
+        """Creates a shared table with one slot per key, all starting at 0.
+
+        Args:
+            keys (iterable): the names of the slots
+            stripes (int): the number of locks shared by the slots
+        """
+        self.slots = {key: slot for slot, key in enumerate(keys)}
+        self.memory = shared_memory.SharedMemory(create=True, size=max(1, len(self.slots)) * 8)
+        self.values = self.memory.buf.cast('q')
+        self.locks = [multiprocessing.Lock() for _ in range(stripes)]
+        #forked processes get a copy of this object, so the owner is remembered by process id
+        self.owner = os.getpid()
+        
+    def __getstate__(self):
+        #only the name of the shared memory is sent to other processes, not its contents
+        return {"name": self.memory.name, "slots": self.slots, "locks": self.locks, "owner": self.owner}
+    
+    def __setstate__(self, state):
+        self.slots = state["slots"]
+        self.locks = state["locks"]
+        self.memory = shared_memory.SharedMemory(name=state["name"])
+        self.values = self.memory.buf.cast('q')
+        self.owner = state["owner"]
+        
+    def __contains__(self, key):
+        return key in self.slots
+        
+    def get(self, key):
+        return self.values[self.slots[key]]
+    
+    def set(self, key, value):
+        slot = self.slots[key]
+        with self.locks[slot % len(self.locks)]:
+            self.values[slot] = value
+    
+    def compare_and_swap(self, key, expected, new):
+        """Sets a slot to a new value only if it still has the expected value.
+
+        Returns:
+            bool: whether the value was changed
+        """
+        slot = self.slots[key]
+        with self.locks[slot % len(self.locks)]:
+            if self.values[slot] != expected:
+                return False
+            self.values[slot] = new
+            return True
+        
+    def add(self, key, amount, minimum=0):
+        """Adds an amount to a slot unless the result would fall below the minimum.
+
+        Returns:
+            bool: whether the amount was added
+        """
+        while True:
+            current = self.get(key)
+            if current + amount < minimum:
+                return False
+            if self.compare_and_swap(key, current, current + amount):
+                return True
+            
+    def close(self):
+        """Detaches from the shared memory and frees it if this table created it."""
+        self.values.release()
+        self.memory.close()
+        if self.owner == os.getpid():
+            self.memory.unlink()
+
+
+class SharedInventory:
+    def __init__(self, university):
+        """Copies the stock of all cafeterias and the balances of all customers of a university into shared memory."""
+        self.stock = SharedTable([(cafeteria.name, item) for cafeteria in university.cafeterias for item in cafeteria.menu])
+        self.balances = SharedTable([customer.customer_id for customer in university.all_customers()])
+        self.prices = {(cafeteria.name, item): to_ore(details['price']) for cafeteria in university.cafeterias for item, details in cafeteria.menu.items()}
+        #items sold and money taken by the tills, which write_back books in the cafeterias
+        self.sold = SharedTable(self.stock.slots)
+        self.takings = SharedTable([cafeteria.name for cafeteria in university.cafeterias])
+        self.items = {cafeteria.name: list(cafeteria.menu) for cafeteria in university.cafeterias}
+        for cafeteria in university.cafeterias:
+            for item, details in cafeteria.menu.items():
+                self.stock.set((cafeteria.name, item), details['quantity'])
+        #sales and takings at the last write back
+        self.written_sold = {key: 0 for key in self.stock.slots}
+        self.written_takings = {cafeteria.name: 0 for cafeteria in university.cafeterias}
+        #balances at the last write back, to know how much the tills took from every customer
+        self.written_balances = {}
+        for customer_id, customer in university.customers_by_id().items():
+            self.balances.set(customer_id, customer.balance_ore)
+            self.written_balances[customer_id] = customer.balance_ore
+            
+    def take_order(self, customer_id, discount, cafeteria_name, item, quantity):
+        """Takes the stock and the money for an order. If the customer cannot pay, the stock is given back.
+
+        Returns:
+            int: the price of the order in øre
+        """
+        key = (cafeteria_name, item)
+        if key not in self.stock:
+            raise ValueError(f"Sorry, {item} is not available in the menu")
+        if not self.stock.add(key, -quantity):
+            raise ValueError(f"Sorry, only {self.stock.get(key)} {item}(s) available")
+        price = discounted_ore(self.prices[key], quantity, discount)
+        if not self.balances.add(customer_id, -price):
+            self.stock.add(key, quantity)
+            raise ValueError(f"Sorry, you do not have enough balance to place this order")
+        self.sold.add(key, quantity)
+        self.takings.add(cafeteria_name, price)
+        return price
+    
+    def write_back(self, university):
+        """Copies the shared stock back into the menus of a university, books the sales since the last write back in the cafeterias and takes the money the tills took from the customers. Every cafeteria records its takings as one revenue entry and every customer their spending as one debit, so the ledger still adds up. Items the restock engines restock are added to the shared stock as well."""
+        for cafeteria in university.cafeterias:
+            if cafeteria.name not in self.takings:
+                continue
+            with cafeteria.lock:
+                changed = []
+                for item in self.items[cafeteria.name]:
+                    key = (cafeteria.name, item)
+                    sold = self.sold.get(key)
+                    if sold != self.written_sold[key]:
+                        cafeteria.item_popularity[item] = cafeteria.item_popularity.get(item, 0) + sold - self.written_sold[key]
+                        self.written_sold[key] = sold
+                    if item in cafeteria.menu and cafeteria.menu[item]['quantity'] != self.stock.get(key):
+                        cafeteria.menu[item]['quantity'] = self.stock.get(key)
+                        university.update_sorted_menu(item, cafeteria.menu[item]['quantity'], cafeteria.name)
+                        changed.append(item)
+                takings = self.takings.get(cafeteria.name)
+                taken = takings - self.written_takings[cafeteria.name]
+                self.written_takings[cafeteria.name] = takings
+                if taken != 0:
+                    cafeteria.revenue_ore += taken
+                    university.ledger.record("revenue", taken, cafeteria_name=cafeteria.name)
+                written = {item: cafeteria.menu[item]['quantity'] for item in changed}
+                cafeteria.stock_changed(*changed)
+                #the restock engine may have restocked some of the items
+                for item, quantity in written.items():
+                    if item in cafeteria.menu and cafeteria.menu[item]['quantity'] > quantity:
+                        self.stock.add((cafeteria.name, item), cafeteria.menu[item]['quantity'] - quantity)
+        for customer_id, customer in university.customers_by_id().items():
+            if customer_id not in self.written_balances:
+                continue
+            balance = self.balances.get(customer_id)
+            spent = self.written_balances[customer_id] - balance
+            self.written_balances[customer_id] = balance
+            if spent != 0:
+                with university.customer_lock(customer_id):
+                    customer.balance_ore -= spent
+                university.customer_ledger(customer_id).record("debit", spent, customer_id, customer.customer_type)
+            
+    def close(self):
+        self.stock.close()
+        self.balances.close()
+        self.sold.close()
+        self.takings.close()
+
+
+# %% [markdown]
+# #### Federation
+# 
+# Several campuses, each with its own University, can be joined into a federation. Every customer has a home campus, which keeps the balance and the orders, and the global directory maps customer ids to their home campus. A customer can order in any cafeteria of the federation: the order is placed by the home campus, and the customer is registered as a visitor on the campus of the cafeteria until their last open order there is completed or cancelled. Customers of other campuses are looked up at their home campus, so cancelling and closing refund the right account. The money of a customer, including refunds, is always recorded in the ledger of their home campus, and the revenue in the ledger of the campus of the cafeteria. All campuses share one set of customer locks for this.
+# 
+# The global catalog merges the sorted menus of all campuses with a k-way merge, so it is sorted without sorting again. Searches and reports are sent to all campuses at once in threads and the results are streamed in the order the campuses answer.
+
+# %%
+from concurrent.futures import as_completed
+
+class Federation:
+    def __init__(self, universities):
+        """Joins several campuses. Customer ids and cafeteria names have to be unique across the federation.
+
+        Args:
+            universities (list): the University of every campus
+        """
+        self.campuses = {university.name: university for university in universities}
+        assert len(self.campuses) == len(universities), "Campus names should be unique"
+        #customer id -> home campus
+        self.directory = {}
+        cafeteria_names = set()
+        for university in universities:
+            for cafeteria in university.cafeterias:
+                assert cafeteria.name not in cafeteria_names, f"Cafeteria {cafeteria.name} exists on more than one campus"
+                cafeteria_names.add(cafeteria.name)
+            for customer in university.students + university.staff:
+                self.register(university, customer.customer_id)
+        #a customer can order on every campus, so all campuses use the same customer locks
+        for university in universities:
+            university.customer_locks = universities[0].customer_locks
+            university.federation = self
+            
+    def register(self, university, customer_id):
+        assert self.directory.get(customer_id, university) is university, f"Customer id {customer_id} exists on more than one campus"
+        self.directory[customer_id] = university
+        
+    def add_customer(self, campus_name, customer_type, name, customer_id):
+        """Adds a student or staff member to their home campus, which registers them in the global directory."""
+        university = self.campuses[campus_name]
+        return university.add_student(name, customer_id) if customer_type == "Student" else university.add_staff(name, customer_id)
+        
+    def home_campus(self, customer_id):
+        """Returns the University that holds the account of a customer, or None."""
+        return self.directory.get(customer_id)
+    
+    def get_customer(self, customer_id):
+        university = self.home_campus(customer_id)
+        return None if university == None else university.get_customer(customer_id)
+    
+    def find_cafeteria(self, name):
+        for university in self.campuses.values():
+            for cafeteria in university.cafeterias:
+                if cafeteria.name == name:
+                    return cafeteria
+        return None
+    
+    def place_order(self, customer_id, cafeteria_name, item, quantity, pickup_time=None):
+        """Places an order for a customer in a cafeteria on any campus.
+
+        Returns:
+            tuple: A tuple containing a potential message and the order object
+        """
+        customer = self.get_customer(customer_id)
+        if customer == None:
+            raise ValueError(f"Sorry, customer with id {customer_id} not found")
+        cafeteria = self.find_cafeteria(cafeteria_name)
+        assert cafeteria != None, f"Sorry, {cafeteria_name} is not available in the federation"
+        visiting = cafeteria.university is not customer.university
+        #the visitor is registered first, so the order cannot be completed before it is counted
+        if visiting:
+            cafeteria.university.add_visitor(customer)
+        try:
+            return customer.place_order(cafeteria_name, item, quantity, pickup_time)
+        except Exception:
+            if visiting:
+                cafeteria.university.release_visitor(customer_id)
+            raise
+    
+    def pick_up_order(self, customer_id, order_id):
+        customer = self.get_customer(customer_id)
+        if customer == None:
+            raise ValueError(f"Sorry, customer with id {customer_id} not found")
+        return customer.pick_up_order(order_id)
+    
+    def iter_catalog(self):
+        """Yields the sorted menus of all campuses merged into one sorted catalog.
+
+        Yields:
+            tuple: item, description, price, quantity, cafeteria and campus
+        """
+        def entries(menu, name):
+            for entry in menu:
+                yield entry + (name,)
+        #the menus are streamed into the merge, so no campus menu is copied
+        menus = [entries(university.sorted_menu_snapshot(), name) for name, university in self.campuses.items()]
+        return heapq.merge(*menus, key=lambda entry: (entry[0], entry[4]))
+    
+    def catalog(self):
+        return list(self.iter_catalog())
+    
+    def fan_out(self, function):
+        """Calls a function for every campus in parallel threads and yields the results as soon as they are there.
+
+        Yields:
+            tuple: the name of the campus and the result
+        """
+        with ThreadPoolExecutor(max_workers=len(self.campuses)) as executor:
+            futures = {executor.submit(function, university): name for name, university in self.campuses.items()}
+            for future in as_completed(futures):
+                yield futures[future], future.result()
+                
+    def iter_search(self, item_name):
+        """Searches all campuses at once and yields the matches as the campuses answer.
+
+        Yields:
+            list: campus, cafeteria, description, price and quantity
+        """
+        for campus_name, result in self.fan_out(lambda university: university.search_menu(item_name)):
+            if result[0] != False:
+                for row in result:
+                    yield [campus_name] + row
+                    
+    def search_menu(self, item_name):
+        """Searches all campuses, see iter_search.
+
+        Returns:
+            list: a list of lists with the campus and the item details, sorted by campus and cafeteria
+        """
+        results = sorted(self.iter_search(item_name), key=lambda row: (row[0], row[1]))
+        if not results:
+            return False, f"Item '{item_name}' not found on any campus."
+        return results
+    
+    @staticmethod
+    def campus_report(university):
+        """Returns the key figures of one campus."""
+        return {"customers": len(university.students) + len(university.staff),
+                "cafeterias": len(university.cafeterias),
+                "open_orders": sum(len(cafeteria.orders) for cafeteria in university.cafeterias),
+                "revenue": to_dkk(sum(cafeteria.revenue_ore for cafeteria in university.cafeterias)),
+                "ledger": {kind: to_dkk(university.ledger.total(kind)) for kind in Ledger.KINDS}}
+    
+    def iter_reports(self):
+        """Yields the report of every campus as soon as it is ready."""
+        return self.fan_out(self.campus_report)
+    
+    def report(self):
+        """Returns the reports of all campuses and their totals.
+
+        Returns:
+            dict: A dictionary with the report per campus and the "total" over all campuses
+        """
+        campuses = dict(self.iter_reports())
+        total = {key: sum(report[key] for report in campuses.values()) for key in ("customers", "cafeterias", "open_orders", "revenue")}
+        total["ledger"] = {kind: sum(report["ledger"][kind] for report in campuses.values()) for kind in Ledger.KINDS}
+        return {"campuses": campuses, "total": total}
+
+
+# %% [markdown]
+# #### Async Service
+# 
+# The service lets many clients use the university at the same time over a local TCP connection, one JSON request per line. Orders and everything else that changes a cafeteria go through one queue per cafeteria, so they are handled one after another, while reading requests such as searching and viewing menus are answered right away. A small load generator is included to try it out.
+
+# %%
+import asyncio
+
+class AsyncService:
+    def __init__(self, university):
+        self.university = university
+        self.queues = {}
+        self.workers = []
+        self.server = None
+        
+    async def start(self):
+        """Starts one worker per cafeteria that handles the writing requests of that cafeteria in order."""
+        for cafeteria in self.university.cafeterias:
+            queue = asyncio.Queue()
+            self.queues[cafeteria.name] = queue
+            self.workers.append(asyncio.create_task(self.worker(queue)))
+            
+    async def stop(self):
+        """Stops the server and the cafeteria workers."""
+        if self.server != None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+        self.queues = {}
+        
+    async def worker(self, queue):
+        while True:
+            future, function, args = await queue.get()
+            #the client may have given up in the meantime, e.g. by disconnecting, and then the request is dropped
+            if future.done():
+                continue
+            try:
+                result = function(*args)
+            except Exception as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+                
+    async def write(self, cafeteria_name, function, *args):
+        """Queues a writing request for a cafeteria and waits for the result.
+
+        Args:
+            cafeteria_name (String): the cafeteria whose queue handles the request
+            function (callable): the model method to be called
+            args: the arguments of the method
+
+        Returns:
+            the return value of the method
+        """
+        queue = self.queues.get(cafeteria_name)
+        if queue == None:
+            raise ValueError(f"Sorry, {cafeteria_name} is not available in the university")
+        future = asyncio.get_running_loop().create_future()
+        queue.put_nowait((future, function, args))
+        return await future
+    
+    def customer(self, customer_id):
+        customer = self.university.get_customer(customer_id)
+        if customer == None:
+            raise ValueError(f"Sorry, customer with id {customer_id} not found")
+        return customer
+    
+    def cafeteria(self, cafeteria_name):
+        cafeteria = self.university.get_cafeteria(cafeteria_name)
+        if cafeteria == None:
+            raise ValueError(f"Sorry, {cafeteria_name} is not available in the university")
+        return cafeteria
+        
+    async def place_order(self, customer_id, cafeteria_name, item, quantity):
+        message, order = await self.write(cafeteria_name, self.customer(customer_id).place_order, cafeteria_name, item, quantity)
+        return {"message": message, "order_id": order.order_id, "quantity": order.quantity, "price": order.price}
+    
+    async def pick_up_order(self, customer_id, order_id):
+        return self.customer(customer_id).pick_up_order(order_id)
+    
+    async def complete_order(self, cafeteria_name, order_id):
+        return await self.write(cafeteria_name, self.cafeteria(cafeteria_name).complete_order, order_id)
+    
+    async def cancel_order(self, cafeteria_name, order_id):
+        return await self.write(cafeteria_name, self.cafeteria(cafeteria_name).cancel_order, order_id)
+    
+    async def add_balance(self, customer_id, amount):
+        return self.customer(customer_id).add_balance(amount)
+    
+    async def get_balance(self, customer_id):
+        return self.customer(customer_id).get_balance()
+    
+    async def search_menu(self, item):
+        return self.university.search_menu(item)
+    
+    async def view_menu(self, customer_id, cafeteria_name):
+        return self.customer(customer_id).view_menu(cafeteria_name)
+    
+    async def queue_metrics(self):
+        return self.university.queue_metrics()
+    
+    async def handle(self, request):
+        """Handles a single request.
+
+        Args:
+            request (dict): a dictionary with the name of the action and its arguments, e.g. {"action": "get_balance", "customer_id": 865}
+
+        Returns:
+            dict: A dictionary with "ok" and either the "result" or the "error" message
+        """
+        actions = {"place_order": self.place_order, "pick_up_order": self.pick_up_order, "add_balance": self.add_balance,
+                   "get_balance": self.get_balance, "search_menu": self.search_menu, "view_menu": self.view_menu,
+                   "complete_order": self.complete_order, "cancel_order": self.cancel_order, "queue_metrics": self.queue_metrics}
+        if not isinstance(request, dict):
+            return {"ok": False, "error": "Request should be a JSON object"}
+        arguments = dict(request)
+        action = actions.get(arguments.pop("action", None))
+        if action == None:
+            return {"ok": False, "error": f"Unknown action {request.get('action')}"}
+        try:
+            return {"ok": True, "result": await action(**arguments)}
+        except OrderRejected as e:
+            return {"ok": False, "error": str(e), "retry_after": e.retry_after}
+        except (ValueError, PermissionError, AssertionError, TypeError) as e:
+            return {"ok": False, "error": str(e)}
+        
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
                     break
-    
-    def remove_item_from_sorted_menu(self, item, cafeteria_name):
-        """Removes an item from the sorted menu of the university.
+                try:
+                    response = await self.handle(json.loads(line))
+                except json.JSONDecodeError:
+                    response = {"ok": False, "error": "Invalid JSON"}
+                writer.write(json.dumps(response, default=str).encode() + b"\n")
+                await writer.drain()
+        finally:
+            writer.close()
+            
+    async def serve(self, host="127.0.0.1", port=8765):
+        """Starts the workers and a TCP server accepting one JSON request per line.
 
         Args:
-            item (string): the name of the item
-            cafeteria_name (string): the name of the cafeteria
-        """
-        if self.is_sorted:
-            for i in range(len(self.sorted_menu)):
-                if self.sorted_menu[i][0] == item and self.sorted_menu[i][4] == cafeteria_name:
-                    self.sorted_menu.pop(i)
-                    break
-      
-    def view_sorted_menu(self):
-        """Returns the sorted menu of the university as a list of dictionaries.
-        
+            host (String): the host to listen on
+            port (int): the port to listen on, 0 picks a free port
+
         Returns:
-            list: list of dictionaries containing the item, description, price, quantity, and cafeteria of each item in the menu
+            int: the port the server listens on
         """
-        if not self.is_sorted:
-            self.sort_menu()
-        menu_list = []
-        for item in self.sorted_menu:
-            menu_item = {
-            "item": item[0],
-            "description": item[1],
-            "price": item[2],
-            "quantity": item[3],
-            "cafeteria": item[4]
-            }
-            menu_list.append(menu_item)
-        return menu_list
+        if not self.workers:
+            await self.start()
+        self.server = await asyncio.start_server(self.handle_connection, host, port)
+        return self.server.sockets[0].getsockname()[1]
     
-    def sort_menu(self):
-        """
-        Generates a sorted complete menu using insertion sort and updates the cache.
+
+async def generate_load(university, host="127.0.0.1", port=8765, n_clients=50, requests_per_client=200, seed=0):
+    """Opens many client connections to a running service and sends a random mix of requests.
+
+    Args:
+        university (University): the university served, used to pick customers, cafeterias and items
+        host (String): the host of the service
+        port (int): the port of the service
+        n_clients (int): number of concurrent clients
+        requests_per_client (int): number of requests sent by every client
+        seed (int): seed for the random request mix
+
+    Returns:
+        tuple: A tuple containing the number of requests, the number of failed requests and the requests per second
+    """
+    customer_ids = [customer.customer_id for customer in university.all_customers()]
+    menus = {cafeteria.name: list(cafeteria.menu.keys()) for cafeteria in university.cafeterias if cafeteria.menu}
+    failed = 0
+    
+    async def client(rng):
+        nonlocal failed
+        reader, writer = await asyncio.open_connection(host, port)
+        for _ in range(requests_per_client):
+            customer_id = rng.choice(customer_ids)
+            cafeteria_name = rng.choice(list(menus.keys()))
+            roll = rng.random()
+            if roll < 0.3:
+                request = {"action": "place_order", "customer_id": customer_id, "cafeteria_name": cafeteria_name, "item": rng.choice(menus[cafeteria_name]), "quantity": rng.randint(1, 3)}
+            elif roll < 0.5:
+                request = {"action": "add_balance", "customer_id": customer_id, "amount": rng.randint(10, 500)}
+            elif roll < 0.6:
+                request = {"action": "get_balance", "customer_id": customer_id}
+            elif roll < 0.8:
+                request = {"action": "search_menu", "item": rng.choice(menus[cafeteria_name])}
+            else:
+                request = {"action": "view_menu", "customer_id": customer_id, "cafeteria_name": cafeteria_name}
+            writer.write(json.dumps(request).encode() + b"\n")
+            await writer.drain()
+            if not json.loads(await reader.readline())["ok"]:
+                failed += 1
+        writer.close()
+        await writer.wait_closed()
+    
+    start = time.perf_counter()
+    await asyncio.gather(*(client(random.Random(seed + i)) for i in range(n_clients)))
+    duration = time.perf_counter() - start
+    total = n_clients * requests_per_client
+    return total, failed, total / duration
+
+
+async def serve_university(university, host="127.0.0.1", port=8765):
+    """Serves a university until the process is stopped."""
+    service = AsyncService(university)
+    port = await service.serve(host, port)
+    print(f"Serving {university.name} on {host}:{port}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await service.stop()
+
+
+async def run_service_with_load(university, n_clients=50, requests_per_client=200):
+    """Starts the service on a free local port, runs the load generator against it and stops the service again."""
+    service = AsyncService(university)
+    port = await service.serve(port=0)
+    try:
+        return await generate_load(university, port=port, n_clients=n_clients, requests_per_client=requests_per_client)
+    finally:
+        await service.stop()
+
+
+# %% [markdown]
+# #### Instrumentation
+# 
+# Optional timers and counters for the hot paths. While instrumentation is disabled, the original methods are in place, so it costs nothing. Enabling it wraps the methods listed in OPERATIONS with a wrapper that counts the calls, records the latency in a histogram and counts hits and misses of the sorted-menu cache. A cProfile and tracemalloc capture can be taken on demand, and the metrics can be exported as Prometheus text or JSON.
+
+# %%
+import cProfile
+import functools
+import io
+import pstats
+import tracemalloc
+
+class Instrumentation:
+    #the classes are looked up when enabling, so the GUI defined further down can be instrumented as well
+    OPERATIONS = [("General_Customer", "place_order"), ("Cafeteria", "process_order"), ("Cafeteria", "complete_order"),
+                  ("Cafeteria", "cancel_order"), ("Cafeteria", "close_cafeteria"), ("Order", "cancel"),
+                  ("University", "sort_menu"), ("University", "search_menu"), ("University", "view_sorted_menu"),
+                  ("University", "update_sorted_menu"), ("GUI", "view_menu"), ("GUI", "view_detailed_menu"),
+                  ("GUI", "view_orders"), ("GUI", "create_search_results"), ("GUI", "view_cafeteria_menu"),
+                  ("GUI", "view_cafeteria_orders"), ("GUI", "create_popular_items"), ("GUI", "view_sorted_menu")]
+    #methods that use the sorted menu and rebuild it if it is out of date
+    SORTED_MENU_READERS = {"University.search_menu", "University.view_sorted_menu"}
+    #upper bounds of the latency buckets in seconds
+    BUCKETS = [0.00001, 0.0001, 0.001, 0.01, 0.1, 1, float("inf")]
+    
+    def __init__(self):
+        self.enabled = False
+        self.originals = {}
+        self.lock = threading.Lock()
+        self.reset()
+        
+    def reset(self):
+        """Clears all collected metrics."""
+        self.calls = {}
+        self.seconds = {}
+        self.histograms = {}
+        self.cache_hits = 0
+        self.cache_misses = 0
+        
+    def enable(self):
+        """Wraps the instrumented methods. Calling it twice has no effect."""
+        if self.enabled:
+            return
+        for class_name, method_name in self.OPERATIONS:
+            cls = globals().get(class_name)
+            if cls == None or method_name not in cls.__dict__:
+                continue
+            original = cls.__dict__[method_name]
+            self.originals[(cls, method_name)] = original
+            setattr(cls, method_name, self.wrap(f"{class_name}.{method_name}", original))
+        self.enabled = True
+        
+    def disable(self):
+        """Puts the original methods back, so there is no overhead left."""
+        for (cls, method_name), original in self.originals.items():
+            setattr(cls, method_name, original)
+        self.originals = {}
+        self.enabled = False
+        
+    def wrap(self, name, function):
+        checks_cache = name in self.SORTED_MENU_READERS
+        
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if checks_cache:
+                self.record_cache(args[0].is_sorted)
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.record(name, time.perf_counter() - start)
+        return wrapper
+        
+    def record(self, name, seconds):
+        with self.lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+            self.seconds[name] = self.seconds.get(name, 0) + seconds
+            histogram = self.histograms.setdefault(name, [0] * len(self.BUCKETS))
+            for i, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    histogram[i] += 1
+                    break
+    
+    def record_cache(self, hit):
+        with self.lock:
+            if hit:
+                self.cache_hits += 1
+            else:
+                self.cache_misses += 1
+                
+    def cache_hit_rate(self):
+        """Returns the share of sorted-menu reads that did not have to re-sort the menu, or None if there were none."""
+        total = self.cache_hits + self.cache_misses
+        return self.cache_hits / total if total > 0 else None
         
+    def snapshot(self):
+        """Returns the collected metrics.
+
         Returns:
-            The sorted complete menu.
+            dict: A dictionary with the calls, total seconds and latency histogram per operation and the sorted-menu cache statistics
         """
-        complete_menu = []        
-        i=0
-        # Sort using insertion sort
-        for cafeteria in self.cafeterias:
-   
-            for name in cafeteria.menu.keys():
-                item=(name, cafeteria.menu[name]['description'], cafeteria.menu[name]['price'],cafeteria.menu[name]['quantity'],cafeteria.menu[name]['cafeteria'])
-                complete_menu.append(item)
-                j=i-1
-                while j >= 0 and (complete_menu[j][0] > name or (complete_menu[j][0] == name and complete_menu[j][4]>item[4])):  # Sort by item name
-                    complete_menu[j + 1] = complete_menu[j]
-                    j -= 1
-                complete_menu[j + 1] = item
-                i+=1
-
-        # Update the cache
-        self.sorted_menu = complete_menu
-        self.is_sorted = True
-        return self.sorted_menu
+        with self.lock:
+            operations = {}
+            for name in self.calls:
+                operations[name] = {"calls": self.calls[name], "seconds": self.seconds[name],
+                                    "buckets": dict(zip([str(bound) for bound in self.BUCKETS], self.histograms[name]))}
+            return {"operations": operations,
+                    "sorted_menu_cache": {"hits": self.cache_hits, "misses": self.cache_misses, "hit_rate": self.cache_hit_rate()}}
+        
+    def prometheus(self):
+        """Returns the metrics in the Prometheus text format."""
+        metrics = self.snapshot()
+        lines = ["# TYPE cafeteria_operation_seconds histogram"]
+        for name, operation in metrics["operations"].items():
+            cumulative = 0
+            for bound, count in operation["buckets"].items():
+                cumulative += count
+                bound = "+Inf" if bound == "inf" else bound
+                lines.append(f'cafeteria_operation_seconds_bucket{{operation="{name}",le="{bound}"}} {cumulative}')
+            lines.append(f'cafeteria_operation_seconds_sum{{operation="{name}"}} {operation["seconds"]}')
+            lines.append(f'cafeteria_operation_seconds_count{{operation="{name}"}} {operation["calls"]}')
+        lines.append("# TYPE cafeteria_sorted_menu_cache_total counter")
+        lines.append(f'cafeteria_sorted_menu_cache_total{{result="hit"}} {metrics["sorted_menu_cache"]["hits"]}')
+        lines.append(f'cafeteria_sorted_menu_cache_total{{result="miss"}} {metrics["sorted_menu_cache"]["misses"]}')
+        return "\n".join(lines) + "\n"
     
-    def search_menu(self, item_name):
-        """Searches for an item in the menu of the university.
+    def export(self, path, format="prometheus"):
+        """Writes the metrics to a local file.
 
         Args:
-            item_name (String): the name of the item to be searched
+            path (String): the file to be written
+            format (String): either "prometheus" or "json"
+        """
+        assert format in ("prometheus", "json"), "Format should be prometheus or json"
+        with open(path, "w") as file:
+            if format == "json":
+                json.dump(self.snapshot(), file, indent=2)
+            else:
+                file.write(self.prometheus())
+                
+    def capture(self, function, *args, top=20, **kwargs):
+        """Runs a function under cProfile and tracemalloc.
+
+        Args:
+            function (callable): the function to be profiled
+            top (int): number of functions and allocation sites to be reported
 
         Returns:
-            list: a list of tuples containing the item details
+            tuple: A tuple containing the return value of the function, the cProfile report sorted by cumulative time, the peak memory in bytes and the largest allocation sites
         """
-        # Sort the menu if it is not up-to-date
-        if not self.is_sorted:
-            self.sort_menu()
+        profiler = cProfile.Profile()
+        tracemalloc.start()
+        profiler.enable()
+        try:
+            result = function(*args, **kwargs)
+        finally:
+            profiler.disable()
+            peak_memory = tracemalloc.get_traced_memory()[1]
+            allocations = tracemalloc.take_snapshot().statistics("lineno")[:top]
+            tracemalloc.stop()
+        report = io.StringIO()
+        pstats.Stats(profiler, stream=report).sort_stats("cumulative").print_stats(top)
+        return result, report.getvalue(), peak_memory, [str(allocation) for allocation in allocations]
 
-        # Perform binary search
-        low, high = 0, len(self.sorted_menu) - 1
-        results = []
 
-        while low <= high:
-            mid = (low + high) // 2
-            mid_item = self.sorted_menu[mid][0]
-
-            if mid_item == item_name:
-                # Find all matches
-                results.append([self.sorted_menu[mid][4], self.sorted_menu[mid][1], self.sorted_menu[mid][2], self.sorted_menu[mid][3]])
-
-                # Check neighbors for duplicates
-                left, right = mid - 1, mid + 1
-                while left >= 0 and self.sorted_menu[left][0] == item_name:
-                    results.append([self.sorted_menu[left][4], self.sorted_menu[left][1], self.sorted_menu[left][2], self.sorted_menu[left][3]])
-                    left -= 1
-                while right < len(self.sorted_menu) and self.sorted_menu[right][0] == item_name:
-                    results.append([self.sorted_menu[right][4], self.sorted_menu[right][1], self.sorted_menu[right][2], self.sorted_menu[right][3]])
-                    right += 1
-                return results
-
-            elif mid_item < item_name:
-                low = mid + 1
-            else:
-                high = mid - 1
+instrumentation = Instrumentation()
 
-        return False, f"Item '{item_name}' not found in any cafeteria."
-    
+
+# %% [markdown]
+# #### Record and Replay
+# 
+# A TraceRecorder captures the public calls that change a university into a compact binary trace, using the same wrapping of methods as the instrumentation. Every call is stored as one packed record with an operation code, the outcome of the call and its arguments. Names, items and menus are stored once in a string table and afterwards only referenced by their position. The trace starts with the cafeterias, menus, customers and balances at the start of the recording and ends with a fingerprint of the final state.
+# 
+# replay_trace builds a fresh university from the start of the trace and calls the same methods again without any randomness. It checks that every call has the same outcome and that the final state has the same fingerprint. This makes it possible to benchmark changes against a recorded day. Orders placed with place_order_anywhere are recorded as the place_order calls they make, so the replay does not depend on the timing of the ranking. Time-based holds are not part of the trace, so they should be off while recording.
+
+# %%
+import hashlib
+import inspect
+import struct
+
+def state_fingerprint(university, ledger_start=None):
+    """Returns a hash of the menus, orders, revenues and balances of a university. Timestamps are left out.
+
+    Args:
+        university (University): the university
+        ledger_start (dict, optional): the ledger totals per kind that were already there when the recording started
+
+    Returns:
+        bytes: the SHA-256 digest of the state
+    """
+    ledger_start = {} if ledger_start == None else ledger_start
+    state = [Order.class_counter]
+    for cafeteria in university.cafeterias:
+        menu = sorted((item, details['description'], details['price'], details['quantity']) for item, details in cafeteria.menu.items())
+        orders = [(order.order_id, order.customer_id, order.status, order.line_items(), order.price_ore) for order in cafeteria.orders.values()]
+        state.append((cafeteria.name, cafeteria.revenue_ore, menu, sorted(cafeteria.item_popularity.items()), orders))
+    for customer in university.all_customers():
+        #order_list, so no list is created for customers who never ordered
+        state.append((customer.customer_type, customer.customer_id, customer.balance_ore, [(order.order_id, order.status) for order in customer.order_list or []]))
+    state.append([university.ledger.total(kind) - ledger_start.get(kind, 0) for kind in Ledger.KINDS])
+    return hashlib.sha256(repr(state).encode()).digest()
+
+
+class TraceRecorder:
+    MAGIC = b"CAFTRACE1"
+    STRING = 0
+    END = 255
+    #operation code -> class, method and the kinds of its arguments including the object itself:
+    #u university, c customer, k cafeteria, s string, j menu, basket or requests as JSON, i integer, n number or None
+    OPERATIONS = {1: ("General_Customer", "place_order", "cssin"),
+                  2: ("Cafeteria", "complete_order", "ki"),
+                  3: ("Cafeteria", "cancel_order", "ki"),
+                  4: ("General_Customer", "pick_up_order", "ci"),
+                  5: ("Cafeteria", "restock_item", "ksi"),
+                  6: ("Cafeteria", "upload_menu", "kj"),
+                  7: ("General_Customer", "add_balance", "cn"),
+                  8: ("General_Customer", "place_basket_order", "csjn"),
+                  9: ("University", "place_orders_batch", "uj")}
+    FORMATS = {"u": "", "c": "Bq", "k": "I", "s": "I", "j": "I", "i": "q", "n": "d"}
+    CUSTOMER_TYPES = ["Student", "Staff"]
+    #the outcome of a call, 0 if it succeeded
+    OUTCOMES = [None, ValueError, PermissionError, AssertionError]
+    #restock engines restock within other calls, but replayed universities have no engines, so these calls are kept
+    NESTED = {"restock_item"}
     
-    def simulate_day(self, n=10):
-        """Simulates a day in the university.
+    def __init__(self, university):
+        self.university = university
+        self.enabled = False
+        self.originals = {}
+        #recorded calls run one at a time, so the order of the trace is the order they ran in
+        self.lock = threading.RLock()
+        self.local = threading.local()
         
-        Args:
-            n (int): maximum number of orders to be placed in each cafeteria, at least 5
-            
-            
-        Returns:
-            tuple: A tuple containing the number of cancelled orders, completed orders, successful orders, failed orders, and a log of all the events
-            """
-        assert n>=5, "n should be at least 5"
-        cancelled_orders = 0
-        completed_orders = 0
-        successful_orders = 0
-        failed_orders = 0
-        log = []
+    @staticmethod
+    def outcome(error):
+        for code, kind in enumerate(TraceRecorder.OUTCOMES):
+            if kind != None and isinstance(error, kind):
+                return code
+        return len(TraceRecorder.OUTCOMES)
         
-        for cafeteria in self.cafeterias:
-            for i in range(random.randint(5, n)):
-                if i % 5 == 4:
-                    popular_items = cafeteria.popular_items(5)
-                    for item in popular_items:
-                        cafeteria.restock_item(item[0], random.randint(10, 50))
-                        log.append(f"Restocked {item[0]} in {cafeteria.name}")
-                
-                customer = random.choice(self.all_customers())
-                customer.add_balance(random.randint(10, 500))
-                log.append(f"Added balance to {customer.name}")
-                item = random.choice(list(cafeteria.menu.keys()))
-                quantity = random.randint(1, 5)
-                
-                try:
-                    order = customer.place_order(cafeteria.name, item, quantity)
-                    log.append(f"{customer.name} placed order for {quantity} {item}(s) from {cafeteria.name}")
-                    if random.random() < 0.1:
-                        cafeteria.cancel_order(order[1].order_id)
-                        cancelled_orders += 1
-                        log.append(f"Order for {quantity} {item}(s) from {cafeteria.name} was cancelled")
-                    elif random.random() > 0.1:
-                        cafeteria.complete_order(order[1].order_id)
-                        completed_orders += 1
-                        log.append(f"Order for {quantity} {item}(s) from {cafeteria.name} was completed")
-                        if random.random() > 0.2:
-                            customer.pick_up_order(order[1].order_id)
-                            successful_orders += 1
-                            log.append(f"Order for {quantity} {item}(s) from {cafeteria.name} was picked up")
-                except ValueError as e:
-                    failed_orders += 1
-                    log.append(f"Order for {quantity} {item}(s) from {cafeteria.name} failed: {str(e)}")
-                   
-        return cancelled_orders, completed_orders, successful_orders, failed_orders, log
-    
-    def close_university(self):
-        """Closes the university for the day.
+    def start(self):
+        """Writes the current state of the university as the start of the trace and wraps the recorded methods."""
+        assert not self.enabled, "The recorder is already running"
+        customers = self.university.all_customers()
+        assert all(not cafeteria.orders for cafeteria in self.university.cafeterias) and all(not customer.order_list for customer in customers), "Recording has to start while there are no orders"
+        header = {"name": self.university.name,
+                  "order_counter": Order.class_counter, "id_step": Order.id_step,
+                  "cafeterias": [{"name": cafeteria.name, "revenue_ore": cafeteria.revenue_ore,
+                                  "menu": {item: {key: value for key, value in details.items() if key != 'cafeteria'} for item, details in cafeteria.menu.items()}}
+                                 for cafeteria in self.university.cafeterias],
+                  "customers": [[customer.customer_type, customer.name, customer.customer_id, customer.balance_ore] for customer in customers]}
+        header = json.dumps(header).encode()
+        self.trace = bytearray(self.MAGIC + struct.pack("<I", len(header)) + header)
+        self.strings = {}
+        self.ledger_start = {kind: self.university.ledger.total(kind) for kind in Ledger.KINDS}
+        self.calls = 0
+        for code, (class_name, method_name, kinds) in self.OPERATIONS.items():
+            cls = globals()[class_name]
+            original = cls.__dict__[method_name]
+            self.originals[(cls, method_name)] = original
+            setattr(cls, method_name, self.wrap(code, method_name, kinds, original))
+        self.enabled = True
         
+    def stop(self):
+        """Puts the original methods back and ends the trace with the fingerprint of the final state.
+
         Returns:
-            tuple: A tuple containing the total revenue and the revenue by cafeteria as a dictionary
+            bytes: the trace
         """
-        total_revenue = 0
-        revenue_by_cafeteria = {}  
-        for cafeteria in self.cafeterias:
-            total_revenue += cafeteria.revenue
+        for (cls, method_name), original in self.originals.items():
+            setattr(cls, method_name, original)
+        self.originals = {}
+        self.enabled = False
+        self.trace += struct.pack("<B", self.END) + state_fingerprint(self.university, self.ledger_start)
+        return bytes(self.trace)
+    
+    def save(self, path):
+        with open(path, "wb") as file:
+            file.write(self.trace)
             
-            revenue_by_cafeteria[cafeteria.name] = cafeteria.close_cafeteria()
-        return total_revenue, revenue_by_cafeteria
+    def string(self, value):
+        """Returns the position of a string in the string table and adds it first if it is new."""
+        if value not in self.strings:
+            data = value.encode()
+            self.trace += struct.pack("<BI", self.STRING, len(data)) + data
+            self.strings[value] = len(self.strings)
+        return self.strings[value]
+    
+    def write(self, code, kinds, arguments):
+        """Appends the record of a call with outcome 0 and returns its position, so the outcome can be filled in afterwards."""
+        fields = []
+        for kind, argument in zip(kinds, arguments):
+            if kind == "u":
+                continue
+            elif kind == "c":
+                fields += [self.CUSTOMER_TYPES.index(argument.customer_type), argument.customer_id]
+            elif kind == "k":
+                fields.append(self.string(argument.name))
+            elif kind == "s":
+                fields.append(self.string(str(argument)))
+            elif kind == "j":
+                fields.append(self.string(json.dumps(argument)))
+            elif kind == "n":
+                fields.append(math.nan if argument == None else argument)
+            else:
+                fields.append(argument)
+        position = len(self.trace)
+        self.trace += struct.pack("<BB" + "".join(self.FORMATS[kind] for kind in kinds), code, 0, *fields)
+        self.calls += 1
+        return position
         
+    def wrap(self, code, method_name, kinds, function):
+        signature = inspect.signature(function)
+        
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            depth = getattr(self.local, "depth", 0)
+            university = args[0] if isinstance(args[0], University) else args[0].university
+            if university is not self.university or (depth > 0 and method_name not in self.NESTED):
+                return function(*args, **kwargs)
+            arguments = signature.bind(*args, **kwargs)
+            arguments.apply_defaults()
+            with self.lock:
+                position = self.write(code, kinds, list(arguments.arguments.values()))
+                self.local.depth = depth + 1
+                try:
+                    return function(*args, **kwargs)
+                except Exception as error:
+                    self.trace[position + 1] = self.outcome(error)
+                    raise
+                finally:
+                    self.local.depth = depth
+        return wrapper
+
+
+def replay_trace(trace, check=True):
+    """Builds a fresh university from the start of a trace and replays all recorded calls as fast as possible.
 
+    Args:
+        trace (bytes or String): the trace or the path of a trace file
+        check (bool): whether to check the outcome of every call and the final state
+
+    Returns:
+        tuple: A tuple containing the university, the number of calls and the seconds the calls took
+    """
+    if isinstance(trace, str):
+        with open(trace, "rb") as file:
+            trace = file.read()
+    assert trace.startswith(TraceRecorder.MAGIC), "Not a trace file"
+    position = len(TraceRecorder.MAGIC)
+    length = struct.unpack_from("<I", trace, position)[0]
+    position += 4
+    header = json.loads(trace[position:position + length])
+    position += length
+    
+    university = University(header["name"])
+    for details in header["cafeterias"]:
+        cafeteria = university.add_cafeteria(details["name"])
+        cafeteria.upload_menu(details["menu"])
+        cafeteria.revenue_ore = details["revenue_ore"]
+    customers = {}
+    for customer_type, name, customer_id, balance_ore in header["customers"]:
+        customer = university.add_student(name, customer_id) if customer_type == "Student" else university.add_staff(name, customer_id)
+        customer.balance_ore = balance_ore
+        customers[(TraceRecorder.CUSTOMER_TYPES.index(customer_type), customer_id)] = customer
+    #the replay hands out the recorded order ids, and the universities of this process continue with their own ids afterwards
+    with Order.counter_lock:
+        saved_ids = (Order.class_counter, Order.id_step)
+        Order.class_counter = header["order_counter"]
+        Order.id_step = header["id_step"]
+    try:
+        #the calls are decoded first, so only the calls themselves are timed
+        strings = []
+        calls = []
+        fingerprint = None
+        while position < len(trace):
+            code = trace[position]
+            if code == TraceRecorder.STRING:
+                length = struct.unpack_from("<I", trace, position + 1)[0]
+                strings.append(trace[position + 5:position + 5 + length].decode())
+                position += 5 + length
+                continue
+            if code == TraceRecorder.END:
+                fingerprint = trace[position + 1:position + 33]
+                break
+            class_name, method_name, kinds = TraceRecorder.OPERATIONS[code]
+            record = struct.Struct("<BB" + "".join(TraceRecorder.FORMATS[kind] for kind in kinds))
+            fields = list(record.unpack_from(trace, position)[2:])
+            position += record.size
+            arguments = []
+            for kind in kinds:
+                if kind == "u":
+                    arguments.append(university)
+                elif kind == "c":
+                    arguments.append(customers[(fields.pop(0), fields.pop(0))])
+                elif kind == "k":
+                    arguments.append(university.get_cafeteria(strings[fields.pop(0)]))
+                elif kind == "s":
+                    arguments.append(strings[fields.pop(0)])
+                elif kind == "j":
+                    arguments.append(json.loads(strings[fields.pop(0)]))
+                elif kind == "n":
+                    value = fields.pop(0)
+                    arguments.append(None if math.isnan(value) else int(value) if value.is_integer() else value)
+                else:
+                    arguments.append(fields.pop(0))
+            calls.append((getattr(arguments[0], method_name), arguments[1:], trace[position - record.size + 1]))
+        
+        start = time.perf_counter()
+        for number, (method, arguments, outcome) in enumerate(calls):
+            try:
+                method(*arguments)
+                result = 0
+            except Exception as error:
+                result = TraceRecorder.outcome(error)
+            if check and result != outcome:
+                raise ValueError(f"Replay diverged at call {number}: {method.__name__}{tuple(arguments)} had outcome {result} instead of {outcome}")
+        seconds = time.perf_counter() - start
+        if check and fingerprint != None and state_fingerprint(university) != fingerprint:
+            raise ValueError("The final state of the replay differs from the recording")
+    finally:
+        with Order.counter_lock:
+            Order.class_counter, Order.id_step = saved_ids
+    return university, len(calls), seconds
 
 
 # %% [markdown]
@@ -764,16 +4103,16 @@ class University:
 # Testing Playground.
 
 # %%
-def setup_example():
+def setup_example(n_students=1000, n_staff=100, compact_accounts=False):
    #creating a university
-   university = University("CBS")
+   university = University("CBS", compact_accounts)
 
    #adding a cafeteria to the university
    university.add_cafeteria("Solbjerg Plads")
    university.add_cafeteria("Dalgas Have")
    university.add_cafeteria("Kilen")
    university.add_cafeteria("Porcelænshaven")
-   university.generate_customers(1000,100)
+   university.generate_customers(n_students,n_staff)
    return university
 
 def upload_example_menus(university):
@@ -809,8 +4148,694 @@ def upload_example_menus(university):
    university.cafeterias[2].upload_menu(daily_menu|reduced_menu)
    university.cafeterias[3].upload_menu(daily_menu|drink_menu)
 
+def stress_test_orders(n_threads=8, orders_per_thread=500, stock=1000):
+   """Lets several threads place, cancel and complete orders at the same time and checks that no item is oversold and no money is lost.
+
+   Args:
+      n_threads (int): number of tills placing orders at the same time
+      orders_per_thread (int): number of orders every till tries to place
+      stock (int): the initial stock of the single item on the menu
+
+   Returns:
+      tuple: A tuple containing the number of placed orders and the number of failed orders
+   """
+   university = University("Stress")
+   cafeteria = university.add_cafeteria("Kilen")
+   cafeteria.add_item("Coffee", "A standard filter.", 25, stock)
+   customers = [university.add_student(f"Student {i+1}", i) for i in range(20)]
+   for customer in customers:
+      customer.add_balance(10000)
+   initial_money = sum(customer.balance_ore for customer in customers)
+   placed = []
+   failed = []
+
+   def till(seed):
+      rng = random.Random(seed)
+      for _ in range(orders_per_thread):
+         customer = rng.choice(customers)
+         try:
+            message, order = customer.place_order("Kilen", "Coffee", rng.randint(1, 3))
+         except ValueError:
+            failed.append(1)
+            continue
+         placed.append(1)
+         if rng.random() < 0.2:
+            cafeteria.cancel_order(order.order_id)
+         elif rng.random() < 0.5:
+            cafeteria.complete_order(order.order_id)
+
+   threads = [threading.Thread(target=till, args=(seed,)) for seed in range(n_threads)]
+   for thread in threads:
+      thread.start()
+   for thread in threads:
+      thread.join()
+
+   #every coffee is either still in stock, waiting in an open order or sold
+   open_quantity = sum(order.quantity for order in cafeteria.orders.values())
+   sold_quantity = sum(customer_order.quantity for customer in customers for customer_order in customer.orders if customer_order.status == "Completed")
+   assert cafeteria.menu["Coffee"]['quantity'] >= 0, "Coffee was oversold"
+   assert cafeteria.menu["Coffee"]['quantity'] + open_quantity + sold_quantity == stock, "Stock was lost or oversold"
+   #every øre is either on a balance, in an open order or in the revenue
+   open_money = sum(order.price_ore for order in cafeteria.orders.values())
+   assert sum(customer.balance_ore for customer in customers) + open_money + cafeteria.revenue_ore == initial_money, "Balance was lost"
+   order_ids = [customer_order.order_id for customer in customers for customer_order in customer.orders]
+   assert len(order_ids) == len(set(order_ids)), "Order ids were handed out twice"
+   return len(placed), len(failed)
+
+def shared_till(inventory, customers, items, orders, seed, sold):
+   rng = random.Random(seed)
+   taken = {}
+   paid = 0
+   for _ in range(orders):
+      customer_id, discount = rng.choice(customers)
+      cafeteria_name, item = rng.choice(items)
+      quantity = rng.randint(1, 3)
+      try:
+         paid += inventory.take_order(customer_id, discount, cafeteria_name, item, quantity)
+      except ValueError:
+         continue
+      taken[(cafeteria_name, item)] = taken.get((cafeteria_name, item), 0) + quantity
+   sold.put((taken, paid))
+   inventory.close()
+
+def stress_test_shared_inventory(n_processes=4, orders_per_process=2000):
+   """Lets several processes take orders against the same shared stock and balances and checks that nothing is oversold and no money is lost.
+
+   Returns:
+      int: The number of items sold
+   """
+   university = setup_example()
+   upload_example_menus(university)
+   customers = university.all_customers()[:50]
+   for customer in customers:
+      customer.add_balance(300)
+   inventory = SharedInventory(university)
+   initial_stock = {key: inventory.stock.get(key) for key in inventory.stock.slots}
+   initial_money = sum(inventory.balances.get(customer.customer_id) for customer in customers)
+   sold = multiprocessing.Queue()
+   arguments = ([(customer.customer_id, customer.discount) for customer in customers], list(initial_stock), orders_per_process)
+   processes = [multiprocessing.Process(target=shared_till, args=(inventory,) + arguments + (seed, sold)) for seed in range(n_processes)]
+   for process in processes:
+      process.start()
+   results = [sold.get() for _ in processes]
+   for process in processes:
+      process.join()
+      
+   total_sold = {}
+   for taken, _ in results:
+      for key, quantity in taken.items():
+         total_sold[key] = total_sold.get(key, 0) + quantity
+   total_paid = sum(paid for _, paid in results)
+   for key, quantity in initial_stock.items():
+      assert inventory.stock.get(key) >= 0, f"{key} was oversold"
+      assert inventory.stock.get(key) + total_sold.get(key, 0) == quantity, f"Stock of {key} was lost or oversold"
+   final_money = sum(inventory.balances.get(customer.customer_id) for customer in customers)
+   assert all(inventory.balances.get(customer.customer_id) >= 0 for customer in customers), "A balance went below 0"
+   assert initial_money == final_money + total_paid, "Money was lost or created"
+   debits = university.ledger.total("debit")
+   revenue = sum(cafeteria.revenue_ore for cafeteria in university.cafeterias)
+   popularity = sum(sum(cafeteria.item_popularity.values()) for cafeteria in university.cafeterias)
+   inventory.write_back(university)
+   inventory.close()
+   assert sum(customer.balance_ore for customer in customers) == final_money, "The balances were not written back"
+   assert university.ledger.total("debit") - debits == total_paid, "The ledger does not add up"
+   assert sum(cafeteria.revenue_ore for cafeteria in university.cafeterias) - revenue == total_paid, "The sales were not booked as revenue"
+   assert sum(sum(cafeteria.item_popularity.values()) for cafeteria in university.cafeterias) - popularity == sum(total_sold.values()), "The sales were not booked in the popularity"
+   for (cafeteria_name, item), quantity in initial_stock.items():
+      assert university.get_cafeteria(cafeteria_name).menu[item]['quantity'] == quantity - total_sold.get((cafeteria_name, item), 0), "The stock was not written back"
+   return sum(total_sold.values())
+
+def measure_account_memory(n_accounts=10000, compact_accounts=False):
+   """Measures the memory of idle students with tracemalloc.
+
+   Returns:
+      float: The bytes per account
+   """
+   random.seed(0)
+   tracemalloc.start()
+   before = tracemalloc.get_traced_memory()[0]
+   university = University("Memory", compact_accounts)
+   university.generate_customers(n_accounts, 0)
+   used = tracemalloc.get_traced_memory()[0] - before
+   tracemalloc.stop()
+   return used / n_accounts
+
+def test_iterators():
+   """Checks the streaming iterators against the lists they replace and that they can stop early, with and without compact accounts."""
+   for compact_accounts in (False, True):
+      university = setup_example(100, 10, compact_accounts)
+      upload_example_menus(university)
+      menu = university.view_sorted_menu()
+      assert list(university.iter_sorted_menu("C", "P")) == [entry for entry in menu if "C" <= entry["item"] < "P"]
+      assert next(university.iter_sorted_menu(where=lambda entry: entry["cafeteria"] == "Kilen"))["cafeteria"] == "Kilen"
+      for entry in menu:
+         assert list(university.iter_search(entry["item"])) == university.search_menu(entry["item"])
+      assert list(university.iter_customers()) == university.all_customers()
+      assert all(customer.customer_type == "Staff" for customer in university.iter_customers("Staff"))
+      try:
+         next(university.iter_customers("Guest"))
+         raise AssertionError("An unknown customer type was accepted")
+      except ValueError:
+         pass
+      
+      customer = university.students[0]
+      cafeteria = university.cafeterias[0]
+      assert list(customer.iter_orders()) == []
+      customer.add_balance(500)
+      orders = [customer.place_order(cafeteria.name, item, 1)[1] for item in ["Coffee", "Tea", "Chips"]]
+      cafeteria.complete_order(orders[0].order_id)
+      assert list(customer.iter_orders()) == customer.view_orders() == orders
+      assert list(customer.iter_orders("Completed")) == [orders[0]]
+      assert list(cafeteria.iter_orders(customer_id=customer.customer_id)) == orders[1:]
+      
+      #completing an order shows the live stock on the sorted menu and does not bring back a removed item
+      coffee = next(university.iter_search("Coffee", where=lambda match: match[0] == cafeteria.name))
+      assert coffee[3] == cafeteria.menu["Coffee"]["quantity"]
+      cafeteria.remove_item("Tea")
+      cafeteria.complete_order(orders[1].order_id)
+      assert list(university.iter_search("Tea", where=lambda match: match[0] == cafeteria.name)) == []
+
+def test_record_replay(days=3, orders_per_day=200):
+   """Records a few simulated days with a restock engine and replays them on a fresh university.
+
+   Returns:
+      tuple: The number of replayed calls and the seconds they took
+   """
+   university = setup_example()
+   recorder = TraceRecorder(university)
+   recorder.start()
+   for cafeteria in university.cafeterias:
+      RestockEngine(cafeteria, [ReorderPointPolicy(3, 15)])
+   for _ in range(days):
+      upload_example_menus(university)
+      university.simulate_day(orders_per_day)
+      #batches, baskets and orders placed anywhere are recorded as well
+      customers = university.all_customers()
+      university.place_orders_batch([(customer.customer_id, cafeteria.name, item, 1) for customer, cafeteria in zip(customers, university.cafeterias) for item in list(cafeteria.menu)[:2]])
+      for customer, cafeteria in zip(customers[-2:], university.cafeterias):
+         try:
+            customer.place_basket_order(cafeteria.name, {item: 1 for item in list(cafeteria.menu)[:2]})
+            customer.place_order_anywhere(next(iter(cafeteria.menu)), 1)
+         except ValueError:
+            pass
+      for cafeteria in university.cafeterias:
+         for order in list(cafeteria.orders.values()):
+            cafeteria.complete_order(order.order_id)
+   trace = recorder.stop()
+   replayed, calls, seconds = replay_trace(trace)
+   assert state_fingerprint(replayed) == state_fingerprint(university, recorder.ledger_start), "Replay does not match the recording"
+   return calls, seconds
+
+
+
+
+
+# %% [markdown]
+# #### Benchmarks
+# 
+# A reproducible benchmark of the main operations for growing numbers of customers, cafeterias, menu items and orders. Every case is timed call by call for the throughput and the latency percentiles and is run a second time with tracemalloc for the peak memory. The results can be saved as JSON and compared against a saved baseline to spot regressions.
+
+# %%
+BENCHMARK_SCALES = {
+    "small": {"n_students": 1000, "n_staff": 100, "n_cafeterias": 4, "menu_size": 20, "n_orders": 500},
+    "large": {"n_students": 5000, "n_staff": 500, "n_cafeterias": 8, "menu_size": 100, "n_orders": 2000},
+}
+
+def build_benchmark_university(n_students, n_staff, n_cafeterias, menu_size, n_orders, seed=0):
+    """Builds a university of the given size with generated menus and funded customers.
+
+    Returns:
+        University: the generated university
+    """
+    random.seed(seed)
+    university = University("Benchmark")
+    for i in range(n_cafeterias):
+        university.add_cafeteria(f"Cafeteria {i+1}")
+    university.generate_customers(n_students, n_staff)
+    for customer in university.all_customers():
+        customer.add_balance(100000)
+    items = [f"Item {i:05d}" for i in range(menu_size * 2)]
+    for cafeteria in university.cafeterias:
+        menu = {}
+        for item in random.sample(items, menu_size):
+            menu[item] = {"description": f"The {item}", "price": random.randint(5, 60), "quantity": n_orders * 10}
+        cafeteria.upload_menu(menu)
+    return university
+
+def place_benchmark_orders(university, n_orders):
+    """Places n_orders random orders and returns the (cafeteria, order) pairs."""
+    customers = university.all_customers()
+    orders = []
+    for _ in range(n_orders):
+        cafeteria = random.choice(university.cafeterias)
+        message, order = random.choice(customers).place_order(cafeteria.name, random.choice(list(cafeteria.menu.keys())), random.randint(1, 3))
+        orders.append((cafeteria, order))
+    return orders
+
+# Every case prepares a university and returns the calls to be timed. Preparing is not timed.
+def benchmark_get_customer(university, n_orders):
+    ids = [customer.customer_id for customer in university.all_customers()]
+    return [lambda customer_id=random.choice(ids): university.get_customer(customer_id) for _ in range(n_orders)]
+
+def benchmark_sort_menu(university, n_orders):
+    def sort():
+        university.invalidate_sorted_menu()
+        university.sort_menu()
+    return [sort for _ in range(max(1, n_orders // 500))]
+
+def benchmark_search_menu(university, n_orders):
+    university.sort_menu()
+    names = [item[0] for item in university.sorted_menu] + ["Not on the menu"]
+    return [lambda name=random.choice(names): university.search_menu(name) for _ in range(n_orders)]
+
+def benchmark_update_sorted_menu(university, n_orders):
+    university.sort_menu()
+    calls = []
+    for _ in range(n_orders):
+        cafeteria = random.choice(university.cafeterias)
+        item = random.choice(list(cafeteria.menu.keys()))
+        calls.append(lambda item=item, cafeteria=cafeteria: university.update_sorted_menu(item, random.randint(1, 50), cafeteria.name))
+    return calls
+
+def benchmark_popular_items(university, n_orders):
+    place_benchmark_orders(university, n_orders)
+    return [lambda cafeteria=random.choice(university.cafeterias): cafeteria.popular_items(5) for _ in range(n_orders)]
+
+def benchmark_complete_order(university, n_orders):
+    return [lambda cafeteria=cafeteria, order=order: cafeteria.complete_order(order.order_id) for cafeteria, order in place_benchmark_orders(university, n_orders)]
+
+def benchmark_cancel_order(university, n_orders):
+    return [lambda cafeteria=cafeteria, order=order: cafeteria.cancel_order(order.order_id) for cafeteria, order in place_benchmark_orders(university, n_orders)]
+
+def benchmark_close_university(university, n_orders):
+    place_benchmark_orders(university, n_orders)
+    return [university.close_university]
+
+def benchmark_simulate_day(university, n_orders):
+    return [lambda: university.simulate_day(max(5, n_orders // len(university.cafeterias))) for _ in range(5)]
+
+BENCHMARK_CASES = {
+    "get_customer": benchmark_get_customer,
+    "sort_menu": benchmark_sort_menu,
+    "search_menu": benchmark_search_menu,
+    "update_sorted_menu": benchmark_update_sorted_menu,
+    "popular_items": benchmark_popular_items,
+    "complete_order": benchmark_complete_order,
+    "cancel_order": benchmark_cancel_order,
+    "close_university": benchmark_close_university,
+    "simulate_day": benchmark_simulate_day,
+}
+
+def percentile(values, p):
+    """Returns the p-th percentile (0-100) of the values using the nearest rank."""
+    ordered = sorted(values)
+    if not ordered:
+        return 0
+    return ordered[min(len(ordered) - 1, max(0, round(p / 100 * len(ordered)) - 1))]
+
+def run_benchmark_case(case, scale, seed=0):
+    """Runs one benchmark case on one scale.
 
+    Args:
+        case (String): the name of the case in BENCHMARK_CASES
+        scale (dict): the size of the university, see BENCHMARK_SCALES
+        seed (int): the seed for the generated university and calls
 
+    Returns:
+        dict: A dictionary with the number of calls, throughput, latency percentiles in microseconds and peak memory in bytes
+    """
+    university = build_benchmark_university(seed=seed, **scale)
+    calls = BENCHMARK_CASES[case](university, scale["n_orders"])
+    latencies = []
+    start = time.perf_counter()
+    for call in calls:
+        call_start = time.perf_counter()
+        call()
+        latencies.append(time.perf_counter() - call_start)
+    duration = time.perf_counter() - start
+    
+    #second run on a fresh university to measure the memory without slowing down the timed run
+    university = build_benchmark_university(seed=seed, **scale)
+    calls = BENCHMARK_CASES[case](university, scale["n_orders"])
+    tracemalloc.start()
+    for call in calls:
+        call()
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {
+        "calls": len(calls),
+        "throughput": len(calls) / duration if duration > 0 else 0,
+        "p50_us": percentile(latencies, 50) * 1e6,
+        "p95_us": percentile(latencies, 95) * 1e6,
+        "p99_us": percentile(latencies, 99) * 1e6,
+        "peak_memory_bytes": peak_memory,
+    }
+
+def run_benchmarks(scales=None, cases=None, seed=0):
+    """Runs the benchmark cases on all scales.
+
+    Args:
+        scales (dict): the scales to be run, defaults to BENCHMARK_SCALES
+        cases (list): the names of the cases to be run, defaults to all cases
+        seed (int): the seed for the generated universities and calls
+
+    Returns:
+        dict: A dictionary with "scale/case" as keys and the results of run_benchmark_case as values
+    """
+    scales = BENCHMARK_SCALES if scales == None else scales
+    cases = list(BENCHMARK_CASES) if cases == None else cases
+    results = {}
+    for scale_name, scale in scales.items():
+        for case in cases:
+            results[f"{scale_name}/{case}"] = run_benchmark_case(case, scale, seed)
+    return results
+
+def compare_benchmarks(results, baseline, tolerance=0.2):
+    """Compares benchmark results against a baseline.
+
+    Args:
+        results (dict): the current results of run_benchmarks
+        baseline (dict): the saved results of an earlier run
+        tolerance (float): the allowed relative slowdown or memory growth before a case counts as a regression
+
+    Returns:
+        list: A list of messages, one for every regression
+    """
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        old = baseline[name]
+        if result["throughput"] < old["throughput"] * (1 - tolerance):
+            regressions.append(f"{name}: throughput dropped from {old['throughput']:.0f}/s to {result['throughput']:.0f}/s")
+        if result["p95_us"] > old["p95_us"] * (1 + tolerance):
+            regressions.append(f"{name}: p95 latency rose from {old['p95_us']:.1f}us to {result['p95_us']:.1f}us")
+        if result["peak_memory_bytes"] > old["peak_memory_bytes"] * (1 + tolerance):
+            regressions.append(f"{name}: peak memory rose from {old['peak_memory_bytes']} to {result['peak_memory_bytes']} bytes")
+    return regressions
+
+def benchmark_main(output=None, baseline=None, scales=None, cases=None, tolerance=0.2):
+    """Runs the benchmarks, prints and saves the results as JSON and compares them against a baseline file.
+
+    Returns:
+        list: A list of messages, one for every regression
+    """
+    if scales != None:
+        scales = {name: BENCHMARK_SCALES[name] for name in scales}
+    results = run_benchmarks(scales, cases)
+    print(json.dumps(results, indent=2))
+    if output != None:
+        with open(output, "w") as file:
+            json.dump(results, file, indent=2)
+    regressions = []
+    if baseline != None:
+        with open(baseline) as file:
+            regressions = compare_benchmarks(results, json.load(file), tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+    return regressions
+
+
+# %% [markdown]
+# #### Load Generator
+# 
+# A load generator for the command line. A scenario describes the university (number of students and staff, the menus, the starting balance and how the cafeterias restock) and the traffic (the share of students, staff and guests, the arrival rate, the probabilities of cancelling and picking up orders and the duration). Values missing in a scenario file are taken from DEFAULT_SCENARIO, which is the example university.
+# 
+# Every arriving customer starts a session: students and staff view a menu, sometimes top up, place an order and then cancel it or have it completed and possibly pick it up; guests can only search the menu. The load can be sent to the model in the same process or to a running service. In the open-loop mode, sessions arrive at random times with the given rate no matter how fast they are handled, which shows how the latency grows under a fixed load. In the closed-loop mode, a fixed number of clients start their next session as soon as the last one is done, which shows the highest throughput. The report contains the throughput and the latency percentiles for every interval and every operation.
+
+# %%
+DEFAULT_SCENARIO = {
+    "seed": 0,
+    "students": 1000,
+    "staff": 100,
+    #cafeteria name -> menu, None uses the example menus
+    "menus": None,
+    "starting_balance": 500,
+    #None turns restocking off
+    "restock": {"reorder_point": 3, "order_up_to": 30},
+    "mix": {"Student": 0.8, "Staff": 0.15, "Guest": 0.05},
+    #sessions per second in the open-loop mode
+    "arrival_rate": 200,
+    #concurrent clients in the closed-loop mode and connections to a service
+    "clients": 10,
+    "think_time": 0,
+    "top_up_probability": 0.2,
+    "cancel_probability": 0.1,
+    "pickup_probability": 0.7,
+    "max_quantity": 3,
+    "duration": 10,
+    "interval": 1,
+}
+
+def load_scenario(path=None, **overrides):
+    """Reads a scenario from a JSON file. Missing values are taken from DEFAULT_SCENARIO, values that are not None in overrides win over both.
+
+    Returns:
+        dict: the scenario
+    """
+    scenario = copy.deepcopy(DEFAULT_SCENARIO)
+    if path != None:
+        with open(path) as file:
+            scenario.update(json.load(file))
+    scenario.update({key: value for key, value in overrides.items() if value != None})
+    unknown = set(scenario) - set(DEFAULT_SCENARIO)
+    assert not unknown, f"Unknown scenario settings: {sorted(unknown)}"
+    assert set(scenario["mix"]) <= {"Student", "Staff", "Guest"} and sum(scenario["mix"].values()) > 0, "Mix should give shares of Student, Staff and Guest"
+    for key in ("top_up_probability", "cancel_probability", "pickup_probability"):
+        assert 0 <= scenario[key] <= 1, f"{key} should be between 0 and 1"
+    assert scenario["arrival_rate"] > 0 and scenario["clients"] > 0 and scenario["duration"] > 0 and scenario["interval"] > 0, "Rates, clients and times should be greater than 0"
+    return scenario
+
+def build_scenario_university(scenario):
+    """Builds the university of a scenario from the example university. The same scenario always gives the same customers.
+
+    Returns:
+        University: the university
+    """
+    random.seed(scenario["seed"])
+    university = setup_example(scenario["students"], scenario["staff"])
+    if scenario["menus"] == None:
+        upload_example_menus(university)
+    else:
+        for cafeteria_name, menu in scenario["menus"].items():
+            cafeteria = university.get_cafeteria(cafeteria_name)
+            if cafeteria == None:
+                cafeteria = university.add_cafeteria(cafeteria_name)
+            cafeteria.upload_menu(menu)
+    if scenario["starting_balance"] > 0:
+        for customer in university.all_customers():
+            customer.add_balance(scenario["starting_balance"])
+    if scenario["restock"] != None:
+        for cafeteria in university.cafeterias:
+            RestockEngine(cafeteria, [ReorderPointPolicy(scenario["restock"]["reorder_point"], scenario["restock"]["order_up_to"])])
+    return university
+
+
+class InProcessTarget:
+    def __init__(self, university):
+        """Sends the requests of the load generator straight to the model in this process. The requests and responses are the same as for the service."""
+        self.university = university
+        self.customers = university.customers_by_id()
+        
+    async def open(self):
+        pass
+    
+    async def close(self):
+        pass
+    
+    async def call(self, request):
+        arguments = dict(request)
+        action = getattr(self, arguments.pop("action"))
+        try:
+            return {"ok": True, "result": action(**arguments)}
+        except (ValueError, PermissionError, AssertionError, TypeError) as e:
+            return {"ok": False, "error": str(e)}
+        
+    def place_order(self, customer_id, cafeteria_name, item, quantity):
+        message, order = self.customers[customer_id].place_order(cafeteria_name, item, quantity)
+        return {"message": message, "order_id": order.order_id, "quantity": order.quantity, "price": order.price}
+    
+    def complete_order(self, cafeteria_name, order_id):
+        return self.university.get_cafeteria(cafeteria_name).complete_order(order_id)
+    
+    def cancel_order(self, cafeteria_name, order_id):
+        return self.university.get_cafeteria(cafeteria_name).cancel_order(order_id)
+    
+    def pick_up_order(self, customer_id, order_id):
+        return self.customers[customer_id].pick_up_order(order_id)
+    
+    def add_balance(self, customer_id, amount):
+        return self.customers[customer_id].add_balance(amount)
+    
+    def view_menu(self, customer_id, cafeteria_name):
+        return self.customers[customer_id].view_menu(cafeteria_name)
+    
+    def search_menu(self, item):
+        return self.university.search_menu(item)
+    
+
+class EndpointTarget:
+    def __init__(self, host, port, connections=10):
+        """Sends the requests of the load generator to a running AsyncService over a pool of connections."""
+        self.host = host
+        self.port = port
+        self.connections = connections
+        self.pool = None
+        
+    async def open(self):
+        self.pool = asyncio.Queue()
+        for _ in range(self.connections):
+            self.pool.put_nowait(await asyncio.open_connection(self.host, self.port))
+            
+    async def close(self):
+        while not self.pool.empty():
+            reader, writer = self.pool.get_nowait()
+            writer.close()
+            await writer.wait_closed()
+    
+    async def call(self, request):
+        reader, writer = await self.pool.get()
+        try:
+            writer.write(json.dumps(request).encode() + b"\n")
+            await writer.drain()
+            return json.loads(await reader.readline())
+        finally:
+            self.pool.put_nowait((reader, writer))
+
+
+async def run_load(scenario, target, mode="open"):
+    """Drives a target with the traffic of a scenario.
+
+    Args:
+        scenario (dict): the scenario, see load_scenario
+        target (InProcessTarget or EndpointTarget): where the requests are sent
+        mode (String): "open" for sessions arriving at the arrival rate, "closed" for clients running sessions one after another
+
+    Returns:
+        list: A list of samples (seconds since the start, operation, latency in seconds, whether it succeeded)
+    """
+    assert mode in ("open", "closed"), "Mode should be open or closed"
+    #the local copy of the university is only used to pick customers, cafeterias and items
+    university = build_scenario_university(scenario)
+    customers = {customer_type: [customer.customer_id for customer in university.all_customers() if customer.customer_type == customer_type] for customer_type in ("Student", "Staff")}
+    menus = {cafeteria.name: list(cafeteria.menu) for cafeteria in university.cafeterias if cafeteria.menu}
+    items = sorted({item for menu in menus.values() for item in menu})
+    mix = [(customer_type, share) for customer_type, share in scenario["mix"].items() if share > 0 and (customer_type == "Guest" or customers[customer_type])]
+    rng = random.Random(scenario["seed"])
+    samples = []
+    
+    async def timed(request):
+        start = time.perf_counter()
+        response = await target.call(request)
+        samples.append((start - began, request["action"], time.perf_counter() - start, response["ok"]))
+        return response
+    
+    async def session(rng):
+        customer_type = rng.choices([entry[0] for entry in mix], [entry[1] for entry in mix])[0]
+        if customer_type == "Guest":
+            await timed({"action": "search_menu", "item": rng.choice(items)})
+            return
+        customer_id = rng.choice(customers[customer_type])
+        cafeteria_name = rng.choice(list(menus))
+        await timed({"action": "view_menu", "customer_id": customer_id, "cafeteria_name": cafeteria_name})
+        if rng.random() < scenario["top_up_probability"]:
+            await timed({"action": "add_balance", "customer_id": customer_id, "amount": rng.randint(50, 500)})
+        response = await timed({"action": "place_order", "customer_id": customer_id, "cafeteria_name": cafeteria_name,
+                                "item": rng.choice(menus[cafeteria_name]), "quantity": rng.randint(1, scenario["max_quantity"])})
+        if not response["ok"]:
+            return
+        order_id = response["result"]["order_id"]
+        if rng.random() < scenario["cancel_probability"]:
+            await timed({"action": "cancel_order", "cafeteria_name": cafeteria_name, "order_id": order_id})
+            return
+        await timed({"action": "complete_order", "cafeteria_name": cafeteria_name, "order_id": order_id})
+        if rng.random() < scenario["pickup_probability"]:
+            await timed({"action": "pick_up_order", "customer_id": customer_id, "order_id": order_id})
+            
+    async def client(rng):
+        while time.perf_counter() < deadline:
+            await session(rng)
+            #gives the other clients a turn even if the target never has to wait
+            await asyncio.sleep(rng.expovariate(1 / scenario["think_time"]) if scenario["think_time"] > 0 else 0)
+    
+    await target.open()
+    began = time.perf_counter()
+    deadline = began + scenario["duration"]
+    try:
+        if mode == "closed":
+            await asyncio.gather(*(client(random.Random(rng.random())) for _ in range(scenario["clients"])))
+        else:
+            sessions = []
+            arrival = began
+            while True:
+                arrival += rng.expovariate(scenario["arrival_rate"])
+                if arrival >= deadline:
+                    break
+                await asyncio.sleep(max(0, arrival - time.perf_counter()))
+                sessions.append(asyncio.create_task(session(random.Random(rng.random()))))
+            await asyncio.gather(*sessions)
+    finally:
+        await target.close()
+    return samples
+
+def load_statistics(samples, duration):
+    latencies = [sample[2] for sample in samples]
+    return {"requests": len(samples),
+            "errors": sum(1 for sample in samples if not sample[3]),
+            "throughput": len(samples) / duration if duration > 0 else 0,
+            "p50_ms": percentile(latencies, 50) * 1e3,
+            "p95_ms": percentile(latencies, 95) * 1e3,
+            "p99_ms": percentile(latencies, 99) * 1e3}
+
+def load_report(samples, duration, interval=1):
+    """Summarises the samples of a load run over all, per operation and per interval.
+
+    Args:
+        samples (list): the samples returned by run_load
+        duration (float): the duration of the run in seconds
+        interval (float): the length of the intervals in seconds
+
+    Returns:
+        dict: A dictionary with the "total", the statistics per operation and a list of the statistics per interval
+    """
+    operations = {}
+    #the samples are put into their operation and interval in one pass
+    windows = [[] for _ in range(math.ceil(duration / interval))]
+    for sample in samples:
+        operations.setdefault(sample[1], []).append(sample)
+        i = int(sample[0] // interval)
+        if 0 <= i < len(windows):
+            windows[i].append(sample)
+    intervals = [dict(load_statistics(window, min(interval, duration - i * interval)), start=i * interval) for i, window in enumerate(windows)]
+    return {"total": load_statistics(samples, duration),
+            "operations": {name: load_statistics(operation, duration) for name, operation in sorted(operations.items())},
+            "intervals": intervals}
+
+def print_load_report(report):
+    print(f"{'':>16} {'requests':>9} {'errors':>7} {'req/s':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    rows = [(f"t={entry['start']:g}s", entry) for entry in report["intervals"]] + list(report["operations"].items()) + [("total", report["total"])]
+    for name, entry in rows:
+        print(f"{name:>16} {entry['requests']:>9} {entry['errors']:>7} {entry['throughput']:>9.0f} {entry['p50_ms']:>8.3f} {entry['p95_ms']:>8.3f} {entry['p99_ms']:>8.3f}")
+
+def load_main(scenario_path=None, mode="open", endpoint=None, output=None, **overrides):
+    """Runs a scenario against the model in this process or against a service at "host:port", prints the report and saves it as JSON.
+
+    Returns:
+        dict: the report
+    """
+    scenario = load_scenario(scenario_path, **overrides)
+    if endpoint == None:
+        target = InProcessTarget(build_scenario_university(scenario))
+    else:
+        host, port = endpoint.rsplit(":", 1)
+        target = EndpointTarget(host, int(port), scenario["clients"])
+    samples = asyncio.run(run_load(scenario, target, mode))
+    report = load_report(samples, scenario["duration"], scenario["interval"])
+    print_load_report(report)
+    if output != None:
+        with open(output, "w") as file:
+            json.dump(report, file, indent=2)
+    return report
 
 
 # %% [markdown]
@@ -1033,7 +5058,7 @@ class GUI:
         Label(self.window, text=f"Place Order for {item} at {cafeteria.name}", font=("Arial", 20)).pack()
         Label(self.window, text=f"Current Balance: {self.current_customer.balance} DKK").pack()
         Button(self.window, text="Add Balance", command=self.add_balance).pack()
-        Label(self.window, text=f"Available Quantity: {self.current_cafeteria.menu[item]['quantity']}").pack()
+        Label(self.window, text=f"Available Quantity: {self.current_cafeteria.snapshot.menu[item]['quantity']}").pack()
         Label(self.window, text="Quantity").pack()
         self.current_quantity = Entry(self.window)
         self.current_quantity.pack()
@@ -1200,7 +5225,7 @@ class GUI:
         for widget in self.window.winfo_children():
             widget.destroy()
         Label(self.window, text="Menu", font=("Arial", 20)).pack()
-        menu = self.current_cafeteria.menu
+        menu = self.current_cafeteria.snapshot.menu
         for item, details in menu.items():
             description, price, quantity = details['description'], details['price'], details['quantity']
             frame = Frame(self.window)
@@ -1216,7 +5241,7 @@ class GUI:
         for widget in self.window.winfo_children():
             widget.destroy()
         Label(self.window, text=f"Restock {item}", font=("Arial", 20)).pack()
-        current_quantity = self.current_cafeteria.menu[item]['quantity']
+        current_quantity = self.current_cafeteria.snapshot.menu[item]['quantity']
         Label(self.window, text=f"Current Quantity: {current_quantity}").pack()
         Label(self.window, text="Quantity").pack()
         self.current_quantity = Entry(self.window)
@@ -1249,7 +5274,7 @@ class GUI:
         Button(self.window, text="Back", command=self.view_cafeteria_menu).pack()
         
         # Display existing data
-        current_data = self.current_cafeteria.menu[item]
+        current_data = self.current_cafeteria.snapshot.menu[item]
         Label(self.window, text=f"Current Description: {current_data['description']}").pack()
         Label(self.window, text=f"Current Price: {current_data['price']}").pack()
         Label(self.window, text=f"Current Quantity: {current_data['quantity']}").pack()
@@ -1523,9 +5548,52 @@ class GUI:
 
 
  
+# %% [markdown]
+# #### Test and Use the GUI
+
+# %%
 # Test and use GUI
-university=setup_example()
-upload_example_menus(university)
-testGUI = GUI(university)
+if __name__ == "__main__":
+    import argparse
+    import sys
+    parser = argparse.ArgumentParser(description="University Cafeteria System. Without a command the GUI is started.")
+    commands = parser.add_subparsers(dest="command")
+    benchmark_parser = commands.add_parser("benchmark", help="run the benchmark suite")
+    benchmark_parser.add_argument("--output", help="file to save the results as JSON")
+    benchmark_parser.add_argument("--baseline", help="JSON file of an earlier run to compare against")
+    benchmark_parser.add_argument("--scale", action="append", choices=list(BENCHMARK_SCALES), help="scale to run, can be repeated")
+    benchmark_parser.add_argument("--case", action="append", choices=list(BENCHMARK_CASES), help="case to run, can be repeated")
+    benchmark_parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative regression")
+    load_parser = commands.add_parser("load", help="generate load from a scenario and report throughput and latency")
+    load_parser.add_argument("scenario", nargs="?", help="JSON scenario file, see DEFAULT_SCENARIO")
+    load_parser.add_argument("--mode", choices=["open", "closed"], default="open", help="open loop with a fixed arrival rate or closed loop with a fixed number of clients")
+    load_parser.add_argument("--endpoint", help="HOST:PORT of a running service, by default the model in this process is used")
+    load_parser.add_argument("--duration", type=float, help="seconds to run")
+    load_parser.add_argument("--rate", type=float, help="sessions per second in the open-loop mode")
+    load_parser.add_argument("--clients", type=int, help="clients in the closed-loop mode")
+    load_parser.add_argument("--output", help="file to save the report as JSON")
+    serve_parser = commands.add_parser("serve", help="serve the university of a scenario as a local service")
+    serve_parser.add_argument("scenario", nargs="?", help="JSON scenario file, see DEFAULT_SCENARIO")
+    serve_parser.add_argument("--host", default="127.0.0.1")
+    serve_parser.add_argument("--port", type=int, default=8765)
+    replay_parser = commands.add_parser("replay", help="replay a recorded trace and check the final state")
+    replay_parser.add_argument("trace", help="trace file written by TraceRecorder.save")
+    replay_parser.add_argument("--no-check", action="store_true", help="do not check the outcomes and the final state")
+    # parse_known_args ignores the arguments Jupyter passes to the kernel
+    arguments = parser.parse_known_args()[0]
+    if arguments.command == "benchmark":
+        sys.exit(1 if benchmark_main(arguments.output, arguments.baseline, arguments.scale, arguments.case, arguments.tolerance) else 0)
+    elif arguments.command == "load":
+        load_main(arguments.scenario, arguments.mode, arguments.endpoint, arguments.output,
+                  duration=arguments.duration, arrival_rate=arguments.rate, clients=arguments.clients)
+    elif arguments.command == "serve":
+        asyncio.run(serve_university(build_scenario_university(load_scenario(arguments.scenario)), arguments.host, arguments.port))
+    elif arguments.command == "replay":
+        university, calls, seconds = replay_trace(arguments.trace, check=not arguments.no_check)
+        print(f"Replayed {calls} calls in {seconds:.3f}s ({calls / seconds if seconds > 0 else 0:.0f} calls/s)")
+    else:
+        university=setup_example()
+        upload_example_menus(university)
+        testGUI = GUI(university)
 
 